@@ -1,9 +1,10 @@
 import numpy as np
+import scipy.linalg
 import scipy.signal
 import matplotlib.pyplot as plt
 
 
-def ssa_decomposition(x, L, fe, do_plot=False):
+def ssa_decomposition(x, L, fe, do_plot=False, dtype=np.float64):
     """
     Decompose a signal using Singular Spectral Analysis
 
@@ -11,33 +12,46 @@ def ssa_decomposition(x, L, fe, do_plot=False):
     :param L: window length
     :param fe: sampling frequency
     :param do_plot: flag to plot results
+    :param dtype: float type of the computation, np.float32 halves the
+                  memory needed for long signals
     :return: fc : components frequencies in Hz
              sig : variances of the components
              Y : the components of the SSA
     """
 
+    x = np.asarray(x, dtype=dtype).ravel()
     N = len(x)
-    # build up of the signal matrix
-    X = np.zeros((N-L+1, L))
-    for k in np.arange(0, N-L+1):
-        X[k, :] = np.transpose(x[k:k+L])
+    # build up of the signal matrix, as a read-only view on x: row k is
+    # x[k:k+L]
+    X = np.lib.stride_tricks.sliding_window_view(x, L)
 
-    U, S, V = np.linalg.svd(X, full_matrices=False)
-    sig = S
-    Y = np.zeros((N, L))
+    # the right singular vectors of X are the eigenvectors of the L x L
+    # lag covariance X^T X, which is summed over blocks of L rows so that
+    # only one block of X is ever copied
+    C = np.zeros((L, L))
+    for start in range(0, N-L+1, L):
+        block = np.ascontiguousarray(X[start:start+L])
+        C += block.T @ block
+    lambdas, V = scipy.linalg.eigh(C, check_finite=False)
+    # largest first, like the singular values
+    order = np.argsort(lambdas)[::-1]
+    sig = np.sqrt(np.maximum(lambdas[order], 0))
+    V = V[:, order].astype(dtype)
+    Y = np.zeros((N, L), dtype=dtype)
     fc = np.zeros((L, 1))
-    y = np.zeros(N)
 
-    for k in np.arange(0, L):
+    # number of terms on each anti-diagonal of the signal matrix
+    n = np.arange(N)
+    counts = np.minimum(np.minimum(n+1, N-n), min(L, N-L+1)).astype(dtype)
 
-        # computation s_i*u_i*v_i^T
-        u_k = U[:, k].reshape(N-L+1, 1)
-        v_k = V[k, :].reshape(1, L)
-        Z = np.fliplr(S[k]*u_k*v_k)
+    for k in np.arange(0, L):
 
-        # averaging the anti-diagonals
-        for p in np.arange(-N+L+1, L+1):
-            y[L-p] = np.mean(np.diag(Z, p-1))
+        # averaging the anti-diagonals of X*v_i*v_i^T: X*v_i is the
+        # correlation of x with v_i and the sum over the anti-diagonal n
+        # is the convolution of X*v_i and v_i at n, so neither the matrix
+        # nor X*v_i for all components is ever formed
+        p = scipy.signal.convolve(x, V[::-1, k], mode='valid')
+        y = scipy.signal.convolve(p, V[:, k])/counts
 
         # component k is stored
         Y[:, k] = y
@@ -0,0 +1,182 @@
+"""
+Batch heartbeat detection over many leads and records.
+
+The methods of ecgdetectors.Detectors work on one lead at a time. Here
+the filtering stages of a detector run once on a whole samples x leads
+array, vectorised along the lead axis, and the sequential peak detection
+of every lead is handed to a pool of worker processes. The other modules
+split a detector into the same two stages with run_preprocessing() and
+run_peak_detection().
+
+General usage instructions:
+r_peaks = detect_batch(ecg, "Pan Tompkins", sampling_frequency)
+where the detector is a description from Detectors.get_detector_list().
+For a samples x leads array r_peaks[lead] is the array of R-peak sample
+indices of that lead. For a list of records r_peaks[record] holds the
+result of each record in the same way.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from ecgdetectors import (Detectors, christovPeakDetect, engzeePeakDetect,
+                          hamiltonPeakDetect, panPeakDetect,
+                          twoAveragePeakDetect, wqrsPeakDetect)
+
+
+## Filtering stages and peak detection of every detector of
+## Detectors.get_detector_list(), by description
+DETECTOR_STAGES = {
+    "Elgendi et al (Two average)": ("two_average_preprocessing", twoAveragePeakDetect),
+    "Engzee": ("engzee_preprocessing", engzeePeakDetect),
+    "Christov": ("christov_preprocessing", christovPeakDetect),
+    "Hamilton": ("hamilton_preprocessing", hamiltonPeakDetect),
+    "Pan Tompkins": ("pan_tompkins_preprocessing", panPeakDetect),
+    "WQRS": ("wqrs_preprocessing", wqrsPeakDetect),
+}
+
+## Peak detections that take the jit flag of Detectors.use_jit
+JIT_PEAK_DETECTION = (christovPeakDetect, engzeePeakDetect,
+                      hamiltonPeakDetect, panPeakDetect)
+
+
+@lru_cache
+def shared_detectors(fs):
+    """
+    Detectors for the sampling rate fs, shared between calls so that
+    their filters are designed only once. Callers must not change or
+    instrument them.
+    """
+    return Detectors(fs)
+
+
+def run_preprocessing(detectors, detector, ecg):
+    """
+    Runs the filtering stages of detector on ecg, one lead or samples x
+    leads, and returns the tuple of signals its peak detection takes.
+    """
+    preprocessing, _ = DETECTOR_STAGES[detector]
+    signals = getattr(detectors, preprocessing)(ecg)
+    if not isinstance(signals, tuple):
+        signals = (signals,)
+
+    return signals
+
+
+def lead_signals(signals, lead=None):
+    """
+    The signals of run_preprocessing() for one lead as contiguous
+    arrays. lead is the column of a multi-lead result, or None when the
+    signals are of a single lead.
+    """
+    if not isinstance(signals, tuple):
+        signals = (signals,)
+    if lead is None:
+        return signals
+
+    return tuple(np.ascontiguousarray(s[:, lead]) for s in signals)
+
+
+def run_peak_detection(detectors, detector, signals, lead=None):
+    """
+    Runs the peak detection of detector on the signals of
+    run_preprocessing(), for the given lead of a multi-lead result, with
+    the sampling rate, Engzee delay and jit flag of detectors. Returns
+    the int array of R-peak sample indices.
+    """
+    _, peak_detection = DETECTOR_STAGES[detector]
+    args = lead_signals(signals, lead) + (detectors.fs,)
+    if peak_detection is engzeePeakDetect:
+        args += (detectors.engzee_fake_delay,)
+
+    if peak_detection in JIT_PEAK_DETECTION:
+        return peak_detection(*args, jit=detectors.use_jit)
+
+    return peak_detection(*args)
+
+
+def detect_batch(records, detector, sampling_frequency, processes=None):
+    """
+    Runs a detector over all leads of one or several records.
+
+    Args:
+        records: a single lead, an array of samples x leads, or an
+            iterable of such records (which may differ in length and
+            number of leads).
+        detector: description of the detector as listed by
+            Detectors.get_detector_list().
+        sampling_frequency: sampling rate in Hz shared by all records.
+        processes: number of worker processes for the peak detection,
+            all CPUs by default. With 1 everything runs in this process.
+
+    Returns:
+        An int array of R-peak sample indices for a single lead, a list
+        of them (one per lead) for a multi-lead record, or a list of
+        such results for an iterable of records.
+    """
+    if detector not in DETECTOR_STAGES:
+        raise RuntimeError('invalid detector!')
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if isinstance(records, np.ndarray):
+        return _detect_records([records], detector, sampling_frequency,
+                               processes)[0]
+
+    return _detect_records(records, detector, sampling_frequency, processes)
+
+
+def _detect_records(records, detector, sampling_frequency, processes):
+    detectors = shared_detectors(sampling_frequency)
+
+    executor = None
+    if processes > 1:
+        executor = ProcessPoolExecutor(max_workers=processes)
+
+    results = []
+    # leads handed to the pool but not collected yet; bounding them keeps
+    # only a few records' filtered signals in memory at a time
+    pending = deque()
+
+    try:
+        for record in records:
+            record = np.asarray(record, dtype=float)
+            signals = run_preprocessing(detectors, detector, record)
+            leads = [None] if record.ndim == 1 else range(record.shape[1])
+
+            peaks = []
+            for lead in leads:
+                if executor is None:
+                    peaks.append(run_peak_detection(detectors, detector, signals, lead))
+                else:
+                    # only the lead's own signals are sent to the worker
+                    future = executor.submit(run_peak_detection, detectors, detector,
+                                             lead_signals(signals, lead))
+                    pending.append((peaks, len(peaks), future))
+                    peaks.append(None)
+
+            results.append((peaks, record.ndim == 1))
+            del signals
+
+            while len(pending) > 2*processes:
+                _collect(pending.popleft())
+
+        while pending:
+            _collect(pending.popleft())
+
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return [peaks[0] if single_lead else peaks
+            for peaks, single_lead in results]
+
+
+def _collect(job):
+    peaks, lead, future = job
+    peaks[lead] = future.result()
@@ -0,0 +1,324 @@
+"""
+Benchmark suite for the heartbeat detectors in ecgdetectors.py.
+
+Every detector of Detectors.get_detector_list() is run over synthetic
+ECG at several sampling rates and lengths and over the records bundled
+with the labs. Each run reports its throughput in samples per second,
+the peak resident memory of the process, the peak of the memory traced
+by tracemalloc and, where reference beats are known, the sensitivity
+and positive predictive value of the detections. The leads of
+aecg_a13.hdf5 are only timed: its reference beats are the fetal ones,
+while the detectors lock onto the maternal QRS of the raw abdominal
+leads. With a fetal RR interval of about 0.48 s, detections that have
+nothing to do with the fetal beats would already score about 0.6.
+
+Each run happens in a fresh worker process, so that the memory figures
+of one run are not inflated by the previous ones.
+
+General usage instructions:
+python ecgbenchmark.py --output results.json
+or from Python:
+results = run_benchmark(rates=(250, 500), durations=(10, 60))
+The results are a JSON-serialisable dict, so files from different
+versions of the detectors can be compared to track regressions.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pathlib
+except ImportError:
+    import pathlib2 as pathlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+import scipy
+
+from ecgdetectors import Detectors, ecgjit
+
+
+## Folder holding the lab folders (lab02, lab03, ...)
+LABS_PATH = pathlib.Path(__file__).resolve().parents[3]
+
+## Sampling rates in Hz and lengths in s of the synthetic records
+SYNTHETIC_RATES = (250, 360, 500, 1000)
+SYNTHETIC_DURATIONS = (10, 60, 300)
+
+## A detection within this many seconds of a reference beat is a hit
+TOLERANCE = 0.15
+
+
+def synthetic_ecg(sampling_frequency, duration, heart_rate=70, noise=0.05,
+                  seed=0):
+    """
+    Simple synthetic ECG made of Gaussian P, Q, R, S and T waves on a
+    baseline wander, 50 Hz interference and white noise. The RR
+    intervals vary randomly by 10% around 60/heart_rate.
+
+    Returns the ECG and the sample indices of its R-peaks.
+    """
+    rng = np.random.default_rng(seed)
+    fs = sampling_frequency
+    n = int(duration*fs)
+    t = np.arange(n)/fs
+
+    beats = []
+    beat = 0.3
+    while beat < duration-1:
+        beats.append(int(beat*fs))
+        beat += max(60/heart_rate*(1+0.1*rng.standard_normal()), 0.35)
+    beats = np.array(beats, dtype=np.int64)
+
+    # (amplitude, offset from the R-peak in s, width in s) of each wave
+    waves = ((0.1, -0.18, 0.03), (-0.15, -0.02, 0.01), (1.0, 0.0, 0.01),
+             (-0.2, 0.03, 0.012), (0.2, 0.25, 0.05))
+    ecg = np.zeros(n)
+    half_width = int(0.5*fs)
+    for beat in beats:
+        start = max(beat-half_width, 0)
+        stop = min(beat+half_width, n)
+        tb = (np.arange(start, stop)-beat)/fs
+        for amplitude, offset, width in waves:
+            ecg[start:stop] += amplitude*np.exp(-((tb-offset)/width)**2)
+
+    ecg += 0.1*np.sin(2*np.pi*0.3*t) + 0.02*np.sin(2*np.pi*50*t)
+    ecg += noise*rng.standard_normal(n)
+
+    return ecg, beats
+
+
+def bundled_records():
+    """
+    Returns the ECG records shipped with the labs as a list of
+    (name, ecg, sampling_frequency, reference_beats) tuples, where
+    reference_beats is None if the record has no annotations of the
+    beats the detectors look for. Records whose file or reader is
+    missing are skipped.
+    """
+    records = []
+
+    for lab in ("lab02", "lab03"):
+        path = LABS_PATH / lab / "code" / "ecg.dat"
+        if path.exists():
+            records.append((lab+"/ecg.dat", np.genfromtxt(path), 500, None))
+
+    path = LABS_PATH / "lab10" / "code" / "lab1_fetal_ecg" / "aecg_a13.hdf5"
+    try:
+        import pandas as pd
+        signals = pd.read_hdf(path, "signals")
+    except (ImportError, OSError):
+        return records
+
+    # the annotated beats are fetal, the detectors find the maternal QRS
+    for lead in signals.columns:
+        records.append(("aecg_a13/"+lead, signals[lead].to_numpy(dtype=float),
+                        1000, None))
+
+    return records
+
+
+def synthetic_records(rates=SYNTHETIC_RATES, durations=SYNTHETIC_DURATIONS):
+    """
+    Synthetic records for every sampling rate and length, in the same
+    format as bundled_records().
+    """
+    records = []
+    for fs in rates:
+        for duration in durations:
+            ecg, beats = synthetic_ecg(fs, duration, seed=int(fs+duration))
+            records.append(("synthetic_%gHz_%gs" % (fs, duration), ecg, fs, beats))
+
+    return records
+
+
+def match_beats(detected, reference, tolerance):
+    """
+    Number of reference beats with a detection less than tolerance
+    samples away, each detection counting for at most one beat. Both
+    arrays are sorted, so every beat is compared with its two
+    neighbouring detections found by binary search.
+    """
+    detected = np.sort(np.asarray(detected, dtype=np.int64))
+    reference = np.sort(np.asarray(reference, dtype=np.int64))
+    if len(detected) == 0 or len(reference) == 0:
+        return 0
+
+    right = np.clip(np.searchsorted(detected, reference), 0, len(detected)-1)
+    left = np.clip(right-1, 0, len(detected)-1)
+    nearest = np.where(abs(detected[left]-reference) <= abs(detected[right]-reference),
+                       left, right)
+    hits = nearest[abs(detected[nearest]-reference) <= tolerance]
+
+    return len(np.unique(hits))
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None if the
+    resource module is not available.
+    """
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return maxrss
+    return maxrss*1024
+
+
+def _run_case(description, ecg, fs, reference, repeats, use_jit, tolerance):
+    detectors = Detectors(fs)
+    detectors.use_jit = use_jit
+    detector = dict(detectors.get_detector_list())[description]
+
+    rss_before = peak_rss()
+
+    # the first call also compiles or loads the numba kernels
+    try:
+        r_peaks = detector(ecg)
+    except Exception as e:
+        # e.g. records shorter than the filters of a detector
+        return {"error": repr(e)}
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        detector(ecg)
+        seconds.append(time.perf_counter()-start)
+
+    rss_after = peak_rss()
+
+    tracemalloc.start()
+    detector(ecg)
+    alloc_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        "n_beats": len(r_peaks),
+        "seconds": min(seconds),
+        "seconds_median": float(np.median(seconds)),
+        "samples_per_second": len(ecg)/min(seconds),
+        "peak_rss_bytes": rss_after,
+        "peak_rss_before_bytes": rss_before,
+        "alloc_peak_bytes": alloc_peak,
+        "n_reference": None,
+        "sensitivity": None,
+        "ppv": None,
+    }
+
+    if reference is not None:
+        hits = match_beats(r_peaks, reference, int(tolerance*fs))
+        result["n_reference"] = len(reference)
+        result["sensitivity"] = hits/len(reference) if len(reference) else None
+        result["ppv"] = hits/len(r_peaks) if len(r_peaks) else None
+
+    return result
+
+
+def run_benchmark(rates=SYNTHETIC_RATES, durations=SYNTHETIC_DURATIONS,
+                  detectors=None, bundled=True, repeats=3, use_jit=True,
+                  tolerance=TOLERANCE):
+    """
+    Runs every detector over the synthetic and bundled records.
+
+    Args:
+        rates, durations: sampling rates in Hz and lengths in s of the
+            synthetic records.
+        detectors: descriptions of the detectors to run, all of
+            Detectors.get_detector_list() by default.
+        bundled: also run over the records shipped with the labs.
+        repeats: number of timed runs of each detector on each record,
+            the fastest one gives the throughput.
+        use_jit: see Detectors.use_jit.
+        tolerance: maximum distance in s between a detection and the
+            reference beat it matches.
+
+    Returns:
+        A dict with the environment under "metadata" and one entry per
+        detector and record under "results".
+    """
+    if detectors is None:
+        detectors = [description for description, _ in Detectors().get_detector_list()]
+
+    records = synthetic_records(rates, durations)
+    if bundled:
+        records += bundled_records()
+
+    results = []
+    for name, ecg, fs, reference in records:
+        for description in detectors:
+            # a fresh process per run keeps the peak memory figures apart
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(_run_case, description, ecg, fs, reference,
+                                         repeats, use_jit, tolerance).result()
+            entry = {
+                "detector": description,
+                "record": name,
+                "sampling_frequency": fs,
+                "n_samples": len(ecg),
+                "duration": len(ecg)/fs,
+            }
+            entry.update(result)
+            results.append(entry)
+
+    return {
+        "metadata": {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "numba": ecgjit.numba.__version__ if ecgjit is not None else None,
+            "use_jit": use_jit and ecgjit is not None,
+            "repeats": repeats,
+            "tolerance": tolerance,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--output", help="JSON file to write, stdout by default")
+    parser.add_argument("--rates", type=int, nargs="+", default=SYNTHETIC_RATES,
+                        help="sampling rates in Hz of the synthetic records")
+    parser.add_argument("--durations", type=float, nargs="+", default=SYNTHETIC_DURATIONS,
+                        help="lengths in s of the synthetic records")
+    parser.add_argument("--detectors", nargs="+",
+                        help="detector descriptions, all by default")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="matching tolerance in s")
+    parser.add_argument("--no-bundled", action="store_true",
+                        help="only run over the synthetic records")
+    parser.add_argument("--no-jit", action="store_true",
+                        help="run the pure Python threshold stages")
+    args = parser.parse_args()
+
+    results = run_benchmark(rates=args.rates, durations=args.durations,
+                            detectors=args.detectors, bundled=not args.no_bundled,
+                            repeats=args.repeats, use_jit=not args.no_jit,
+                            tolerance=args.tolerance)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
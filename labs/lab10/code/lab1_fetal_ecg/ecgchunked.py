@@ -0,0 +1,161 @@
+"""
+Heartbeat detection over recordings too long to hold in memory.
+
+The detectors of ecgdetectors.Detectors need the whole record as a
+float64 array, plus several intermediates of the same length. Here the
+record is read one chunk at a time from anything that can be sliced
+along its first axis, such as a numpy memmap or an h5py dataset, and
+each lead is fed to the streaming detector of ecgstreaming.py. The
+streams carry the filter, moving average and threshold state from one
+chunk to the next, so the beats are exactly those of the detector run
+on the whole record, whatever the chunk length. Memory use is
+proportional to the chunk length, not to the record length.
+
+Processing that cannot carry its state from one block to the next, such
+as the per block source separation of ecgfetal.py, reads each block
+with a warm-up of WARM_UP s before it, so that the filters and the
+adaptive thresholds have settled, and a look-ahead of LOOK_AHEAD s after
+it, so that beats near its end are confirmed. Stitcher moves the start
+of each window to the middle of an RR interval, since the detectors
+expect a record to start between beats, and joins the beats of the
+blocks without duplicates.
+
+General usage instructions:
+ecg = h5py.File("holter.hdf5")["ecg"]
+r_peaks = detect_chunked(ecg, "Pan Tompkins", sampling_frequency)
+where the detector is a description from Detectors.get_detector_list().
+For a samples x leads source r_peaks[lead] is the int array of R-peak
+sample indices of that lead, for a single lead source it is one array.
+"""
+
+import numpy as np
+
+from ecgstreaming import DETECTOR_STREAMS
+
+
+## Length in s of the chunks read from the record
+CHUNK_DURATION = 300
+
+## Seconds read before each block of windowed processing, more than the
+## 10 s moving average of WQRS and the 5 s learning phase of Christov and
+## Engzee
+WARM_UP = 20
+
+## Seconds read after each block of windowed processing to confirm the
+## beats near its end, and to give estimates over the whole window, such
+## as the maternal templates of ecgfetal.py, the beats after the block
+LOOK_AHEAD = 15
+
+
+def detect_chunked(source, detector, sampling_frequency,
+                   chunk_duration=CHUNK_DURATION):
+    """
+    Runs a detector chunk by chunk over a long record.
+
+    Args:
+        source: a single lead or an array of samples x leads that can be
+            sliced along its first axis, e.g. a numpy memmap or an h5py
+            dataset. Only one chunk of it is read at a time.
+        detector: description of the detector as listed by
+            Detectors.get_detector_list().
+        sampling_frequency: sampling rate in Hz.
+        chunk_duration: length in s of each chunk.
+
+    Returns:
+        An int array of R-peak sample indices for a single lead source,
+        or a list of them, one per lead.
+    """
+    if detector not in DETECTOR_STREAMS:
+        raise RuntimeError('invalid detector!')
+
+    fs = sampling_frequency
+    n = source.shape[0]
+    single_lead = len(source.shape) == 1
+    n_leads = 1 if single_lead else source.shape[1]
+
+    chunk = max(int(chunk_duration*fs), 1)
+    streams = [DETECTOR_STREAMS[detector](fs) for _ in range(n_leads)]
+    r_peaks = [[] for _ in range(n_leads)]
+
+    for start in range(0, n, chunk):
+        window = np.asarray(source[start:min(start+chunk, n)], dtype=float)
+
+        for lead, stream in enumerate(streams):
+            if single_lead:
+                r_peaks[lead] += stream.process(window)
+            else:
+                r_peaks[lead] += stream.process(np.ascontiguousarray(window[:, lead]))
+
+        del window
+
+    r_peaks = [np.array(peaks, dtype=np.int64) for peaks in r_peaks]
+    if single_lead:
+        return r_peaks[0]
+
+    return r_peaks
+
+
+class Stitcher:
+    """
+    Joins the beats of windows that overlap their neighbours. Each
+    window contributes the beats that fall into its block. Beats that
+    the windows on either side of a block boundary both found are kept
+    once, and beats from the end of the previous block that only the
+    next window found are kept as well.
+    """
+
+    def __init__(self, refractory):
+        """
+        Beats less than refractory samples apart are the same beat.
+        """
+
+        ## Minimum distance in samples between two beats of different blocks
+        self.refractory = refractory
+
+        ## Last beat kept so far
+        self.last_peak = -refractory-1
+
+        ## Sorted int arrays of the beats kept from each block
+        self.blocks = []
+
+    def window_start(self, start):
+        """
+        Moves the start of a window to the middle of the RR interval of
+        the beats kept so far that contains it.
+        """
+        if start <= 0:
+            return 0
+
+        for block in range(len(self.blocks)-1, -1, -1):
+            peaks = self.blocks[block]
+            if peaks[0] <= start:
+                k = np.searchsorted(peaks, start, side='right')
+                if k < len(peaks):
+                    return int((peaks[k-1]+peaks[k])//2)
+                # the interval may end in the first beat of the next block
+                if block+1 < len(self.blocks):
+                    return int((peaks[-1]+self.blocks[block+1][0])//2)
+                break
+
+        return start
+
+    def add(self, peaks, start, stop):
+        """
+        Adds the beats of the window of the block from sample start to
+        stop, as sorted sample indices of the record.
+        """
+        peaks = np.asarray(peaks, dtype=np.int64)
+        peaks = peaks[(peaks >= start-self.refractory) & (peaks < stop)]
+        peaks = peaks[peaks > self.last_peak+self.refractory]
+        if len(peaks) > 0:
+            self.blocks.append(peaks)
+            self.last_peak = peaks[-1]
+
+    def peaks(self):
+        """
+        Returns the int array of all beats kept.
+        """
+        if not self.blocks:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(self.blocks)
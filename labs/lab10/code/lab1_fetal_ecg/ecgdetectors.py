@@ -11,20 +11,36 @@ GPL GNU GENERAL PUBLIC LICENSE Version 3, 29 June 2007
 """
 
 import numpy as np
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 
 try:
     import pathlib
 except ImportError:
     import pathlib2 as pathlib
+import scipy.ndimage as ndimage
 import scipy.signal as signal
 
+try:
+    import ecgjit
+except ImportError:
+    ecgjit = None
+
 
 class Detectors:
     """ECG heartbeat detection algorithms
     General useage instructions:
     r_peaks = detectors.the_detector(ecg_in_samples)
     The argument ecg_in_samples is a single channel ECG in volt
-    at the given sample rate.
+    at the given sample rate. r_peaks is an int array of sample indices,
+    see result_format for lists or amplitudes and latencies.
+    To see where the time goes:
+    with detectors.instrument() as profile:
+        r_peaks = detectors.the_detector(ecg_in_samples)
+    report = profile.report()
     """
 
     def __init__(self, sampling_frequency = False):
@@ -41,6 +57,29 @@ class Detectors:
         ## This is set to a positive value for benchmarking
         self.engzee_fake_delay = 0
 
+        ## Run the threshold stages compiled with numba when it is
+        ## installed, set to False to force the pure Python loops
+        self.use_jit = True
+
+        ## Format of the beats returned by the detectors: "array" for an
+        ## array of sample indices, "structured" for an array of BEAT_DTYPE
+        ## records that also holds the amplitude and latency of each beat,
+        ## or "list" for a list of ints as returned by older versions
+        self.result_format = "array"
+
+        ## Integer type of the sample indices, np.int32 halves the memory
+        ## for records of less than 2**31 samples
+        self.index_dtype = np.int64
+
+        ## StageProfile recording every filtering and threshold stage,
+        ## None when not instrumented, see instrument()
+        self.profile = None
+
+        ## Filters designed so far for the sampling rate _filter_fs, by
+        ## name, see filter_design()
+        self._filters = {}
+        self._filter_fs = sampling_frequency
+
         ## 2D Array of the different detectors: [[description,detector]]
         self.detector_list = [
             ["Elgendi et al (Two average)",self.two_average_detector],
@@ -61,86 +100,111 @@ class Detectors:
         """
         return self.detector_list
 
-    def hamilton_detector(self, unfiltered_ecg):
+    def filter_design(self, name):
         """
-        P.S. Hamilton, 
-        Open Source ECG Analysis Software Documentation, E.P.Limited, 2002.
+        Returns the filter name of FILTER_DESIGNS for the sampling rate.
+        Each filter is designed on its first use and reused by every
+        later call, until fs is changed.
         """
-        
-        f1 = 8/self.fs
-        f2 = 16/self.fs
-
-        b, a = signal.butter(1, [f1*2, f2*2], btype='bandpass')
+        if self._filter_fs != self.fs:
+            self._filters = {}
+            self._filter_fs = self.fs
 
-        filtered_ecg = signal.lfilter(b, a, unfiltered_ecg)
+        if name not in self._filters:
+            self._filters[name] = design_filter(name, self.fs)
 
-        diff = abs(np.diff(filtered_ecg))
+        return self._filters[name]
 
-        b = np.ones(int(0.08*self.fs))
-        b = b/int(0.08*self.fs)
-        a = [1]
+    @contextmanager
+    def instrument(self, trace_memory=True):
+        """
+        Context manager that records the stages of every detection run
+        inside it into the StageProfile it yields. With trace_memory the
+        peak allocation of each stage is traced with tracemalloc as well,
+        which slows the stages down. Outside of it the stages are not
+        timed at all.
+        """
+        profile = StageProfile(trace_memory)
+        previous = self.profile
+        self.profile = profile
+        start_tracing = trace_memory and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        try:
+            yield profile
+        finally:
+            self.profile = previous
+            if start_tracing:
+                tracemalloc.stop()
+
+    def _result(self, r_peaks, unfiltered_ecg):
+        """
+        Converts the beats of a detector to result_format.
+        """
+        if self.result_format == "list":
+            return np.asarray(r_peaks).tolist()
 
-        ma = signal.lfilter(b, a, diff)
+        r_peaks = np.asarray(r_peaks, dtype=self.index_dtype)
+        if self.result_format == "array":
+            return r_peaks
+        elif self.result_format == "structured":
+            return beat_records(r_peaks, unfiltered_ecg, self.fs)
 
-        ma[0:len(b)*2] = 0
+        raise RuntimeError('invalid result format!')
 
-        n_pks = []
-        n_pks_ave = 0.0
-        s_pks = []
-        s_pks_ave = 0.0
-        QRS = [0]
-        RR = []
-        RR_ave = 0.0
+    def _stage(self, detector, stage, n_samples, label=None):
+        if self.profile is None:
+            return NO_STAGE
+        return self.profile.stage(detector, stage, n_samples, label)
 
-        th = 0.0
+    def hamilton_detector(self, unfiltered_ecg):
+        """
+        P.S. Hamilton, 
+        Open Source ECG Analysis Software Documentation, E.P.Limited, 2002.
+        """
 
-        i=0
-        idx = []
-        peaks = []  
+        ma = self.hamilton_preprocessing(unfiltered_ecg)
 
-        for i in range(len(ma)):
+        with self._stage("Hamilton", "thresholding", len(ma), "threshold and searchback"):
+            QRS = hamiltonPeakDetect(ma, self.fs, self.use_jit)
 
-            if i>0 and i<len(ma)-1:
-                if ma[i-1]<ma[i] and ma[i+1]<ma[i]:
-                    peak = i
-                    peaks.append(i)
+        return self._result(QRS, unfiltered_ecg)
 
-                    if ma[peak] > th and (peak-QRS[-1])>0.3*self.fs:        
-                        QRS.append(peak)
-                        idx.append(i)
-                        s_pks.append(ma[peak])
-                        if len(n_pks)>8:
-                            s_pks.pop(0)
-                        s_pks_ave = np.mean(s_pks)
+    def hamilton_preprocessing(self, unfiltered_ecg):
+        """
+        Filtering stages of the Hamilton detector, returns the moving
+        average that hamiltonPeakDetect thresholds. Works along the first
+        axis, so an array of samples x leads is filtered in one go.
+        """
+        return self.hamilton_moving_average(self.hamilton_derivative(unfiltered_ecg))
 
-                        if RR_ave != 0.0:
-                            if QRS[-1]-QRS[-2] > 1.5*RR_ave:
-                                missed_peaks = peaks[idx[-2]+1:idx[-1]]
-                                for missed_peak in missed_peaks:
-                                    if missed_peak-peaks[idx[-2]]>int(0.360*self.fs) and ma[missed_peak]>0.5*th:
-                                        QRS.append(missed_peak)
-                                        QRS.sort()
-                                        break
+    def hamilton_derivative(self, unfiltered_ecg):
+        """
+        Bandpass and derivative of the Hamilton detector.
+        """
+        n = len(unfiltered_ecg)
+        with self._stage("Hamilton", "filter", n, "bandpass"):
+            sos = self.filter_design("hamilton_sos")
 
-                        if len(QRS)>2:
-                            RR.append(QRS[-1]-QRS[-2])
-                            if len(RR)>8:
-                                RR.pop(0)
-                            RR_ave = int(np.mean(RR))
+            filtered_ecg = signal.sosfilt(sos, unfiltered_ecg, axis=0)
 
-                    else:
-                        n_pks.append(ma[peak])
-                        if len(n_pks)>8:
-                            n_pks.pop(0)
-                        n_pks_ave = np.mean(n_pks)
+        with self._stage("Hamilton", "derivative", n, "derivative"):
+            return np.diff(filtered_ecg, axis=0)
 
-                    th = n_pks_ave + 0.45*(s_pks_ave-n_pks_ave)
+    def hamilton_moving_average(self, diff):
+        """
+        Moving average of the absolute derivative of the Hamilton
+        detector, from hamilton_derivative() or a derivative like it.
+        """
+        with self._stage("Hamilton", "MWA", len(diff), "absolute moving average"):
+            b = self.filter_design("hamilton_ma")
+            a = [1]
 
-                    i+=1
+            ma = signal.lfilter(b, a, abs(diff), axis=0)
 
-        QRS.pop(0)
+        ma[0:len(b)*2] = 0
 
-        return QRS
+        return ma
 
     
     def christov_detector(self, unfiltered_ecg):
@@ -150,127 +214,38 @@ class Detectors:
         adaptive threshold, BioMedical Engineering OnLine 2004, 
         vol. 3:28, 2004.
         """
-        total_taps = 0
 
-        b = np.ones(int(0.02*self.fs))
-        b = b/int(0.02*self.fs)
-        total_taps += len(b)
-        a = [1]
+        MA3 = self.christov_preprocessing(unfiltered_ecg)
 
-        MA1 = signal.lfilter(b, a, unfiltered_ecg)
+        with self._stage("Christov", "thresholding", len(MA3), "M+F+R threshold"):
+            QRS = christovPeakDetect(MA3, self.fs, self.use_jit)
+        
+        return self._result(QRS, unfiltered_ecg)
 
-        b = np.ones(int(0.028*self.fs))
-        b = b/int(0.028*self.fs)
-        total_taps += len(b)
+    def christov_preprocessing(self, unfiltered_ecg):
+        """
+        Filtering stages of the Christov detector, returns the signal
+        that christovPeakDetect thresholds. Works along the first axis.
+        """
+        n = len(unfiltered_ecg)
+        MA1_b, MA2_b, MA3_b = self.filter_design("christov_ma")
         a = [1]
 
-        MA2 = signal.lfilter(b, a, MA1)
+        with self._stage("Christov", "filter", n, "moving averages MA1 and MA2"):
+            MA1 = signal.lfilter(MA1_b, a, unfiltered_ecg, axis=0)
 
-        Y = []
-        for i in range(1, len(MA2)-1):
-            
-            diff = abs(MA2[i+1]-MA2[i-1])
+            MA2 = signal.lfilter(MA2_b, a, MA1, axis=0)
 
-            Y.append(diff)
+        with self._stage("Christov", "derivative", n, "absolute derivative"):
+            Y = abs(MA2[2:]-MA2[:-2])
 
-        b = np.ones(int(0.040*self.fs))
-        b = b/int(0.040*self.fs)
-        total_taps += len(b)
-        a = [1]
-
-        MA3 = signal.lfilter(b, a, Y)
+        with self._stage("Christov", "MWA", n, "moving average MA3"):
+            MA3 = signal.lfilter(MA3_b, a, Y, axis=0)
 
+        total_taps = len(MA1_b)+len(MA2_b)+len(MA3_b)
         MA3[0:total_taps] = 0
 
-        ms50 = int(0.05*self.fs)
-        ms200 = int(0.2*self.fs)
-        ms1200 = int(1.2*self.fs)
-        ms350 = int(0.35*self.fs)
-
-        M = 0
-        newM5 = 0
-        M_list = []
-        MM = []
-        M_slope = np.linspace(1.0, 0.6, ms1200-ms200)
-        F = 0
-        F_list = []
-        R = 0
-        RR = []
-        Rm = 0
-        R_list = []
-
-        MFR = 0
-        MFR_list = []
-
-        QRS = []
-
-        for i in range(len(MA3)):
-
-            # M
-            if i < 5*self.fs:
-                M = 0.6*np.max(MA3[:i+1])
-                MM.append(M)
-                if len(MM)>5:
-                    MM.pop(0)
-
-            elif QRS and i < QRS[-1]+ms200:
-                newM5 = 0.6*np.max(MA3[QRS[-1]:i])
-                if newM5>1.5*MM[-1]:
-                    newM5 = 1.1*MM[-1]
-
-            elif QRS and i == QRS[-1]+ms200:
-                if newM5==0:
-                    newM5 = MM[-1]
-                MM.append(newM5)
-                if len(MM)>5:
-                    MM.pop(0)    
-                M = np.mean(MM)    
-            
-            elif QRS and i > QRS[-1]+ms200 and i < QRS[-1]+ms1200:
-
-                M = np.mean(MM)*M_slope[i-(QRS[-1]+ms200)]
-
-            elif QRS and i > QRS[-1]+ms1200:
-                M = 0.6*np.mean(MM)
-
-            # F
-            if i > ms350:
-                F_section = MA3[i-ms350:i]
-                max_latest = np.max(F_section[-ms50:])
-                max_earliest = np.max(F_section[:ms50])
-                F = F + ((max_latest-max_earliest)/150.0)
-
-            # R
-            if QRS and i < QRS[-1]+int((2.0/3.0*Rm)):
-
-                R = 0
-
-            elif QRS and i > QRS[-1]+int((2.0/3.0*Rm)) and i < QRS[-1]+Rm:
-
-                dec = (M-np.mean(MM))/1.4
-                R = 0 + dec
-
-
-            MFR = M+F+R
-            M_list.append(M)
-            F_list.append(F)
-            R_list.append(R)
-            MFR_list.append(MFR)
-
-            if not QRS and MA3[i]>MFR:
-                QRS.append(i)
-            
-            elif QRS and i > QRS[-1]+ms200 and MA3[i]>MFR:
-                QRS.append(i)
-                if len(QRS)>2:
-                    RR.append(QRS[-1]-QRS[-2])
-                    if len(RR)>5:
-                        RR.pop(0)
-                    Rm = int(np.mean(RR))
-
-        QRS.pop(0)
-        
-        return QRS
+        return MA3
 
     
     def engzee_detector(self, unfiltered_ecg):
@@ -282,116 +257,39 @@ class Detectors:
         Electrocardiogram Segmentation for Finger Based ECG
         Biometrics”, BIOSIGNALS 2012, pp. 49-54, 2012.
         """
+
+        low_pass, unfiltered_ecg = self.engzee_preprocessing(unfiltered_ecg)
+
+        with self._stage("Engzee", "thresholding", len(low_pass), "threshold and R-peak search"):
+            r_peaks = engzeePeakDetect(low_pass, unfiltered_ecg, self.fs,
+                                       self.engzee_fake_delay, self.use_jit)
+
+        return self._result(r_peaks, unfiltered_ecg)
+
+    def engzee_preprocessing(self, unfiltered_ecg):
+        """
+        Filtering stages of the Engzee detector. Returns the low-passed
+        difference that engzeePeakDetect thresholds together with the
+        unfiltered ECG it locates the R-peaks in. Works along the first
+        axis.
+        """
                 
-        f1 = 48/self.fs
-        f2 = 52/self.fs
-        b, a = signal.butter(4, [f1*2, f2*2], btype='bandstop')
-        filtered_ecg = signal.lfilter(b, a, unfiltered_ecg)
+        n = len(unfiltered_ecg)
+        with self._stage("Engzee", "filter", n, "bandstop"):
+            sos = self.filter_design("engzee_sos")
+            filtered_ecg = signal.sosfilt(sos, unfiltered_ecg, axis=0)
 
-        diff = np.zeros(len(filtered_ecg))
-        for i in range(4, len(diff)):
-            diff[i] = filtered_ecg[i]-filtered_ecg[i-4]
+        with self._stage("Engzee", "derivative", n, "4 sample difference"):
+            diff = np.zeros_like(filtered_ecg)
+            diff[4:] = filtered_ecg[4:]-filtered_ecg[:-4]
 
-        ci = [1,4,6,4,1]        
-        low_pass = signal.lfilter(ci, 1, diff)
+        with self._stage("Engzee", "filter", n, "lowpass"):
+            ci = [1,4,6,4,1]
+            low_pass = signal.lfilter(ci, 1, diff, axis=0)
 
         low_pass[:int(0.2*self.fs)] = 0
-      
-        ms200 = int(0.2*self.fs)
-        ms1200 = int(1.2*self.fs)        
-        ms160 = int(0.16*self.fs)
-        neg_threshold = int(0.01*self.fs)
-
-        M = 0
-        M_list = []
-        neg_m = []
-        MM = []
-        M_slope = np.linspace(1.0, 0.6, ms1200-ms200)
-
-        QRS = []
-        r_peaks = []
-
-        counter = 0
-
-        thi_list = []
-        thi = False
-        thf_list = []
-        thf = False
-        newM5 = False
-
-        for i in range(len(low_pass)):
-
-            # M
-            if i < 5*self.fs:
-                M = 0.6*np.max(low_pass[:i+1])
-                MM.append(M)
-                if len(MM)>5:
-                    MM.pop(0)
-
-            elif QRS and i < QRS[-1]+ms200:
-
-                newM5 = 0.6*np.max(low_pass[QRS[-1]:i])
-
-                if newM5>1.5*MM[-1]:
-                    newM5 = 1.1*MM[-1]
-
-            elif newM5 and QRS and i == QRS[-1]+ms200:
-                MM.append(newM5)
-                if len(MM)>5:
-                    MM.pop(0)    
-                M = np.mean(MM)    
-            
-            elif QRS and i > QRS[-1]+ms200 and i < QRS[-1]+ms1200:
-
-                M = np.mean(MM)*M_slope[i-(QRS[-1]+ms200)]
-
-            elif QRS and i > QRS[-1]+ms1200:
-                M = 0.6*np.mean(MM)
-
-            M_list.append(M)
-            neg_m.append(-M)
-
-
-            if not QRS and low_pass[i]>M:
-                QRS.append(i)
-                thi_list.append(i)
-                thi = True
-            
-            elif QRS and i > QRS[-1]+ms200 and low_pass[i]>M:
-                QRS.append(i)
-                thi_list.append(i)
-                thi = True
-
-            if thi and i<thi_list[-1]+ms160:
-                if low_pass[i]<-M and low_pass[i-1]>-M:
-                    #thf_list.append(i)
-                    thf = True
-                    
-                if thf and low_pass[i]<-M:
-                    thf_list.append(i)
-                    counter += 1
-                
-                elif low_pass[i]>-M and thf:
-                    counter = 0
-                    thi = False
-                    thf = False
-            
-            elif thi and i>thi_list[-1]+ms160:
-                    counter = 0
-                    thi = False
-                    thf = False                                        
-            
-            if counter>neg_threshold:
-                unfiltered_section = unfiltered_ecg[thi_list[-1]-int(0.01*self.fs):i]
-                r_peaks.append(self.engzee_fake_delay+
-                               np.argmax(unfiltered_section)+thi_list[-1]-int(0.01*self.fs))
-                counter = 0
-                thi = False
-                thf = False
 
-        # removing the 1st detection as it 1st needs the QRS complex amplitude for the threshold
-        r_peaks.pop(0)
-        return r_peaks
+        return low_pass, unfiltered_ecg
 
 
     def pan_tompkins_detector(self, unfiltered_ecg, MWA_name='cumulative'):
@@ -401,26 +299,50 @@ class Detectors:
         In: IEEE Transactions on Biomedical Engineering 
         BME-32.3 (1985), pp. 230–236.
         """
-        
-        maxQRSduration = 0.150 #sec
-        f1 = 5/self.fs
-        f2 = 15/self.fs
 
-        b, a = signal.butter(1, [f1*2, f2*2], btype='bandpass')
+        mwa = self.pan_tompkins_preprocessing(unfiltered_ecg, MWA_name)
 
-        filtered_ecg = signal.lfilter(b, a, unfiltered_ecg)        
+        with self._stage("Pan Tompkins", "thresholding", len(mwa), "threshold and searchback"):
+            mwa_peaks = panPeakDetect(mwa, self.fs, self.use_jit)
 
-        diff = np.diff(filtered_ecg) 
+        return self._result(mwa_peaks, unfiltered_ecg)
 
-        squared = diff*diff
+    def pan_tompkins_preprocessing(self, unfiltered_ecg, MWA_name='cumulative'):
+        """
+        Filtering stages of the Pan-Tompkins detector, returns the moving
+        window integration that panPeakDetect thresholds. Works along the
+        first axis.
+        """
+        return self.pan_tompkins_integration(self.pan_tompkins_derivative(unfiltered_ecg),
+                                             MWA_name)
 
-        N = int(maxQRSduration*self.fs)
-        mwa = MWA_from_name(MWA_name)(squared, N)
-        mwa[:int(maxQRSduration*self.fs*2)] = 0
+    def pan_tompkins_derivative(self, unfiltered_ecg):
+        """
+        Bandpass and derivative of the Pan-Tompkins detector.
+        """
+        n = len(unfiltered_ecg)
+        with self._stage("Pan Tompkins", "filter", n, "bandpass"):
+            sos = self.filter_design("pan_tompkins_sos")
+
+            filtered_ecg = signal.sosfilt(sos, unfiltered_ecg, axis=0)
+
+        with self._stage("Pan Tompkins", "derivative", n, "derivative"):
+            return np.diff(filtered_ecg, axis=0)
+
+    def pan_tompkins_integration(self, diff, MWA_name='cumulative'):
+        """
+        Moving window integration of the squared derivative of the
+        Pan-Tompkins detector, from pan_tompkins_derivative().
+        """
+        maxQRSduration = 0.150 #sec
+        with self._stage("Pan Tompkins", "MWA", len(diff), "squared moving window integration"):
+            squared = diff*diff
 
-        mwa_peaks = panPeakDetect(mwa, self.fs)
+            N = int(maxQRSduration*self.fs)
+            mwa = MWA_from_name(MWA_name)(squared, N, out=squared)
+        mwa[:int(maxQRSduration*self.fs*2)] = 0
 
-        return mwa_peaks
+        return mwa
 
 
     def two_average_detector(self, unfiltered_ecg, MWA_name='cumulative'):
@@ -431,47 +353,41 @@ class Detectors:
         The 3rd International Conference on Bio-inspired Systems 
         and Signal Processing (BIOSIGNALS2010). 428-431.
         """
-        
-        f1 = 8/self.fs
-        f2 = 20/self.fs
 
-        b, a = signal.butter(2, [f1*2, f2*2], btype='bandpass')
+        filtered_ecg, mwa_qrs, mwa_beat = self.two_average_preprocessing(
+            unfiltered_ecg, MWA_name)
 
-        filtered_ecg = signal.lfilter(b, a, unfiltered_ecg)
+        with self._stage("Elgendi et al (Two average)", "thresholding", len(filtered_ecg),
+                         "blocks of interest"):
+            QRS = twoAveragePeakDetect(filtered_ecg, mwa_qrs, mwa_beat, self.fs)
 
-        window1 = int(0.12*self.fs)
-        mwa_qrs = MWA_from_name(MWA_name)(abs(filtered_ecg), window1)
+        return self._result(QRS, unfiltered_ecg)
 
-        window2 = int(0.6*self.fs)
-        mwa_beat = MWA_from_name(MWA_name)(abs(filtered_ecg), window2)
-
-        blocks = np.zeros(len(unfiltered_ecg))
-        block_height = np.max(filtered_ecg)
+    def two_average_preprocessing(self, unfiltered_ecg, MWA_name='cumulative'):
+        """
+        Filtering stages of the two average detector, returns the
+        band-passed ECG and its QRS and beat moving averages, the inputs
+        of twoAveragePeakDetect. Works along the first axis.
+        """
+        
+        n = len(unfiltered_ecg)
+        with self._stage("Elgendi et al (Two average)", "filter", n,
+                         "bandpass and rectification"):
+            sos = self.filter_design("two_average_sos")
 
-        for i in range(len(mwa_qrs)):
-            if mwa_qrs[i] > mwa_beat[i]:
-                blocks[i] = block_height
-            else:
-                blocks[i] = 0
+            filtered_ecg = signal.sosfilt(sos, unfiltered_ecg, axis=0)
 
-        QRS = []
+            rectified = abs(filtered_ecg)
 
-        for i in range(1, len(blocks)):
-            if blocks[i-1] == 0 and blocks[i] == block_height:
-                start = i
-            
-            elif blocks[i-1] == block_height and blocks[i] == 0:
-                end = i-1
+        with self._stage("Elgendi et al (Two average)", "MWA", n,
+                         "QRS and beat moving averages"):
+            window1 = int(0.12*self.fs)
+            mwa_qrs = MWA_from_name(MWA_name)(rectified, window1)
 
-                if end-start>int(0.08*self.fs):
-                    detection = np.argmax(filtered_ecg[start:end+1])+start
-                    if QRS:
-                        if detection-QRS[-1]>int(0.3*self.fs):
-                            QRS.append(detection)
-                    else:
-                        QRS.append(detection)
+            window2 = int(0.6*self.fs)
+            mwa_beat = MWA_from_name(MWA_name)(rectified, window2, out=rectified)
 
-        return QRS
+        return filtered_ecg, mwa_qrs, mwa_beat
 
     def wqrs_detector(self, unfiltered_ecg):
         """
@@ -480,39 +396,232 @@ class Detectors:
         Complexes 
         In: 2003 IEEE
         """
-        def butter_lowpass_filter(data, cutoff):
-            nyq = 0.5 * self.fs
-            order = 2
-
-            normal_cutoff = cutoff / nyq
-            
-            b, a = signal.butter(order, normal_cutoff, btype='low', analog=False)
-            y = signal.lfilter(b, a, data)
-            return y
-
-        def length_transfrom(x, w):
-            tmp = []
-            for i in range(w, len(x)):
-                chunk = x[i-w:i]
-                ll = np.sum(
-                    np.sqrt( np.power(1/self.fs,2)*np.ones(w-1) + np.power(np.diff(chunk),2) )
-                )
-                tmp.append(ll)
-            l = [tmp[0]]*w
-            
-            return l+tmp
-        
-        def threshold(x):
-            peaks = []
-            u = MWA_convolve(x, 10*self.fs)
-            for i in range(len(x)):
-                if (len(peaks) == 0 or i > peaks[-1]+(self.fs*0.35)) and x[i] > u[i]:
-                    peaks.append(i)
-            return peaks
-        
-        y = butter_lowpass_filter(unfiltered_ecg, 15)
-        y = length_transfrom(y, int(np.ceil(self.fs*0.13)))
-        return threshold(y)
+
+        y = self.wqrs_preprocessing(unfiltered_ecg)
+
+        with self._stage("WQRS", "thresholding", len(y), "threshold"):
+            r_peaks = wqrsPeakDetect(y, self.fs)
+
+        return self._result(r_peaks, unfiltered_ecg)
+
+    def wqrs_preprocessing(self, unfiltered_ecg):
+        """
+        Filtering stages of the WQRS detector, returns the length
+        transform that wqrsPeakDetect thresholds. Works along the first
+        axis.
+        """
+        n = len(unfiltered_ecg)
+        with self._stage("WQRS", "filter", n, "lowpass"):
+            sos = self.filter_design("wqrs_sos")
+
+            y = signal.sosfilt(sos, unfiltered_ecg, axis=0)
+
+        with self._stage("WQRS", "MWA", n, "length transform"):
+            y = length_transform(y, int(np.ceil(self.fs*0.13)), self.fs)
+
+        return y
+
+## Stage context of a Detectors instance that is not instrumented
+NO_STAGE = nullcontext()
+
+## Stages every detector is reported in, whatever its own name for them.
+## Pan-Tompkins and Hamilton search back inside their threshold loop, so
+## the searchback is timed as part of their thresholding.
+STAGES = ("filter", "derivative", "MWA", "thresholding")
+
+
+class StageProfile:
+    """
+    Wall time, number of samples and peak allocation of the stages run
+    by Detectors.instrument(), in the order they ran.
+    """
+
+    def __init__(self, trace_memory=True):
+        ## Trace the peak allocation of each stage with tracemalloc
+        self.trace_memory = trace_memory
+
+        ## One dict per stage run, see stage()
+        self.records = []
+
+    @contextmanager
+    def stage(self, detector, stage, n_samples, label=None):
+        """
+        Records the stage run inside it as a dict with the detector
+        description, the stage, one of STAGES, the detector's own label
+        for it (the stage itself by default), the number of samples, the
+        wall time in s and the peak allocation in bytes above what was
+        allocated when it started (None without trace_memory).
+        """
+        if stage not in STAGES:
+            raise RuntimeError('invalid stage!')
+
+        if self.trace_memory:
+            allocated = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter()-start
+            alloc_peak = None
+            if self.trace_memory:
+                alloc_peak = tracemalloc.get_traced_memory()[1]-allocated
+            self.records.append({
+                "detector": detector,
+                "stage": stage,
+                "label": stage if label is None else label,
+                "n_samples": n_samples,
+                "seconds": seconds,
+                "alloc_peak_bytes": alloc_peak,
+            })
+
+    def report(self):
+        """
+        Returns a JSON-serialisable dict with the stage runs under
+        "records", one entry per detector, stage and label under
+        "stages", and one entry per stage over all detectors under
+        "totals", in the order of STAGES. Each entry has its number of
+        runs, samples and seconds summed over them, the largest peak
+        allocation and the throughput in samples per second.
+        """
+        stages = self._summarise(("detector", "stage", "label"))
+        totals = self._summarise(("stage",))
+        totals.sort(key=lambda total: STAGES.index(total["stage"]))
+
+        return {"records": list(self.records), "stages": stages, "totals": totals}
+
+    def _summarise(self, fields):
+        """
+        Sums the records by the values of fields.
+        """
+        summary = {}
+        for record in self.records:
+            key = tuple(record[field] for field in fields)
+            if key not in summary:
+                summary[key] = dict(zip(fields, key))
+                summary[key].update({"runs": 0, "n_samples": 0, "seconds": 0.0,
+                                     "alloc_peak_bytes": record["alloc_peak_bytes"]})
+            total = summary[key]
+            total["runs"] += 1
+            total["n_samples"] += record["n_samples"]
+            total["seconds"] += record["seconds"]
+            if record["alloc_peak_bytes"] is not None:
+                total["alloc_peak_bytes"] = max(total["alloc_peak_bytes"],
+                                                record["alloc_peak_bytes"])
+
+        for total in summary.values():
+            total["samples_per_second"] = (total["n_samples"]/total["seconds"]
+                                           if total["seconds"] > 0 else None)
+
+        return list(summary.values())
+
+
+## Record of one beat in the structured result of the detectors: the
+## sample index of the detection, the unfiltered ECG at the R-peak and
+## the latency in s of the detection after the R-peak
+BEAT_DTYPE = np.dtype([("index", np.int64), ("amplitude", np.float64),
+                       ("latency", np.float64)])
+
+## Seconds searched on either side of a detection for its R-peak
+R_PEAK_SEARCH = 0.15
+
+## Samples gathered at a time by r_peak_search, which bounds its
+## temporaries whatever the number of detections
+R_PEAK_SEARCH_BATCH = 1 << 18
+
+
+def r_peak_search(unfiltered_ecg, r_peaks, radius):
+    """
+    Sample index of the largest sample of the unfiltered ECG less than
+    radius samples away from each detection. The detections are searched
+    in batches of R_PEAK_SEARCH_BATCH samples in all.
+    """
+    r_peaks = np.asarray(r_peaks, dtype=np.int64)
+    result = np.zeros(len(r_peaks), dtype=np.int64)
+    if len(r_peaks) == 0 or len(unfiltered_ecg) == 0:
+        return result
+
+    unfiltered_ecg = np.asarray(unfiltered_ecg)
+    offsets = np.arange(-radius, radius+1)
+    batch = max(R_PEAK_SEARCH_BATCH//len(offsets), 1)
+
+    for start in range(0, len(r_peaks), batch):
+        stop = min(start+batch, len(r_peaks))
+        window = np.clip(r_peaks[start:stop, None]+offsets, 0, len(unfiltered_ecg)-1)
+        best = np.argmax(unfiltered_ecg[window], axis=1)
+        result[start:stop] = window[np.arange(stop-start), best]
+
+    return result
+
+
+def beat_records(r_peaks, unfiltered_ecg, fs):
+    """
+    Structured array of BEAT_DTYPE for the detections r_peaks. The
+    R-peak of each detection is the largest unfiltered sample within
+    R_PEAK_SEARCH, so the latency is the lag the filters and thresholds
+    of the detector put on the beat.
+    """
+    beats = np.zeros(len(r_peaks), dtype=BEAT_DTYPE)
+    beats["index"] = r_peaks
+    if len(r_peaks) > 0:
+        r_peak = r_peak_search(unfiltered_ecg, r_peaks, int(R_PEAK_SEARCH*fs))
+        beats["amplitude"] = np.asarray(unfiltered_ecg)[r_peak]
+        beats["latency"] = (beats["index"]-r_peak)/fs
+
+    return beats
+
+
+def butter_sos(order, cutoff, btype, fs):
+    """
+    Butterworth filter with cutoff frequencies in Hz as second-order
+    sections, which stay numerically stable for narrow bands at high
+    sampling rates.
+    """
+    nyq = 0.5 * fs
+    return signal.butter(order, np.divide(cutoff, nyq), btype=btype, output='sos')
+
+
+def boxcar(duration, fs):
+    """
+    FIR kernel of a moving average over duration seconds.
+    """
+    taps = int(duration*fs)
+    return np.ones(taps)/taps
+
+
+## Filters of the detectors as functions of the sampling rate
+FILTER_DESIGNS = {
+    "hamilton_sos": lambda fs: butter_sos(1, [8, 16], 'bandpass', fs),
+    "hamilton_ma": lambda fs: boxcar(0.08, fs),
+    "christov_ma": lambda fs: (boxcar(0.02, fs), boxcar(0.028, fs), boxcar(0.040, fs)),
+    "engzee_sos": lambda fs: butter_sos(4, [48, 52], 'bandstop', fs),
+    "pan_tompkins_sos": lambda fs: butter_sos(1, [5, 15], 'bandpass', fs),
+    "two_average_sos": lambda fs: butter_sos(2, [8, 20], 'bandpass', fs),
+    "wqrs_sos": lambda fs: butter_sos(2, 15, 'low', fs),
+}
+
+
+def design_filter(name, fs):
+    """
+    Designs the filter name of FILTER_DESIGNS for the sampling rate fs.
+    """
+    if name not in FILTER_DESIGNS:
+        raise RuntimeError('invalid filter!')
+
+    return FILTER_DESIGNS[name](fs)
+
+
+@lru_cache(maxsize=None)
+def threshold_slope(ms200, ms1200):
+    """
+    Decay of the M threshold of the Christov and Engzee detectors from
+    200 ms to 1200 ms after a QRS, computed once per sampling rate.
+    """
+    M_slope = np.linspace(1.0, 0.6, ms1200-ms200)
+    M_slope.flags.writeable = False
+
+    return M_slope
+
 
 def MWA_from_name(function_name):
     if function_name == "cumulative":
@@ -521,23 +630,96 @@ def MWA_from_name(function_name):
         return MWA_convolve
     elif function_name == "original":
         return MWA_original
+    elif function_name == "compensated":
+        return MWA_compensated
+    elif function_name == "auto":
+        return MWA
     else: 
         raise RuntimeError('invalid moving average function!')
 
+## Window sizes up to which MWA() convolves instead of summing cumulatively
+MWA_CONVOLVE_MAX_WINDOW = 8
+
+## Lengths from which MWA() switches to the compensated cumulative sum
+MWA_COMPENSATED_MIN_LENGTH = 2**20
+
+## Block length of MWA_compensated
+MWA_BLOCK_SIZE = 2**16
+
+#Moving window average choosing the fastest accurate variant
+def MWA(input_array, window_size, out=None, dtype=None):
+    """
+    Moving window average along the first axis, like all MWA_ variants:
+    sample i is the mean of the window_size samples up to and including
+    i, or of all samples up to i during the first window. Short windows
+    are convolved, which is fastest, long or single precision inputs use
+    the compensated cumulative sum and everything else the plain one.
+    The result is written to out if given, which may be input_array
+    itself, and is float64 unless dtype or out say otherwise.
+    """
+    dtype = _MWA_dtype(out, dtype)
+    if window_size <= MWA_CONVOLVE_MAX_WINDOW:
+        return MWA_convolve(input_array, window_size, out, dtype)
+    elif len(input_array) >= MWA_COMPENSATED_MIN_LENGTH or dtype != np.float64:
+        return MWA_compensated(input_array, window_size, out, dtype)
+
+    return MWA_cumulative(input_array, window_size, out, dtype)
+
 #Fast implementation of moving window average with numpy's cumsum function 
-def MWA_cumulative(input_array, window_size):
-    
-    ret = np.cumsum(input_array, dtype=float)
-    ret[window_size:] = ret[window_size:] - ret[:-window_size]
+def MWA_cumulative(input_array, window_size, out=None, dtype=None):
     
-    for i in range(1,window_size):
-        ret[i-1] = ret[i-1] / i
-    ret[window_size - 1:]  = ret[window_size - 1:] / window_size
+    dtype = _MWA_dtype(out, dtype)
+    if out is None:
+        out = np.empty(np.shape(input_array), dtype=dtype)
+
+    ret = np.cumsum(input_array, axis=0, dtype=dtype, out=out)
+    ret[window_size:] -= ret[:-window_size]
     
-    return ret
+    return _MWA_divide(ret, window_size)
+
+#Cumulative moving window average that stays accurate on long inputs
+def MWA_compensated(input_array, window_size, out=None, dtype=None):
+    """
+    Same as MWA_cumulative, but the running sum restarts every
+    MWA_BLOCK_SIZE samples. Windows that straddle two blocks add the
+    tail of the previous block from its own cumulative sum, so rounding
+    errors are bounded by one block instead of growing with the length
+    of the input. The sums are accumulated in float64 whatever dtype
+    the result is stored in.
+    """
+    dtype = _MWA_dtype(out, dtype)
+    if out is None:
+        out = np.empty(np.shape(input_array), dtype=dtype)
+
+    n = len(input_array)
+    block = max(MWA_BLOCK_SIZE, window_size)
+    previous = None
+
+    for start in range(0, n, block):
+        stop = min(start+block, n)
+        csum = np.cumsum(input_array[start:stop], axis=0, dtype=np.float64)
+        ret = out[start:stop]
+
+        np.subtract(csum[window_size:], csum[:-window_size], out=ret[window_size:])
+        head = min(window_size, stop-start)
+        if previous is None:
+            ret[:head] = csum[:head]
+        else:
+            # the window of sample j < window_size starts in the
+            # previous block, after its sample block-window_size+j
+            tail = previous[-1]-previous[block-window_size:block-window_size+head]
+            np.add(csum[:head], tail, out=ret[:head])
+
+        previous = csum
+
+    return _MWA_divide(out, window_size)
 
 #Original Function 
-def MWA_original(input_array, window_size):
+def MWA_original(input_array, window_size, out=None, dtype=None):
+
+    if np.ndim(input_array) > 1:
+        mwa = np.apply_along_axis(MWA_original, 0, input_array, window_size)
+        return _MWA_output(mwa, out, dtype)
 
     mwa = np.zeros(len(input_array))
     mwa[0] = input_array[0]
@@ -550,18 +732,53 @@ def MWA_original(input_array, window_size):
         
         mwa[i-1] = np.mean(section)
 
-    return mwa
+    return _MWA_output(mwa, out, dtype)
 
 #Fast moving window average implemented with 1D convolution 
-def MWA_convolve(input_array, window_size):
+def MWA_convolve(input_array, window_size, out=None, dtype=None):
+
+    if np.ndim(input_array) > 1:
+        ret = np.apply_along_axis(MWA_convolve, 0, input_array, window_size)
+        return _MWA_output(ret, out, dtype)
     
     ret = np.pad(input_array, (window_size-1,0), 'constant', constant_values=(0,0))
     ret = np.convolve(ret,np.ones(window_size),'valid')
     
-    for i in range(1,window_size):
-        ret[i-1] = ret[i-1] / i
-    ret[window_size-1:] = ret[window_size-1:] / window_size
-    
+    ret = _MWA_divide(ret, window_size)
+
+    return _MWA_output(ret, out, dtype)
+
+
+def _MWA_dtype(out, dtype):
+    if out is not None:
+        return out.dtype
+    elif dtype is None:
+        return np.dtype(np.float64)
+
+    return np.dtype(dtype)
+
+
+def _MWA_output(ret, out, dtype):
+    """
+    Stores a moving average in out, or casts it to dtype.
+    """
+    if out is not None:
+        out[...] = ret
+        return out
+
+    return ret.astype(_MWA_dtype(out, dtype), copy=False)
+
+
+def _MWA_divide(ret, window_size):
+    """
+    Turns the window sums into averages in place, the windows of the
+    first window_size-1 samples only holding the samples so far.
+    """
+    warm_up = min(window_size-1, len(ret))
+    counts = np.arange(1, warm_up+1, dtype=ret.dtype)
+    ret[:warm_up] /= counts.reshape((-1,)+(1,)*(np.ndim(ret)-1))
+    ret[window_size-1:] /= window_size
+
     return ret
 
 
@@ -572,12 +789,454 @@ def normalise(input_array):
     return output_array
 
 
-def panPeakDetect(detection, fs):    
+def local_maxima(input_array):
+    """
+    Returns the indices of all strict local maxima of a 1D array, i.e.
+    the samples i with input_array[i-1] < input_array[i] > input_array[i+1].
+    """
+    input_array = np.asarray(input_array)
+    centre = input_array[1:-1]
+    is_peak = (input_array[:-2] < centre) & (input_array[2:] < centre)
+
+    return np.flatnonzero(is_peak) + 1
+
+
+def short_mean(values):
+    """
+    Mean of a buffer of at most 8 floats, summed in the same order as
+    np.mean so that the ring buffers give bit-identical thresholds.
+    """
+    v = values
+    if len(v) == 8:
+        return (((v[0]+v[1])+(v[2]+v[3]))+((v[4]+v[5])+(v[6]+v[7])))/8
+
+    return sum(v)/len(v)
+
+
+def hamiltonPeakDetect(detection, fs, jit=True):
+    """
+    Adaptive thresholding stage of the Hamilton detector.
+
+    Beats can only be found at local maxima of the detection signal, so
+    these are located in one vectorised pass and the threshold state
+    machine only visits them. The noise peak levels and RR intervals are
+    kept in fixed 8-slot ring buffers, so each noise peak costs O(1).
+    The signal peak level is the mean of all signal peaks so far, taken
+    with np.mean over a preallocated array so that it has the same last
+    bits as the original. With jit the compiled kernel of ecgjit is used
+    if numba is installed.
+    """
+    if jit and ecgjit is not None:
+        QRS = ecgjit.hamilton_peak_detect(np.asarray(detection, dtype=float),
+                                          0.3*fs, int(0.360*fs))
+        return QRS[1:].copy()
+
+    peaks = local_maxima(detection)
+    amplitudes = detection[peaks].tolist()
+    peaks = peaks.tolist()
+
+    n_pks = deque(maxlen=8)
+    n_pks_ave = 0.0
+    s_pks = np.empty(len(peaks))
+    s_pks_count = 0
+    s_pks_ave = 0.0
+    QRS = [0]
+    RR = deque(maxlen=8)
+    RR_ave = 0.0
+
+    th = 0.0
+
+    # sample index of the previously accepted peak
+    last_idx = None
+    ms360 = int(0.360*fs)
+
+    for k, peak in enumerate(peaks):
+
+        if amplitudes[k] > th and (peak-QRS[-1])>0.3*fs:
+            QRS.append(peak)
+            # s_pks was only ever trimmed when len(n_pks)>8, which cannot
+            # happen, so its average is the mean over all signal peaks
+            s_pks[s_pks_count] = amplitudes[k]
+            s_pks_count += 1
+            s_pks_ave = s_pks[:s_pks_count].mean()
+
+            if RR_ave != 0.0:
+                if QRS[-1]-QRS[-2] > 1.5*RR_ave:
+                    # the searchback window indexes the list of peaks with
+                    # sample indices; kept as is to reproduce the original
+                    # detections
+                    start = last_idx+1
+                    stop = min(peak, k+1)
+                    for missed_peak in peaks[start:stop]:
+                        if missed_peak-peaks[last_idx]>ms360 and detection[missed_peak]>0.5*th:
+                            QRS.insert(len(QRS)-1, missed_peak)
+                            break
+
+            if len(QRS)>2:
+                RR.append(QRS[-1]-QRS[-2])
+                RR_ave = int(sum(RR)/len(RR))
+
+            last_idx = peak
+
+        else:
+            n_pks.append(amplitudes[k])
+            n_pks_ave = short_mean(n_pks)
+
+        th = n_pks_ave + 0.45*(s_pks_ave-n_pks_ave)
+
+    return np.array(QRS[1:], dtype=np.int64)
+
+
+def christovPeakDetect(detection, fs, jit=True):
+    """
+    Combined adaptive threshold (M+F+R) stage of the Christov detector.
+
+    The learning phase threshold comes from a running maximum, the two
+    50 ms maxima of the F term from a sliding-window maximum and the
+    maximum since the last QRS is tracked incrementally, so the loop
+    only does O(1) work per sample. With jit the compiled kernel of
+    ecgjit is used if numba is installed.
+    """
+    n = len(detection)
+
+    ms50 = int(0.05*fs)
+    ms200 = int(0.2*fs)
+    ms1200 = int(1.2*fs)
+    ms350 = int(0.35*fs)
+
+    M_slope = threshold_slope(ms200, ms1200)
+
+    # M during the first 5 s is 0.6 times the running maximum
+    n_learn = min(n, int(np.ceil(5*fs)))
+    M_learn = 0.6*np.maximum.accumulate(detection[:n_learn])
+
+    # F accumulates the difference between the maxima of the latest and
+    # the earliest 50 ms of the preceding 350 ms. maximum_filter1d keeps
+    # a monotonic deque, so the trailing 50 ms maxima cost O(n).
+    F = np.zeros(n)
+    if n > ms350+1:
+        max50 = ndimage.maximum_filter1d(detection, ms50, origin=(ms50-1)//2)
+        F[ms350+1:] = np.cumsum((max50[ms350:n-1]-max50[ms50:n-ms350+ms50-1])/150.0)
+
+    if jit and ecgjit is not None:
+        QRS = ecgjit.christov_peak_detect(
+            np.asarray(detection, dtype=float), np.asarray(M_learn, dtype=float),
+            F, M_slope, ms200, ms1200)
+        # copied out of the kernel's buffer of one slot per sample
+        return QRS[1:].copy()
+
+    M_slope = M_slope.tolist()
+    M_learn = M_learn.tolist()
+    F = F.tolist()
+    detection = detection.tolist()
+
+    M = 0
+    newM5 = 0
+    MM = deque(maxlen=5)
+    MM_ave = 0.0
+    R = 0
+    RR = deque(maxlen=5)
+    Rm = 0
+    R_start = 0
+
+    QRS = []
+    last_qrs = 0
+    # maximum of detection[last_qrs:seg_next]
+    seg_max = 0.0
+    seg_next = 0
+
+    for i in range(n):
+
+        # M
+        if i < n_learn:
+            M = M_learn[i]
+            MM.append(M)
+            MM_ave = sum(MM)/len(MM)
+
+        elif QRS and i < last_qrs+ms200:
+            while seg_next < i:
+                if detection[seg_next] > seg_max:
+                    seg_max = detection[seg_next]
+                seg_next += 1
+            newM5 = 0.6*seg_max
+            if newM5>1.5*MM[-1]:
+                newM5 = 1.1*MM[-1]
+
+        elif QRS and i == last_qrs+ms200:
+            if newM5==0:
+                newM5 = MM[-1]
+            MM.append(newM5)
+            MM_ave = sum(MM)/len(MM)
+            M = MM_ave
+
+        elif QRS and i > last_qrs+ms200 and i < last_qrs+ms1200:
+            M = MM_ave*M_slope[i-(last_qrs+ms200)]
+
+        elif QRS and i > last_qrs+ms1200:
+            M = 0.6*MM_ave
+
+        # R
+        if QRS and i < last_qrs+R_start:
+            R = 0
+
+        elif QRS and i > last_qrs+R_start and i < last_qrs+Rm:
+            R = (M-MM_ave)/1.4
+
+        MFR = M+F[i]+R
+
+        if not QRS and detection[i]>MFR:
+            QRS.append(i)
+            last_qrs = i
+            seg_max = detection[i]
+            seg_next = i+1
+
+        elif QRS and i > last_qrs+ms200 and detection[i]>MFR:
+            QRS.append(i)
+            if len(QRS)>2:
+                RR.append(QRS[-1]-QRS[-2])
+                Rm = int(sum(RR)/len(RR))
+                R_start = int((2.0/3.0*Rm))
+            last_qrs = i
+            seg_max = detection[i]
+            seg_next = i+1
+
+    return np.array(QRS[1:], dtype=np.int64)
+
+
+def engzeePeakDetect(low_pass, unfiltered_ecg, fs, fake_delay=0, jit=True):
+    """
+    Threshold and R-peak localisation stage of the Engzee detector.
+
+    The learning phase threshold comes from a running maximum and the
+    maximum since the last QRS is tracked incrementally, so the loop
+    only does O(1) work per sample. fake_delay is added to every
+    R-peak, see Detectors.engzee_fake_delay. With jit the compiled
+    kernel of ecgjit is used if numba is installed.
+    """
+    n = len(low_pass)
+
+    ms200 = int(0.2*fs)
+    ms1200 = int(1.2*fs)
+    ms160 = int(0.16*fs)
+    ms10 = int(0.01*fs)
+    neg_threshold = int(0.01*fs)
+
+    M_slope = threshold_slope(ms200, ms1200)
+
+    # M during the first 5 s is 0.6 times the running maximum
+    n_learn = min(n, int(np.ceil(5*fs)))
+    M_learn = 0.6*np.maximum.accumulate(low_pass[:n_learn])
+
+    if jit and ecgjit is not None:
+        r_peaks = ecgjit.engzee_peak_detect(
+            np.asarray(low_pass, dtype=float), np.asarray(unfiltered_ecg, dtype=float),
+            np.asarray(M_learn, dtype=float), M_slope,
+            ms200, ms1200, ms160, ms10, neg_threshold)
+        # removing the 1st detection as it 1st needs the QRS complex amplitude for the threshold
+        return fake_delay+r_peaks[1:]
+
+    M_slope = M_slope.tolist()
+    M_learn = M_learn.tolist()
+    low_pass = low_pass.tolist()
+
+    M = 0
+    MM = deque(maxlen=5)
+    MM_ave = 0.0
+    newM5 = False
+
+    QRS = []
+    last_qrs = 0
+    # maximum of low_pass[last_qrs:seg_next]
+    seg_max = 0.0
+    seg_next = 0
+
+    r_peaks = []
+
+    counter = 0
+    thi = False
+    thf = False
+
+    for i in range(n):
+
+        # M
+        if i < n_learn:
+            M = M_learn[i]
+            MM.append(M)
+            MM_ave = sum(MM)/len(MM)
+
+        elif QRS and i < last_qrs+ms200:
+            while seg_next < i:
+                if low_pass[seg_next] > seg_max:
+                    seg_max = low_pass[seg_next]
+                seg_next += 1
+            newM5 = 0.6*seg_max
+            if newM5>1.5*MM[-1]:
+                newM5 = 1.1*MM[-1]
+
+        elif newM5 and QRS and i == last_qrs+ms200:
+            MM.append(newM5)
+            MM_ave = sum(MM)/len(MM)
+            M = MM_ave
+
+        elif QRS and i > last_qrs+ms200 and i < last_qrs+ms1200:
+            M = MM_ave*M_slope[i-(last_qrs+ms200)]
+
+        elif QRS and i > last_qrs+ms1200:
+            M = 0.6*MM_ave
+
+        if (not QRS or i > last_qrs+ms200) and low_pass[i]>M:
+            QRS.append(i)
+            last_qrs = i
+            seg_max = low_pass[i]
+            seg_next = i+1
+            thi = True
+
+        if thi and i<last_qrs+ms160:
+            if low_pass[i]<-M and low_pass[i-1]>-M:
+                thf = True
+
+            if thf and low_pass[i]<-M:
+                counter += 1
+
+            elif low_pass[i]>-M and thf:
+                counter = 0
+                thi = False
+                thf = False
+
+        elif thi and i>last_qrs+ms160:
+            counter = 0
+            thi = False
+            thf = False
+
+        if counter>neg_threshold:
+            unfiltered_section = unfiltered_ecg[last_qrs-ms10:i]
+            r_peaks.append(fake_delay+
+                           np.argmax(unfiltered_section)+last_qrs-ms10)
+            counter = 0
+            thi = False
+            thf = False
+
+    # removing the 1st detection as it 1st needs the QRS complex amplitude for the threshold
+    return np.array(r_peaks[1:], dtype=np.int64)
+
+
+def twoAveragePeakDetect(filtered_ecg, mwa_qrs, mwa_beat, fs):
+    """
+    Blocks of interest stage of the two average detector. Blocks are the
+    runs of samples where the QRS average exceeds the beat average; each
+    block longer than 80 ms gives a beat at its maximum, and beats closer
+    than 300 ms to the previous one are dropped. Blocks are found from
+    the edges of a boolean mask and their maxima with
+    np.maximum.reduceat, so only the short list of blocks is looped over.
+    """
+    blocks = np.asarray(mwa_qrs > mwa_beat, dtype=np.int8)
+    edges = np.diff(blocks)
+
+    # a block only counts once both of its edges have been seen
+    starts = np.flatnonzero(edges == 1)+1
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) > 0:
+        ends = ends[ends >= starts[0]]
+    starts = starts[:len(ends)]
+
+    long_blocks = ends-starts > int(0.08*fs)
+    starts = starts[long_blocks]
+    ends = ends[long_blocks]
+
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    block_max = np.maximum.reduceat(
+        filtered_ecg, np.column_stack((starts, ends+1)).ravel())[::2]
+
+    # the first sample of each block that reaches the block maximum
+    lengths = ends-starts+1
+    offsets = np.cumsum(lengths)-lengths
+    idx = np.arange(lengths.sum())+np.repeat(starts-offsets, lengths)
+    label = np.repeat(np.arange(len(starts)), lengths)
+    hits = np.flatnonzero(filtered_ecg[idx] == block_max[label])
+    first = np.ones(len(hits), dtype=bool)
+    first[1:] = label[hits[1:]] != label[hits[:-1]]
+    detections = idx[hits[first]]
+
+    refractory = int(0.3*fs)
+    QRS = []
+    for detection in detections.tolist():
+        if not QRS or detection-QRS[-1]>refractory:
+            QRS.append(detection)
+
+    return np.array(QRS, dtype=np.int64)
+
+
+def length_transform(x, w, fs):
+    """
+    Curve length of x over a sliding window of w samples along the first
+    axis, as used by the WQRS detector. The window sums come from one prefix sum of the
+    segment lengths, and the first w samples repeat the first full
+    window value.
+    """
+    segments = np.sqrt(np.power(1/fs, 2) + np.power(np.diff(x, axis=0), 2))
+    csum = np.cumsum(segments, axis=0)
+    csum = np.concatenate((np.zeros((1,)+csum.shape[1:]), csum))
+
+    # the window ending before sample i spans segments i-w to i-2
+    l = np.empty(np.shape(x))
+    l[w:] = csum[w-1:len(x)-1]-csum[:len(x)-w]
+    l[:w] = l[w]
+
+    return l
+
+
+def wqrsPeakDetect(x, fs):
+    """
+    Threshold stage of the WQRS detector: a beat is placed at the first
+    sample where x exceeds its 10 s moving average, at least 350 ms
+    after the previous beat. Only the samples above the moving average
+    are visited, each beat skipping its refractory period with a binary
+    search.
+    """
+    u = MWA_cumulative(x, 10*fs)
+    candidates = np.flatnonzero(x > u)
+    refractory = fs*0.35
+
+    # at most one beat per refractory period
+    peaks = np.empty(min(len(candidates), int(len(x)/refractory)+1), dtype=np.int64)
+    n_peaks = 0
+    k = 0
+    while k < len(candidates):
+        peaks[n_peaks] = candidates[k]
+        n_peaks += 1
+        k = np.searchsorted(candidates, candidates[k]+refractory, side='right')
+
+    return peaks[:n_peaks].copy()
+
+
+def panPeakDetect(detection, fs, jit=True):
+    """
+    Threshold and searchback stage of the Pan-Tompkins detector.
+
+    The local maxima of the detection signal and their amplitudes are
+    found in one vectorised pass and the SPKI/NPKI state machine only
+    visits them. The last nine signal peaks are kept in a ring buffer
+    for the RR average, and the searchback looks up the maxima between
+    the last two signal peaks as an index range of the maxima array.
+    With jit the compiled kernel of ecgjit is used if numba is
+    installed.
+    """
 
     min_distance = int(0.25*fs)
 
+    if jit and ecgjit is not None:
+        signal_peaks = ecgjit.pan_peak_detect(np.asarray(detection, dtype=float),
+                                              0.3*fs, min_distance)
+        return signal_peaks[1:].copy()
+
+    peaks = local_maxima(detection)
+    amplitudes = np.asarray(detection)[peaks]
+
     signal_peaks = [0]
-    noise_peaks = []
+    # the last nine signal peaks for the RR average
+    recent_peaks = deque([0], maxlen=9)
 
     SPKI = 0.0
     NPKI = 0.0
@@ -586,52 +1245,46 @@ def panPeakDetect(detection, fs):
     threshold_I2 = 0.0
 
     RR_missed = 0
-    index = 0
-    indexes = []
-
-    missed_peaks = []
-    peaks = []
-
-    for i in range(1,len(detection)-1):
-        if detection[i-1]<detection[i] and detection[i+1]<detection[i]:
-            peak = i
-            peaks.append(i)
-
-            if detection[peak]>threshold_I1 and (peak-signal_peaks[-1])>0.3*fs:
-                    
-                signal_peaks.append(peak)
-                indexes.append(index)
-                SPKI = 0.125*detection[signal_peaks[-1]] + 0.875*SPKI
-                if RR_missed!=0:
-                    if signal_peaks[-1]-signal_peaks[-2]>RR_missed:
-                        missed_section_peaks = peaks[indexes[-2]+1:indexes[-1]]
-                        missed_section_peaks2 = []
-                        for missed_peak in missed_section_peaks:
-                            if missed_peak-signal_peaks[-2]>min_distance and signal_peaks[-1]-missed_peak>min_distance and detection[missed_peak]>threshold_I2:
-                                missed_section_peaks2.append(missed_peak)
-
-                        if len(missed_section_peaks2)>0:
-                            signal_missed = [detection[i] for i in missed_section_peaks2]
-                            index_max = np.argmax(signal_missed)
-                            missed_peak = missed_section_peaks2[index_max]
-                            missed_peaks.append(missed_peak)
-                            signal_peaks.append(signal_peaks[-1])
-                            signal_peaks[-2] = missed_peak   
-
-            else:
-                noise_peaks.append(peak)
-                NPKI = 0.125*detection[noise_peaks[-1]] + 0.875*NPKI
-
-            threshold_I1 = NPKI + 0.25*(SPKI-NPKI)
-            threshold_I2 = 0.5*threshold_I1
-
-            if len(signal_peaks)>8:
-                RR = np.diff(signal_peaks[-9:])
-                RR_ave = int(np.mean(RR))
-                RR_missed = int(1.66*RR_ave)
-
-            index = index+1      
-    
-    signal_peaks.pop(0)
+    # position in peaks of the last accepted peak
+    last_index = None
+
+    for index, (peak, amplitude) in enumerate(zip(peaks.tolist(), amplitudes.tolist())):
+
+        if amplitude>threshold_I1 and (peak-signal_peaks[-1])>0.3*fs:
+
+            previous = signal_peaks[-1]
+            signal_peaks.append(peak)
+            recent_peaks.append(peak)
+            SPKI = 0.125*amplitude + 0.875*SPKI
+
+            if RR_missed!=0:
+                if peak-previous>RR_missed:
+                    # maxima between the last two accepted peaks that are
+                    # at least min_distance away from both
+                    section = peaks[last_index+1:index]
+                    lo = np.searchsorted(section, previous+min_distance, side='right')
+                    hi = np.searchsorted(section, peak-min_distance, side='left')
+                    missed_amplitudes = amplitudes[last_index+1+lo:last_index+1+hi]
+                    candidates = missed_amplitudes > threshold_I2
+
+                    if candidates.any():
+                        index_max = np.argmax(np.where(candidates, missed_amplitudes, -np.inf))
+                        missed_peak = int(section[lo+index_max])
+                        signal_peaks.insert(len(signal_peaks)-1, missed_peak)
+                        recent_peaks.pop()
+                        recent_peaks.append(missed_peak)
+                        recent_peaks.append(peak)
+
+            last_index = index
+
+        else:
+            NPKI = 0.125*amplitude + 0.875*NPKI
+
+        threshold_I1 = NPKI + 0.25*(SPKI-NPKI)
+        threshold_I2 = 0.5*threshold_I1
+
+        if len(signal_peaks)>8:
+            RR_ave = int((recent_peaks[-1]-recent_peaks[0])/8)
+            RR_missed = int(1.66*RR_ave)
 
-    return signal_peaks
+    return np.array(signal_peaks[1:], dtype=np.int64)
@@ -0,0 +1,187 @@
+"""
+Consensus heartbeat detection with several detectors of ecgdetectors.py.
+
+The detectors are described as a graph of the filtering stages of
+ecgdetectors.Detectors. Every stage is computed once per record, however
+many detectors use it, and each detector then runs its peak detection on
+its last stage. The beats of all detectors are fused by a vote:
+detections closer than a tolerance window are taken to be the same beat,
+and a beat is kept if enough detectors found it.
+
+By default the Hamilton detector reuses the 5-15 Hz bandpass and
+derivative of Pan-Tompkins instead of its own, nearly identical, 8-16 Hz
+first-order bandpass, which saves a filter pass. Its beats then move by
+a few tens of ms from those of Detectors.hamilton_detector, and the vote
+can differ by a beat; with shared_bandpass=False every detector gives
+exactly its own beats.
+
+General usage instructions:
+ensemble = DetectorEnsemble(sampling_frequency)
+r_peaks = ensemble.detect(ecg)
+where ecg is a single lead and r_peaks is an int array of sample
+indices. ensemble.detect_all(ecg) gives the beats of every detector.
+"""
+
+import numpy as np
+
+from ecgbatch import DETECTOR_STAGES, run_peak_detection, run_preprocessing
+from ecgdetectors import Detectors
+
+
+## A detection within this many seconds of another is the same beat
+TOLERANCE = 0.1
+
+
+class DetectorEnsemble:
+    """
+    Runs several detectors over shared filtering stages and fuses their
+    beats by a tolerance-window vote.
+    """
+
+    def __init__(self, sampling_frequency, detectors=None, tolerance=TOLERANCE,
+                 min_votes=None, shared_bandpass=True):
+        """
+        Args:
+            sampling_frequency: sampling rate in Hz of the ECG data.
+            detectors: descriptions of the detectors to run, all of
+                Detectors.get_detector_list() by default.
+            tolerance: maximum distance in s between detections of the
+                same beat.
+            min_votes: number of detectors that need to find a beat,
+                a majority by default.
+            shared_bandpass: let Hamilton reuse the Pan-Tompkins
+                bandpass and derivative, False for the exact beats of
+                every detector.
+        """
+
+        ## Sampling rate
+        self.fs = sampling_frequency
+
+        ## Detectors whose filter designs the stages share
+        self.detectors = Detectors(sampling_frequency)
+
+        if detectors is None:
+            detectors = [description for description, _ in self.detectors.get_detector_list()]
+        for description in detectors:
+            if description not in DETECTOR_STAGES:
+                raise RuntimeError('invalid detector!')
+
+        ## Descriptions of the detectors in the ensemble
+        self.detector_names = list(detectors)
+
+        ## Tolerance window of the vote in samples
+        self.tolerance = int(tolerance*sampling_frequency)
+
+        ## Votes needed for a beat
+        self.min_votes = len(detectors)//2+1 if min_votes is None else min_votes
+
+        ## Hamilton reuses the Pan-Tompkins bandpass and derivative
+        self.shared_bandpass = shared_bandpass
+
+    def stage_graph(self):
+        """
+        Returns the filtering stages as a dict of
+        name: (function, names of the input stages)
+        where "ecg" is the raw input. The stage named after a detector
+        description gives the signals its peak detection takes.
+        """
+        d = self.detectors
+        hamilton_derivative = "hamilton_derivative"
+        if self.shared_bandpass:
+            hamilton_derivative = "pan_tompkins_derivative"
+
+        graph = {
+            "pan_tompkins_derivative": (d.pan_tompkins_derivative, ("ecg",)),
+            "hamilton_derivative": (d.hamilton_derivative, ("ecg",)),
+            "Pan Tompkins": (d.pan_tompkins_integration, ("pan_tompkins_derivative",)),
+            "Hamilton": (d.hamilton_moving_average, (hamilton_derivative,)),
+        }
+
+        for description in DETECTOR_STAGES:
+            if description not in graph:
+                graph[description] = (self._preprocessing(description), ("ecg",))
+
+        return graph
+
+    def run_stages(self, ecg):
+        """
+        Computes the stages needed by the detectors of the ensemble, each
+        of them once, and returns them as a dict by stage name.
+        """
+        graph = self.stage_graph()
+        results = {"ecg": np.asarray(ecg, dtype=float)}
+
+        def run(name):
+            if name not in results:
+                function, inputs = graph[name]
+                results[name] = function(*[run(stage) for stage in inputs])
+            return results[name]
+
+        for description in self.detector_names:
+            run(description)
+
+        return results
+
+    def detect_all(self, ecg):
+        """
+        Returns the beats of every detector as a dict of int arrays by
+        detector description.
+        """
+        stages = self.run_stages(ecg)
+
+        r_peaks = {}
+        for description in self.detector_names:
+            r_peaks[description] = run_peak_detection(
+                self.detectors, description, stages[description])
+
+        return r_peaks
+
+    def detect(self, ecg):
+        """
+        Returns the fused beats of the ensemble as an int array of
+        sample indices.
+        """
+        r_peaks, _ = vote_peaks(list(self.detect_all(ecg).values()),
+                                self.tolerance, self.min_votes)
+
+        return r_peaks
+
+    def _preprocessing(self, description):
+        return lambda ecg: run_preprocessing(self.detectors, description, ecg)
+
+
+def vote_peaks(peak_lists, tolerance, min_votes):
+    """
+    Fuses the beats of several detectors.
+
+    All detections are merged into one sorted array, which is split
+    into groups wherever two consecutive detections are more than
+    tolerance samples apart. A group is a beat if detections of at
+    least min_votes different detectors fall into it, and the beat is
+    placed at the median detection of the group.
+
+    Returns the beats and the number of detectors that voted for each.
+    """
+    lengths = [len(peaks) for peaks in peak_lists]
+    if sum(lengths) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    peaks = np.concatenate([np.asarray(p, dtype=np.int64) for p in peak_lists])
+    voters = np.repeat(np.arange(len(peak_lists)), lengths)
+    order = np.argsort(peaks, kind='stable')
+    peaks = peaks[order]
+    voters = voters[order]
+
+    starts = np.flatnonzero(np.diff(peaks) > tolerance)+1
+    starts = np.concatenate(([0], starts))
+    counts = np.diff(np.concatenate((starts, [len(peaks)])))
+    group = np.repeat(np.arange(len(starts)), counts)
+
+    # count every detector once per group
+    group_voters = np.unique(group*len(peak_lists)+voters)
+    votes = np.bincount(group_voters//len(peak_lists), minlength=len(starts))
+
+    beats = peaks[starts+(counts-1)//2]
+    keep = votes >= min_votes
+
+    return beats[keep], votes[keep]
@@ -0,0 +1,526 @@
+"""
+Fetal heartbeat detection on multi-channel abdominal ECG recordings.
+
+The recordings are HDF5 files such as aecg_a13.hdf5, with the abdominal
+leads as a samples x channels dataset. Each recording is read one block
+at a time, extended by the warm-up and look-ahead of ecgchunked.py, and
+every block goes through three stages:
+1. the leads are fused into their first principal component, on which
+   the maternal QRS are detected with a detector of ecgdetectors.py,
+2. the maternal QRS are cancelled in all leads with mqrs_utils,
+3. the fetal QRS are detected on the first principal component of the
+   residual or, with fetal_lead "best" or "fused", on every channel of
+   the residual in parallel by detect_fetal_channels(), which keeps the
+   channel of the best signal quality or the vote of the good channels.
+The source separation of each window cannot be carried over to the next,
+so the maternal stage starts each window in the middle of a maternal RR
+interval and the beats of the blocks are joined by ecgchunked.Stitcher.
+The stages run in their own threads connected by short queues, so
+reading the next block and the linear algebra of the cancellation
+overlap, and only a few blocks are held in memory. A directory of
+recordings is spread over a pool of worker processes, one recording per
+worker.
+
+General usage instructions:
+result = process_record("aecg_a13.hdf5")
+gives the maternal and fetal R-peak sample indices as int arrays under
+"maternal" and "fetal", and
+results = process_directory("recordings/")
+does the same for every HDF5 file of a directory.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import pathlib
+except ImportError:
+    import pathlib2 as pathlib
+
+import h5py
+import numpy as np
+
+from ecgbatch import (DETECTOR_STAGES, lead_signals, run_peak_detection,
+                      run_preprocessing, shared_detectors)
+from ecgchunked import LOOK_AHEAD, WARM_UP, Stitcher
+from ecgdetectors import Detectors, R_PEAK_SEARCH, r_peak_search
+from ecgensemble import vote_peaks
+from mqrs_utils import mqrs_canceller
+
+
+## Dataset of the abdominal leads, as written by pandas for a DataFrame
+## stored under "signals"
+DATASET = "signals/block0_values"
+
+## Length in s of the part of the recording each block contributes
+## beats to
+BLOCK_DURATION = 30
+
+## Seconds read before the warm-up of each block, so that the window can
+## start in the middle of the maternal RR interval around it
+START_SLACK = 1
+
+## Detectors of the maternal and the fetal QRS, as listed by
+## Detectors.get_detector_list()
+MATERNAL_DETECTOR = "Pan Tompkins"
+FETAL_DETECTOR = "WQRS"
+
+## Lead of the residual the fetal QRS are taken from: "pca" for its first
+## principal component, "best" for the channel of the best
+## channel_quality(), "fused" for the vote of the good channels
+FETAL_LEADS = ("pca", "best", "fused")
+FETAL_LEAD = "pca"
+
+## Beats of two blocks closer than this many seconds are the same beat
+MATERNAL_REFRACTORY = 0.2
+FETAL_REFRACTORY = 0.15
+
+## Blocks waiting between two stages
+QUEUE_SIZE = 2
+
+## Range in s of the median RR interval of a plausible fetal heart rate,
+## 100 to 200 bpm
+FETAL_RR = (0.3, 0.6)
+
+## RR intervals less than this many seconds off the median of their
+## channel count as regular
+RR_TOLERANCE = 0.03
+
+## Kurtosis from which a residual channel counts as a clean ECG
+KURTOSIS_THRESHOLD = 5
+
+## Channels with at least this fraction of the quality of the best one
+## vote on the fused fetal beats
+QUALITY_FRACTION = 0.5
+
+## A detection within this many seconds of one of another channel is
+## the same beat
+VOTE_TOLERANCE = 0.1
+
+
+def read_blocks(dataset, fs, block_duration=BLOCK_DURATION, warm_up=WARM_UP,
+                look_ahead=LOOK_AHEAD):
+    """
+    Reads a samples x channels dataset one block at a time.
+
+    Yields (start, stop, offset, window) where the block covers the
+    samples start to stop and window holds the samples from offset on,
+    from START_SLACK s before the warm-up to the end of the look-ahead.
+    """
+    n = dataset.shape[0]
+    block = max(int(block_duration*fs), 1)
+    before = int((warm_up+START_SLACK)*fs)
+    look_ahead = int(look_ahead*fs)
+
+    for start in range(0, n, block):
+        stop = min(start+block, n)
+        offset = max(start-before, 0)
+        yield start, stop, offset, np.asarray(dataset[offset:min(stop+look_ahead, n)], dtype=float)
+
+
+def fuse_leads(x):
+    """
+    First principal component of the channels of x, with the sign that
+    makes its largest excursion positive.
+    """
+    x = x-x.mean(axis=0)
+    _, v = np.linalg.eigh(x.T @ x)
+    fused = x @ v[:, -1]
+    if fused.max() < -fused.min():
+        fused = -fused
+
+    return fused
+
+
+def channel_quality(residual, r_peaks, fs):
+    """
+    Signal quality index of every channel of a residual, from the
+    regularity of its beats and the kurtosis of its samples.
+
+    The regularity is the fraction of RR intervals less than
+    RR_TOLERANCE seconds off the median RR interval of the channel, and
+    is zero if that median is not a fetal one. It is scaled down by the
+    kurtosis of channels whose kurtosis is below KURTOSIS_THRESHOLD.
+    All channels are scored at once.
+
+    Args:
+        residual: samples x channels array.
+        r_peaks: the beats detected in each channel.
+        fs: sampling rate in Hz.
+
+    Returns:
+        A float array with the quality of each channel between 0 and 1.
+    """
+    # beats of all channels as rows padded with NaN
+    n_beats = np.array([len(peaks) for peaks in r_peaks])
+    beats = np.full((len(r_peaks), max(n_beats.max(initial=0), 1)), np.nan)
+    beats[np.arange(beats.shape[1]) < n_beats[:, None]] = np.concatenate(
+        [np.asarray(peaks, dtype=float) for peaks in r_peaks] + [np.zeros(0)])
+
+    rr = np.diff(beats, axis=1)/fs
+    n_rr = np.maximum(n_beats-1, 0)
+    quality = np.zeros(len(r_peaks))
+    scored = n_rr >= 2
+    if scored.any():
+        median = np.nanmedian(rr[scored], axis=1)
+        regular = np.abs(rr[scored]-median[:, None]) < RR_TOLERANCE
+        quality[scored] = np.where((median >= FETAL_RR[0]) & (median <= FETAL_RR[1]),
+                                   regular.sum(axis=1)/n_rr[scored], 0)
+
+    # excess kurtosis from the central moments, without the copies of
+    # scipy.stats.kurtosis
+    centred = residual-residual.mean(axis=0)
+    m2 = np.einsum('ij,ij->j', centred, centred)
+    centred *= centred
+    m4 = np.einsum('ij,ij->j', centred, centred)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kurtosis = len(residual)*m4/(m2*m2)-3
+    quality *= np.clip(np.nan_to_num(kurtosis)/KURTOSIS_THRESHOLD, 0, 1)
+
+    return quality
+
+
+def detect_fetal_channels(residual, detector, fs, executor=None):
+    """
+    Runs a detector on every channel of a residual, the channels in
+    parallel, and picks the beats of the channel with the best
+    channel_quality().
+
+    The filtering runs on all channels at once and the peak detection
+    of each channel is submitted to the executor. By default that is a
+    thread per channel, which runs the numba kernels of Pan-Tompkins,
+    Hamilton, Christov and Engzee in parallel. The pure Python peak
+    detections of WQRS and Two Average hold the GIL, and run in parallel
+    with a ProcessPoolExecutor only.
+
+    Args:
+        residual: samples x channels array, e.g. from
+            mqrs_utils.cancel_mqrs().
+        detector: description of the detector as listed by
+            Detectors.get_detector_list().
+        fs: sampling rate in Hz.
+        executor: a concurrent.futures executor.
+
+    Returns:
+        A dict with the beats of the best channel under "r_peaks", its
+        index under "channel", the quality of every channel under
+        "quality", the beats of every channel under "channels", and
+        under "fused" the beats that a majority of the channels with at
+        least QUALITY_FRACTION of the best quality found.
+    """
+    if detector not in DETECTOR_STAGES:
+        raise RuntimeError('invalid detector!')
+
+    residual = np.asarray(residual, dtype=float)
+    detectors = shared_detectors(fs)
+    signals = run_preprocessing(detectors, detector, residual)
+
+    n_channels = residual.shape[1]
+    channel_signals = [lead_signals(signals, channel) for channel in range(n_channels)]
+    del signals
+
+    args = ([detectors]*n_channels, [detector]*n_channels, channel_signals)
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=n_channels) as executor:
+            r_peaks = list(executor.map(run_peak_detection, *args))
+    else:
+        r_peaks = list(executor.map(run_peak_detection, *args))
+
+    quality = channel_quality(residual, r_peaks, fs)
+    best = int(np.argmax(quality))
+    voters = np.flatnonzero(quality >= QUALITY_FRACTION*quality[best])
+    if quality[best] > 0 and len(voters) > 1:
+        fused, _ = vote_peaks([r_peaks[channel] for channel in voters],
+                              int(VOTE_TOLERANCE*fs), len(voters)//2+1)
+    else:
+        fused = r_peaks[best]
+
+    return {
+        "r_peaks": r_peaks[best],
+        "channel": best,
+        "quality": quality,
+        "channels": r_peaks,
+        "fused": fused,
+    }
+
+
+class FetalPipeline:
+    """
+    Maternal QRS detection, maternal QRS cancellation and fetal QRS
+    detection of one recording, block by block.
+    """
+
+    def __init__(self, sampling_frequency, maternal_detector=MATERNAL_DETECTOR,
+                 fetal_detector=FETAL_DETECTOR, n_eigenvectors_to_keep=3,
+                 fetal_lead=FETAL_LEAD, warm_up=WARM_UP):
+        """
+        Args:
+            sampling_frequency: sampling rate in Hz.
+            maternal_detector, fetal_detector: descriptions of the
+                detectors as listed by Detectors.get_detector_list().
+            n_eigenvectors_to_keep: see mqrs_utils.cancel_mqrs().
+            fetal_lead: one of FETAL_LEADS.
+            warm_up: seconds of each window before its block, as read by
+                read_blocks().
+        """
+
+        ## Sampling rate
+        self.fs = sampling_frequency
+
+        detectors = dict(Detectors(sampling_frequency).get_detector_list())
+        if maternal_detector not in detectors or fetal_detector not in detectors:
+            raise RuntimeError('invalid detector!')
+        if fetal_lead not in FETAL_LEADS:
+            raise RuntimeError('invalid fetal lead!')
+
+        ## Detector of the maternal QRS on the fused leads
+        self.maternal_detector = detectors[maternal_detector]
+
+        ## Detector of the fetal QRS on the residual
+        self.fetal_detector = fetal_detector
+
+        ## Lead of the residual the fetal QRS are taken from
+        self.fetal_lead = fetal_lead
+
+        ## Detectors at the sampling rate
+        self.detectors = detectors
+
+        ## Maternal QRS canceller for the sampling rate
+        self.canceller = mqrs_canceller(sampling_frequency)
+
+        ## Eigenvectors of the maternal QRS templates
+        self.n_eigenvectors_to_keep = n_eigenvectors_to_keep
+
+        ## Seconds of each window before its block
+        self.warm_up = warm_up
+
+    def maternal_stage(self, window):
+        """
+        Detects the maternal QRS on the fused leads of a window and
+        cancels them. Returns the maternal R-peaks and the residual.
+        """
+        fused = fuse_leads(window)
+        mqrs = self.maternal_detector(fused)
+        mqrs = np.unique(r_peak_search(fused, mqrs, int(R_PEAK_SEARCH*self.fs)))
+
+        # only mQRS whose template window fits into the window
+        offsets = self.canceller.offsets
+        mqrs = mqrs[(mqrs+offsets[0] >= 0) & (mqrs+offsets[-1] < len(window))]
+        if len(mqrs) <= self.n_eigenvectors_to_keep:
+            return mqrs, window
+
+        residual, _ = self.canceller.cancel(window, mqrs, self.n_eigenvectors_to_keep)
+
+        return mqrs, residual
+
+    def fetal_stage(self, residual):
+        """
+        Detects the fetal QRS on the residual of a window.
+        """
+        if self.fetal_lead == "pca":
+            return np.asarray(self.detectors[self.fetal_detector](fuse_leads(residual)),
+                              dtype=np.int64)
+
+        channels = detect_fetal_channels(residual, self.fetal_detector, self.fs)
+        if self.fetal_lead == "best":
+            return channels["r_peaks"]
+
+        return channels["fused"]
+
+    def run(self, blocks):
+        """
+        Runs the stages over (start, stop, offset, window) blocks as
+        yielded by read_blocks(), each stage in its own thread.
+
+        Returns the maternal and the fetal R-peaks of the recording.
+        """
+        maternal_queue = queue.Queue(QUEUE_SIZE)
+        fetal_queue = queue.Queue(QUEUE_SIZE)
+        result_queue = queue.Queue(QUEUE_SIZE)
+
+        # the maternal stage sees the blocks in order, so it places each
+        # window from the maternal beats of the blocks before
+        maternal_peaks = Stitcher(int(MATERNAL_REFRACTORY*self.fs))
+        warm_up = int(self.warm_up*self.fs)
+
+        def maternal(block):
+            start, stop, offset, window = block
+            first = max(maternal_peaks.window_start(start-warm_up), offset)
+            mqrs, residual = self.maternal_stage(window[first-offset:])
+            maternal_peaks.add(mqrs+first, start, stop)
+            return start, stop, first, residual
+
+        def fetal(block):
+            start, stop, offset, residual = block
+            return start, stop, offset, self.fetal_stage(residual)
+
+        threads = [
+            threading.Thread(target=_produce, args=(blocks, maternal_queue), daemon=True),
+            threading.Thread(target=_consume, args=(maternal, maternal_queue, fetal_queue),
+                             daemon=True),
+            threading.Thread(target=_consume, args=(fetal, fetal_queue, result_queue),
+                             daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        fetal_peaks = Stitcher(int(FETAL_REFRACTORY*self.fs))
+        try:
+            for start, stop, offset, fqrs in _drain(result_queue):
+                fetal_peaks.add(fqrs+offset, start, stop)
+        finally:
+            # unblock the stages if the collection stopped early
+            for q in (maternal_queue, fetal_queue, result_queue):
+                _clear(q)
+
+        return maternal_peaks.peaks(), fetal_peaks.peaks()
+
+
+def process_record(path, dataset=DATASET, sampling_frequency=None,
+                   block_duration=BLOCK_DURATION, warm_up=WARM_UP,
+                   look_ahead=LOOK_AHEAD, **kwargs):
+    """
+    Detects the maternal and fetal QRS of one HDF5 recording.
+
+    Args:
+        path: HDF5 file of the recording.
+        dataset: samples x channels dataset of the abdominal leads.
+        sampling_frequency: sampling rate in Hz, by default the
+            sampling_frequency attribute of the file.
+        block_duration: seconds per block.
+        warm_up, look_ahead: seconds read before and after each block.
+        kwargs: further arguments of FetalPipeline.
+
+    Returns:
+        A dict with the path, the sampling rate, the number of samples
+        and the int arrays of the "maternal" and "fetal" R-peaks.
+    """
+    with h5py.File(path, "r") as f:
+        fs = sampling_frequency
+        if fs is None:
+            if "sampling_frequency" not in f.attrs:
+                raise RuntimeError('invalid sampling frequency!')
+            fs = f.attrs["sampling_frequency"].item()
+        if fs == int(fs):
+            fs = int(fs)
+        signals = f[dataset]
+        if signals.ndim != 2:
+            raise RuntimeError('invalid dataset!')
+
+        pipeline = FetalPipeline(fs, warm_up=warm_up, **kwargs)
+        maternal, fetal = pipeline.run(read_blocks(signals, fs, block_duration,
+                                                   warm_up, look_ahead))
+
+        return {
+            "path": str(path),
+            "sampling_frequency": fs,
+            "n_samples": signals.shape[0],
+            "maternal": maternal,
+            "fetal": fetal,
+        }
+
+
+def process_directory(directory, pattern="*.hdf5", processes=None, **kwargs):
+    """
+    Runs process_record() over every file of a directory matching the
+    pattern, one file per worker process.
+
+    Returns the results in the order of the sorted file names.
+    """
+    paths = sorted(pathlib.Path(directory).glob(pattern))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1 or len(paths) <= 1:
+        return [process_record(path, **kwargs) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=min(processes, len(paths))) as executor:
+        futures = [executor.submit(process_record, path, **kwargs) for path in paths]
+        return [future.result() for future in futures]
+
+
+## Marks the end of the blocks in a queue
+_END = object()
+
+
+class _Failure:
+    # an exception raised by a stage, passed on to the collecting thread
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _produce(items, outbox):
+    try:
+        for item in items:
+            outbox.put(item)
+    except Exception as e:
+        outbox.put(_Failure(e))
+        return
+    outbox.put(_END)
+
+
+def _consume(function, inbox, outbox):
+    for item in _drain(inbox, raise_failure=False):
+        if isinstance(item, _Failure):
+            outbox.put(item)
+            return
+        try:
+            outbox.put(function(item))
+        except Exception as e:
+            outbox.put(_Failure(e))
+            return
+    outbox.put(_END)
+
+
+def _drain(inbox, raise_failure=True):
+    while True:
+        item = inbox.get()
+        if item is _END:
+            return
+        if raise_failure and isinstance(item, _Failure):
+            raise item.exception
+        yield item
+        if isinstance(item, _Failure):
+            return
+
+
+def _clear(q):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("directory", help="directory of HDF5 recordings")
+    parser.add_argument("--pattern", default="*.hdf5")
+    parser.add_argument("--dataset", default=DATASET,
+                        help="samples x channels dataset of the abdominal leads")
+    parser.add_argument("--processes", type=int, help="all CPUs by default")
+    parser.add_argument("--maternal-detector", default=MATERNAL_DETECTOR)
+    parser.add_argument("--fetal-detector", default=FETAL_DETECTOR)
+    parser.add_argument("--fetal-lead", default=FETAL_LEAD, choices=FETAL_LEADS)
+    args = parser.parse_args()
+
+    results = process_directory(args.directory, args.pattern, args.processes,
+                                dataset=args.dataset,
+                                maternal_detector=args.maternal_detector,
+                                fetal_detector=args.fetal_detector,
+                                fetal_lead=args.fetal_lead)
+    for result in results:
+        result["maternal"] = result["maternal"].tolist()
+        result["fetal"] = result["fetal"].tolist()
+
+    json.dump(results, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main()
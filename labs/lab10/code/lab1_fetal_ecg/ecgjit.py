@@ -0,0 +1,539 @@
+"""
+Numba compiled versions of the sequential threshold stages in
+ecgdetectors.py: panPeakDetect, hamiltonPeakDetect, christovPeakDetect
+and engzeePeakDetect.
+
+Importing this module fails with an ImportError when numba is not
+installed, in which case ecgdetectors keeps using its pure Python
+loops. The kernels take the preprocessed detection signal plus the
+window lengths computed by the Python wrappers, and return the same
+detections as the pure Python code (including the placeholder first
+detection that the wrappers drop). Buffers are summed in the same order
+as the Python code so that every threshold is bit-identical. The
+kernels release the GIL, so several leads can be run in threads.
+
+christov_resume and engzee_resume run the Christov and Engzee loops on
+one chunk of a record and keep their state in small arrays between
+calls, for the streaming detectors of ecgstreaming.py. The batch kernels
+run them once over the whole record.
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True, nogil=True)
+def _buffer_mean(buffer, start, count):
+    """
+    Mean of the count oldest-first values of a ring buffer, summed like
+    short_mean in ecgdetectors.
+    """
+    size = len(buffer)
+    if count == 8:
+        v = np.empty(8)
+        for j in range(8):
+            v[j] = buffer[(start+j) % size]
+        return (((v[0]+v[1])+(v[2]+v[3]))+((v[4]+v[5])+(v[6]+v[7])))/8
+    total = 0.0
+    for j in range(count):
+        total += buffer[(start+j) % size]
+    return total/count
+
+
+@numba.njit(cache=True, nogil=True)
+def _block_sum(a, start, n):
+    """
+    Sum of at most 128 values as in the pairwise summation of np.sum:
+    eight interleaved partial sums, then the remainder in order.
+    """
+    if n < 8:
+        total = 0.0
+        for i in range(n):
+            total += a[start+i]
+        return total
+    r = np.empty(8)
+    for j in range(8):
+        r[j] = a[start+j]
+    i = 8
+    while i < n-n % 8:
+        for j in range(8):
+            r[j] += a[start+i+j]
+        i += 8
+    total = ((r[0]+r[1])+(r[2]+r[3]))+((r[4]+r[5])+(r[6]+r[7]))
+    while i < n:
+        total += a[start+i]
+        i += 1
+    return total
+
+
+@numba.njit(cache=True, nogil=True)
+def _pairwise_sum(a, start, n):
+    """
+    Sum of a[start:start+n] in the order of the pairwise summation of
+    np.sum, so that np.mean of a growing array is bit-identical. The
+    recursive halving of numpy is done with explicit stacks, since
+    numba does not cache recursive functions reliably.
+    """
+    # segments still to sum, a length of -1 adds the last two sums
+    starts = np.empty(256, dtype=np.int64)
+    lengths = np.empty(256, dtype=np.int64)
+    sums = np.empty(128)
+    n_tasks = 1
+    n_sums = 0
+    starts[0] = start
+    lengths[0] = n
+
+    while n_tasks > 0:
+        n_tasks -= 1
+        s = starts[n_tasks]
+        m = lengths[n_tasks]
+        if m < 0:
+            n_sums -= 1
+            sums[n_sums-1] = sums[n_sums-1]+sums[n_sums]
+        elif m <= 128:
+            sums[n_sums] = _block_sum(a, s, m)
+            n_sums += 1
+        else:
+            m2 = m//2
+            m2 -= m2 % 8
+            lengths[n_tasks] = -1
+            starts[n_tasks+1] = s+m2
+            lengths[n_tasks+1] = m-m2
+            starts[n_tasks+2] = s
+            lengths[n_tasks+2] = m2
+            n_tasks += 3
+
+    return sums[0]
+
+
+@numba.njit(cache=True, nogil=True)
+def local_maxima(x):
+    peaks = np.empty(max(len(x)//2+1, 1), dtype=np.int64)
+    n_peaks = 0
+    for i in range(1, len(x)-1):
+        if x[i-1] < x[i] and x[i+1] < x[i]:
+            peaks[n_peaks] = i
+            n_peaks += 1
+    return peaks[:n_peaks]
+
+
+@numba.njit(cache=True, nogil=True)
+def pan_peak_detect(detection, refractory, min_distance):
+    peaks = local_maxima(detection)
+
+    # signal_peaks[0] is the placeholder 0 of panPeakDetect
+    signal_peaks = np.zeros(len(peaks)+2, dtype=np.int64)
+    n_signal = 1
+    # position in peaks of every peak that passed threshold_I1
+    indexes = np.zeros(len(peaks)+1, dtype=np.int64)
+    n_indexes = 0
+
+    SPKI = 0.0
+    NPKI = 0.0
+    threshold_I1 = 0.0
+    threshold_I2 = 0.0
+    RR_missed = 0
+
+    for index in range(len(peaks)):
+        peak = peaks[index]
+
+        if detection[peak]>threshold_I1 and (peak-signal_peaks[n_signal-1])>refractory:
+
+            signal_peaks[n_signal] = peak
+            n_signal += 1
+            indexes[n_indexes] = index
+            n_indexes += 1
+            SPKI = 0.125*detection[peak] + 0.875*SPKI
+
+            if RR_missed!=0:
+                if signal_peaks[n_signal-1]-signal_peaks[n_signal-2]>RR_missed:
+                    missed_peak = -1
+                    for j in range(indexes[n_indexes-2]+1, indexes[n_indexes-1]):
+                        candidate = peaks[j]
+                        if candidate-signal_peaks[n_signal-2]>min_distance and signal_peaks[n_signal-1]-candidate>min_distance and detection[candidate]>threshold_I2:
+                            if missed_peak < 0 or detection[candidate]>detection[missed_peak]:
+                                missed_peak = candidate
+
+                    if missed_peak >= 0:
+                        signal_peaks[n_signal] = signal_peaks[n_signal-1]
+                        signal_peaks[n_signal-1] = missed_peak
+                        n_signal += 1
+
+        else:
+            NPKI = 0.125*detection[peak] + 0.875*NPKI
+
+        threshold_I1 = NPKI + 0.25*(SPKI-NPKI)
+        threshold_I2 = 0.5*threshold_I1
+
+        if n_signal>8:
+            RR_ave = int((signal_peaks[n_signal-1]-signal_peaks[n_signal-9])/8)
+            RR_missed = int(1.66*RR_ave)
+
+    return signal_peaks[:n_signal]
+
+
+@numba.njit(cache=True, nogil=True)
+def hamilton_peak_detect(detection, refractory, ms360):
+    peaks = local_maxima(detection)
+
+    n_pks = np.zeros(8)
+    n_pks_start = 0
+    n_pks_count = 0
+    n_pks_ave = 0.0
+    s_pks = np.empty(len(peaks))
+    s_pks_count = 0
+    s_pks_ave = 0.0
+    # QRS[0] is the placeholder 0 of hamiltonPeakDetect
+    QRS = np.zeros(len(peaks)+2, dtype=np.int64)
+    n_QRS = 1
+    RR = np.zeros(8, dtype=np.int64)
+    RR_start = 0
+    RR_count = 0
+    RR_ave = 0.0
+
+    th = 0.0
+    last_idx = 0
+
+    for k in range(len(peaks)):
+        peak = peaks[k]
+
+        if detection[peak] > th and (peak-QRS[n_QRS-1])>refractory:
+            QRS[n_QRS] = peak
+            n_QRS += 1
+            s_pks[s_pks_count] = detection[peak]
+            s_pks_count += 1
+            s_pks_ave = _pairwise_sum(s_pks, 0, s_pks_count)/s_pks_count
+
+            if RR_ave != 0.0:
+                if QRS[n_QRS-1]-QRS[n_QRS-2] > 1.5*RR_ave:
+                    # same sample-indexed searchback as hamiltonPeakDetect
+                    for j in range(last_idx+1, min(peak, k+1)):
+                        missed_peak = peaks[j]
+                        if missed_peak-peaks[last_idx]>ms360 and detection[missed_peak]>0.5*th:
+                            QRS[n_QRS] = QRS[n_QRS-1]
+                            QRS[n_QRS-1] = missed_peak
+                            n_QRS += 1
+                            break
+
+            if n_QRS>2:
+                if RR_count < 8:
+                    RR[(RR_start+RR_count) % 8] = QRS[n_QRS-1]-QRS[n_QRS-2]
+                    RR_count += 1
+                else:
+                    RR[RR_start] = QRS[n_QRS-1]-QRS[n_QRS-2]
+                    RR_start = (RR_start+1) % 8
+                RR_sum = 0
+                for j in range(RR_count):
+                    RR_sum += RR[j]
+                RR_ave = int(RR_sum/RR_count)
+
+            last_idx = peak
+
+        else:
+            if n_pks_count < 8:
+                n_pks[(n_pks_start+n_pks_count) % 8] = detection[peak]
+                n_pks_count += 1
+            else:
+                n_pks[n_pks_start] = detection[peak]
+                n_pks_start = (n_pks_start+1) % 8
+            n_pks_ave = _buffer_mean(n_pks, n_pks_start, n_pks_count)
+
+        th = n_pks_ave + 0.45*(s_pks_ave-n_pks_ave)
+
+    return QRS[:n_QRS]
+
+
+## Slots of the float and int state arrays that christov_resume carries
+## from one chunk to the next; the ring buffers MM and RR take the last 5
+## slots of each
+CF_M, CF_NEW_M5, CF_MM_AVE, CF_R, CF_SEG_MAX, CF_PREVIOUS, CF_MM = range(7)
+CI_MM_START, CI_MM_COUNT, CI_RR_START, CI_RR_COUNT, CI_RM, CI_R_START, \
+    CI_N_QRS, CI_LAST_QRS, CI_RR = range(9)
+
+## Slots of the float and int state arrays of engzee_resume, MM takes the
+## last 5 float slots
+EF_M, EF_MM_AVE, EF_NEW_M5, EF_SEG_MAX, EF_PREVIOUS, EF_MM = range(6)
+EI_MM_START, EI_MM_COUNT, EI_N_QRS, EI_LAST_QRS, EI_COUNTER, EI_THI, \
+    EI_THF = range(7)
+
+
+def christov_state():
+    """
+    Float and int state of christov_resume at the start of a record.
+    """
+    return np.zeros(CF_MM+5), np.zeros(CI_RR+5, dtype=np.int64)
+
+
+def engzee_state():
+    """
+    Float and int state of engzee_resume at the start of a record.
+    """
+    return np.zeros(EF_MM+5), np.zeros(EI_THF+1, dtype=np.int64)
+
+
+@numba.njit(cache=True, nogil=True)
+def christov_peak_detect(detection, M_learn, F, M_slope, ms200, ms1200):
+    fstate, istate = np.zeros(CF_MM+5), np.zeros(CI_RR+5, dtype=np.int64)
+    return christov_resume(detection, 0, M_learn, F, M_slope, ms200, ms1200,
+                           fstate, istate)
+
+
+@numba.njit(cache=True, nogil=True)
+def christov_resume(detection, offset, M_learn, F, M_slope, ms200, ms1200,
+                    fstate, istate):
+    """
+    Threshold loop of christovPeakDetect over the chunk detection, whose
+    first sample is sample offset of the record. M_learn and F cover the
+    same samples, M_learn only up to the end of the learning phase. The
+    loop state is read from and written back to fstate and istate, so
+    that consecutive chunks give the detections of the whole record.
+    """
+    n = len(detection)
+    n_learn = len(M_learn)
+
+    M = fstate[CF_M]
+    newM5 = fstate[CF_NEW_M5]
+    MM = fstate[CF_MM:CF_MM+5]
+    MM_start = istate[CI_MM_START]
+    MM_count = istate[CI_MM_COUNT]
+    MM_ave = fstate[CF_MM_AVE]
+    R = fstate[CF_R]
+    RR = istate[CI_RR:CI_RR+5]
+    RR_start = istate[CI_RR_START]
+    RR_count = istate[CI_RR_COUNT]
+    Rm = istate[CI_RM]
+    R_start = istate[CI_R_START]
+
+    QRS = np.zeros(n, dtype=np.int64)
+    n_chunk = 0
+    n_QRS = istate[CI_N_QRS]
+    last_qrs = istate[CI_LAST_QRS]
+    seg_max = fstate[CF_SEG_MAX]
+    previous = fstate[CF_PREVIOUS]
+
+    for j in range(n):
+        i = offset+j
+
+        # M
+        if j < n_learn:
+            M = M_learn[j]
+            if MM_count < 5:
+                MM[(MM_start+MM_count) % 5] = M
+                MM_count += 1
+            else:
+                MM[MM_start] = M
+                MM_start = (MM_start+1) % 5
+            MM_ave = _buffer_mean(MM, MM_start, MM_count)
+
+        elif n_QRS > 0 and i < last_qrs+ms200:
+            if previous > seg_max:
+                seg_max = previous
+            newM5 = 0.6*seg_max
+            last_MM = MM[(MM_start+MM_count-1) % 5]
+            if newM5>1.5*last_MM:
+                newM5 = 1.1*last_MM
+
+        elif n_QRS > 0 and i == last_qrs+ms200:
+            if newM5==0:
+                newM5 = MM[(MM_start+MM_count-1) % 5]
+            if MM_count < 5:
+                MM[(MM_start+MM_count) % 5] = newM5
+                MM_count += 1
+            else:
+                MM[MM_start] = newM5
+                MM_start = (MM_start+1) % 5
+            MM_ave = _buffer_mean(MM, MM_start, MM_count)
+            M = MM_ave
+
+        elif n_QRS > 0 and i > last_qrs+ms200 and i < last_qrs+ms1200:
+            M = MM_ave*M_slope[i-(last_qrs+ms200)]
+
+        elif n_QRS > 0 and i > last_qrs+ms1200:
+            M = 0.6*MM_ave
+
+        # seg_max covers detection[last_qrs:i] once i is past the learning
+        # phase; catch up on the samples seen while still learning
+        if j < n_learn and n_QRS > 0 and i > last_qrs:
+            if previous > seg_max:
+                seg_max = previous
+
+        # R
+        if n_QRS > 0 and i < last_qrs+R_start:
+            R = 0.0
+
+        elif n_QRS > 0 and i > last_qrs+R_start and i < last_qrs+Rm:
+            R = (M-MM_ave)/1.4
+
+        MFR = M+F[j]+R
+
+        if (n_QRS == 0 or i > last_qrs+ms200) and detection[j]>MFR:
+            QRS[n_chunk] = i
+            n_chunk += 1
+            n_QRS += 1
+            if n_QRS>2:
+                if RR_count < 5:
+                    RR[(RR_start+RR_count) % 5] = i-last_qrs
+                    RR_count += 1
+                else:
+                    RR[RR_start] = i-last_qrs
+                    RR_start = (RR_start+1) % 5
+                RR_sum = 0
+                for k in range(RR_count):
+                    RR_sum += RR[k]
+                Rm = int(RR_sum/RR_count)
+                R_start = int((2.0/3.0*Rm))
+            last_qrs = i
+            seg_max = detection[j]
+
+        previous = detection[j]
+
+    fstate[CF_M] = M
+    fstate[CF_NEW_M5] = newM5
+    fstate[CF_MM_AVE] = MM_ave
+    fstate[CF_R] = R
+    fstate[CF_SEG_MAX] = seg_max
+    fstate[CF_PREVIOUS] = previous
+    istate[CI_MM_START] = MM_start
+    istate[CI_MM_COUNT] = MM_count
+    istate[CI_RR_START] = RR_start
+    istate[CI_RR_COUNT] = RR_count
+    istate[CI_RM] = Rm
+    istate[CI_R_START] = R_start
+    istate[CI_N_QRS] = n_QRS
+    istate[CI_LAST_QRS] = last_qrs
+
+    return QRS[:n_chunk]
+
+
+@numba.njit(cache=True, nogil=True)
+def engzee_peak_detect(low_pass, unfiltered_ecg, M_learn, M_slope, ms200,
+                       ms1200, ms160, ms10, neg_threshold):
+    fstate, istate = np.zeros(EF_MM+5), np.zeros(EI_THF+1, dtype=np.int64)
+    return engzee_resume(low_pass, 0, unfiltered_ecg, 0, M_learn, M_slope,
+                         ms200, ms1200, ms160, ms10, neg_threshold,
+                         fstate, istate)
+
+
+@numba.njit(cache=True, nogil=True)
+def engzee_resume(low_pass, offset, unfiltered_ecg, ecg_offset, M_learn,
+                  M_slope, ms200, ms1200, ms160, ms10, neg_threshold,
+                  fstate, istate):
+    """
+    Threshold loop of engzeePeakDetect over the chunk low_pass, whose
+    first sample is sample offset of the record. unfiltered_ecg starts
+    at sample ecg_offset and must reach back 10 ms before the last QRS.
+    The loop state is read from and written back to fstate and istate
+    like in christov_resume.
+    """
+    n = len(low_pass)
+    n_learn = len(M_learn)
+
+    M = fstate[EF_M]
+    MM = fstate[EF_MM:EF_MM+5]
+    MM_start = istate[EI_MM_START]
+    MM_count = istate[EI_MM_COUNT]
+    MM_ave = fstate[EF_MM_AVE]
+    newM5 = fstate[EF_NEW_M5]
+
+    n_QRS = istate[EI_N_QRS]
+    last_qrs = istate[EI_LAST_QRS]
+    seg_max = fstate[EF_SEG_MAX]
+    previous = fstate[EF_PREVIOUS]
+
+    r_peaks = np.zeros(n, dtype=np.int64)
+    n_r_peaks = 0
+
+    counter = istate[EI_COUNTER]
+    thi = istate[EI_THI] != 0
+    thf = istate[EI_THF] != 0
+
+    for j in range(n):
+        i = offset+j
+
+        # M
+        if j < n_learn:
+            M = M_learn[j]
+            if MM_count < 5:
+                MM[(MM_start+MM_count) % 5] = M
+                MM_count += 1
+            else:
+                MM[MM_start] = M
+                MM_start = (MM_start+1) % 5
+            MM_ave = _buffer_mean(MM, MM_start, MM_count)
+            if n_QRS > 0 and i > last_qrs:
+                if previous > seg_max:
+                    seg_max = previous
+
+        elif n_QRS > 0 and i < last_qrs+ms200:
+            if previous > seg_max:
+                seg_max = previous
+            newM5 = 0.6*seg_max
+            last_MM = MM[(MM_start+MM_count-1) % 5]
+            if newM5>1.5*last_MM:
+                newM5 = 1.1*last_MM
+
+        elif newM5 != 0 and n_QRS > 0 and i == last_qrs+ms200:
+            if MM_count < 5:
+                MM[(MM_start+MM_count) % 5] = newM5
+                MM_count += 1
+            else:
+                MM[MM_start] = newM5
+                MM_start = (MM_start+1) % 5
+            MM_ave = _buffer_mean(MM, MM_start, MM_count)
+            M = MM_ave
+
+        elif n_QRS > 0 and i > last_qrs+ms200 and i < last_qrs+ms1200:
+            M = MM_ave*M_slope[i-(last_qrs+ms200)]
+
+        elif n_QRS > 0 and i > last_qrs+ms1200:
+            M = 0.6*MM_ave
+
+        if (n_QRS == 0 or i > last_qrs+ms200) and low_pass[j]>M:
+            n_QRS += 1
+            last_qrs = i
+            seg_max = low_pass[j]
+            thi = True
+
+        if thi and i<last_qrs+ms160:
+            if low_pass[j]<-M and previous>-M:
+                thf = True
+
+            if thf and low_pass[j]<-M:
+                counter += 1
+
+            elif low_pass[j]>-M and thf:
+                counter = 0
+                thi = False
+                thf = False
+
+        elif thi and i>last_qrs+ms160:
+            counter = 0
+            thi = False
+            thf = False
+
+        if counter>neg_threshold:
+            start = last_qrs-ms10-ecg_offset
+            if start < 0:
+                start += len(unfiltered_ecg)
+            r_peaks[n_r_peaks] = np.argmax(unfiltered_ecg[start:i-ecg_offset])+last_qrs-ms10
+            n_r_peaks += 1
+            counter = 0
+            thi = False
+            thf = False
+
+        previous = low_pass[j]
+
+    fstate[EF_M] = M
+    fstate[EF_MM_AVE] = MM_ave
+    fstate[EF_NEW_M5] = newM5
+    fstate[EF_SEG_MAX] = seg_max
+    fstate[EF_PREVIOUS] = previous
+    istate[EI_MM_START] = MM_start
+    istate[EI_MM_COUNT] = MM_count
+    istate[EI_N_QRS] = n_QRS
+    istate[EI_LAST_QRS] = last_qrs
+    istate[EI_COUNTER] = counter
+    istate[EI_THI] = 1 if thi else 0
+    istate[EI_THF] = 1 if thf else 0
+
+    return r_peaks[:n_r_peaks]
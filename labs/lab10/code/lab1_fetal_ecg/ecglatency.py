@@ -0,0 +1,163 @@
+"""
+Detection latency of the heartbeat detectors in ecgdetectors.py.
+
+A detector used for alarms has to confirm each beat soon after its
+R-peak. Here a record is replayed chunk by chunk as if it arrived in
+real time, and for every beat the sample at which its detection became
+final is recorded. The streaming detectors of ecgstreaming.py, which
+find the same beats as the detectors run on the whole record, are fed
+the chunks directly and a beat is final when they return it.
+
+The latency of a beat is the time from its R-peak, the largest sample
+of the unfiltered ECG near the detection, to the sample at which it
+became final, and is resolved to one chunk.
+
+General usage instructions:
+report = latency_report(ecg, sampling_frequency)
+gives the latency distribution of every detector as a JSON-serialisable
+dict, and replay(ecg, "Pan Tompkins", sampling_frequency) the latency of
+each beat as an array of LATENCY_DTYPE records.
+"""
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from ecgdetectors import Detectors, R_PEAK_SEARCH, r_peak_search
+from ecgstreaming import DETECTOR_STREAMS
+
+## Seconds of ECG received at a time
+STEP = 0.05
+
+## End-to-end latency budget in s of the alarm pipeline
+BUDGET = 0.2
+
+## Percentiles of the latency reported per detector
+PERCENTILES = (50, 90, 95, 99)
+
+## Record of one beat: its sample index as reported by the detector, the
+## sample index of the R-peak, the number of samples received when the
+## detection became final and the latency in s from R-peak to decision
+LATENCY_DTYPE = np.dtype([("index", np.int64), ("r_peak", np.int64),
+                          ("decision", np.int64), ("latency", np.float64)])
+
+
+def replay(ecg, detector, sampling_frequency, step=STEP):
+    """
+    Replays a single lead ECG through a detector step seconds at a time.
+
+    Returns an array of LATENCY_DTYPE records, one per beat that the
+    detector reports for the complete record.
+    """
+    ecg = np.asarray(ecg, dtype=float)
+    fs = sampling_frequency
+    step = max(int(step*fs), 1)
+
+    if detector not in DETECTOR_STREAMS:
+        raise RuntimeError('invalid detector!')
+    index, decision = _replay_stream(DETECTOR_STREAMS[detector](fs), ecg, step)
+
+    beats = np.zeros(len(index), dtype=LATENCY_DTYPE)
+    beats["index"] = index
+    beats["decision"] = decision
+    beats["r_peak"] = r_peak_search(ecg, index, int(R_PEAK_SEARCH*fs))
+    beats["latency"] = (beats["decision"]-beats["r_peak"])/fs
+
+    return beats
+
+
+def _replay_stream(stream, ecg, step):
+    index = []
+    decision = []
+    for start in range(0, len(ecg), step):
+        stop = min(start+step, len(ecg))
+        beats = stream.process(ecg[start:stop])
+        index += beats
+        decision += [stop]*len(beats)
+
+    index = np.array(index, dtype=np.int64)
+    order = np.argsort(index, kind='stable')
+
+    return index[order], np.array(decision, dtype=np.int64)[order]
+
+
+def latency_summary(beats, budget=BUDGET):
+    """
+    Distribution of the latencies of the records returned by replay():
+    the number of beats, the mean, percentiles and maximum latency in s
+    and the fraction of beats final within budget seconds.
+    """
+    latency = beats["latency"]
+    summary = {"n_beats": len(beats), "mean": None, "max": None,
+               "within_budget": None}
+    for q in PERCENTILES:
+        summary["p%d" % q] = None
+    if len(beats) == 0:
+        return summary
+
+    summary["mean"] = float(np.mean(latency))
+    summary["max"] = float(np.max(latency))
+    summary["within_budget"] = float(np.mean(latency <= budget))
+    for q, value in zip(PERCENTILES, np.percentile(latency, PERCENTILES)):
+        summary["p%d" % q] = float(value)
+
+    return summary
+
+
+def latency_report(ecg, sampling_frequency, detectors=None, step=STEP,
+                   budget=BUDGET):
+    """
+    Replays the ECG through several detectors.
+
+    Args:
+        ecg: a single lead.
+        sampling_frequency: sampling rate in Hz.
+        detectors: descriptions of the detectors to replay, all of
+            Detectors.get_detector_list() by default.
+        step: seconds of ECG received at a time.
+        budget: latency budget in s.
+
+    Returns:
+        A dict with the settings and, under "detectors", the
+        latency_summary() of each detector by description.
+    """
+    if detectors is None:
+        detectors = [description for description, _ in Detectors().get_detector_list()]
+
+    return {
+        "sampling_frequency": sampling_frequency,
+        "duration": len(ecg)/sampling_frequency,
+        "step": step,
+        "budget": budget,
+        "detectors": {description: latency_summary(
+            replay(ecg, description, sampling_frequency, step), budget)
+            for description in detectors},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("record", help="text file with one ECG sample per line")
+    parser.add_argument("sampling_frequency", type=float, help="in Hz")
+    parser.add_argument("--detectors", nargs="+",
+                        help="detector descriptions, all by default")
+    parser.add_argument("--step", type=float, default=STEP,
+                        help="seconds of ECG received at a time")
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="latency budget in s")
+    args = parser.parse_args()
+
+    fs = args.sampling_frequency
+    if fs == int(fs):
+        fs = int(fs)
+    report = latency_report(np.genfromtxt(args.record), fs, args.detectors,
+                            args.step, args.budget)
+
+    json.dump(report, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main()
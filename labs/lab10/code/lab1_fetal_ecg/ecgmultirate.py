@@ -0,0 +1,145 @@
+"""
+Heartbeat detection at a reduced internal sampling rate.
+
+The bandpasses of the detectors in ecgdetectors.py keep nothing above
+about 20 Hz, yet ECG recorders often sample at 1 or 2 kHz, so most of
+the filtering work is spent on samples that carry no information for
+the detectors. Here the record is first decimated by a polyphase
+filter (scipy.signal.resample_poly) to an internal rate of about
+250 Hz, the detector runs at that rate, and each beat is then moved
+back to the original rate and refined to the maximum of the raw signal
+around it. The refinement gives the same beat as refining the beats of
+a detector running at the full rate, because both end up on the same
+local maximum of the raw ECG.
+
+General usage instructions:
+r_peaks = detect_multirate(ecg, "Pan Tompkins", sampling_frequency)
+where the detector is a description from Detectors.get_detector_list()
+and r_peaks is an int array of sample indices of the original record,
+or a list of them for a samples x leads record.
+"""
+
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+import scipy.signal as signal
+
+from ecgbatch import (DETECTOR_STAGES, run_peak_detection, run_preprocessing,
+                      shared_detectors)
+from ecgdetectors import r_peak_search
+
+
+## Sampling rate in Hz at which the detectors run
+INTERNAL_FREQUENCY = 250
+
+## Largest up or down factor of the polyphase resampler; the internal
+## rate is rounded so that the factors stay below it
+MAX_RESAMPLING_FACTOR = 100
+
+## Half length of the anti-aliasing filter in samples of the slower of
+## the two rates. The detectors keep nothing above about 20 Hz, so a
+## much shorter filter than the default of resample_poly will do.
+ANTI_ALIAS_HALF_LENGTH = 4
+
+## Seconds searched on either side of a beat for the maximum of the raw
+## signal, more than the delay of the detectors' fiducial points
+SEARCH_RADIUS = 0.15
+
+
+def detect_multirate(ecg, detector, sampling_frequency,
+                     internal_frequency=INTERNAL_FREQUENCY,
+                     search_radius=SEARCH_RADIUS):
+    """
+    Runs a detector on a decimated copy of the ECG and refines its
+    beats on the original one.
+
+    Args:
+        ecg: a single lead or an array of samples x leads.
+        detector: description of the detector as listed by
+            Detectors.get_detector_list().
+        sampling_frequency: sampling rate in Hz of the ECG.
+        internal_frequency: sampling rate in Hz for the detection. A
+            record sampled at this rate or below is not decimated.
+        search_radius: seconds searched on either side of each beat for
+            the maximum of the raw signal.
+
+    Returns:
+        An int array of R-peak sample indices for a single lead, or a
+        list of them, one per lead.
+    """
+    if detector not in DETECTOR_STAGES:
+        raise RuntimeError('invalid detector!')
+
+    ecg = np.asarray(ecg, dtype=float)
+    up, down = resampling_factors(sampling_frequency, internal_frequency)
+    if up < down:
+        decimated = signal.resample_poly(ecg, up, down, axis=0,
+                                         window=anti_alias_filter(up, down))
+    else:
+        up = down = 1
+        decimated = ecg
+    fs = sampling_frequency*up/down
+    if fs == int(fs):
+        fs = int(fs)
+
+    detectors = shared_detectors(fs)
+    signals = run_preprocessing(detectors, detector, decimated)
+    del decimated
+
+    radius = int(search_radius*sampling_frequency)
+    single_lead = ecg.ndim == 1
+    n_leads = 1 if single_lead else ecg.shape[1]
+
+    r_peaks = []
+    for lead in range(n_leads):
+        if single_lead:
+            peaks = run_peak_detection(detectors, detector, signals)
+            lead_ecg = ecg
+        else:
+            peaks = run_peak_detection(detectors, detector, signals, lead)
+            lead_ecg = ecg[:, lead]
+
+        # sample k of resample_poly lies at k*down/up of its input
+        peaks = np.rint(peaks*down/up).astype(np.int64)
+        r_peaks.append(refine_peaks(lead_ecg, peaks, radius))
+
+    if single_lead:
+        return r_peaks[0]
+
+    return r_peaks
+
+
+def resampling_factors(sampling_frequency, internal_frequency):
+    """
+    Up and down factors of the polyphase resampler that take the
+    sampling rate closest to internal_frequency.
+    """
+    ratio = Fraction(internal_frequency/sampling_frequency).limit_denominator(MAX_RESAMPLING_FACTOR)
+    if ratio == 0:
+        ratio = Fraction(1, MAX_RESAMPLING_FACTOR)
+
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache
+def anti_alias_filter(up, down):
+    """
+    Lowpass FIR filter of the polyphase resampler, cut off at the
+    Nyquist frequency of the slower rate.
+    """
+    factor = max(up, down)
+    h = signal.firwin(2*ANTI_ALIAS_HALF_LENGTH*factor+1, 1/factor,
+                      window=('kaiser', 5.0))
+    h.flags.writeable = False
+
+    return h
+
+
+def refine_peaks(ecg, r_peaks, radius):
+    """
+    Moves every beat to the largest sample of the ECG less than radius
+    samples away, for all beats at once, and returns the sorted unique
+    beats.
+    """
+    return np.unique(r_peak_search(ecg, r_peaks, radius))
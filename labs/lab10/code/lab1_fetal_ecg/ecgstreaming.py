@@ -0,0 +1,941 @@
+"""
+Streaming counterparts of the heartbeat detectors in ecgdetectors.py.
+
+The methods of ecgdetectors.Detectors need the whole record. The
+detectors here take the ECG in chunks of any size. They carry the
+filter, moving window average and threshold state from one chunk to the
+next and return each beat as soon as it is confirmed. Feeding a record
+chunk by chunk gives exactly the beats of the batch detector.
+
+General usage instructions:
+stream = PanTompkinsStream(sampling_frequency)
+for chunk in chunks:
+    r_peaks = stream.process(chunk)
+The returned r_peaks are sample indices counted from the start of the
+stream. DETECTOR_STREAMS maps the descriptions of
+Detectors.get_detector_list() to the stream classes.
+"""
+
+from collections import deque
+
+import numpy as np
+import scipy.ndimage as ndimage
+import scipy.signal as signal
+
+from ecgdetectors import (design_filter, ecgjit, local_maxima, short_mean,
+                          threshold_slope)
+
+
+class _FIRFilter:
+    """
+    lfilter with an FIR kernel b, continued across chunks. lfilter
+    evaluates FIR filters with np.convolve, so the same windows are
+    convolved here from the last len(b)-1 inputs and the chunk.
+    """
+
+    def __init__(self, b):
+        self._b = np.asarray(b, dtype=float)
+        self._tail = np.zeros(len(self._b)-1)
+
+    def process(self, x):
+        if len(x) == 0:
+            return np.zeros(0)
+
+        extended = np.concatenate((self._tail, x))
+        self._tail = extended[len(extended)-len(self._tail):]
+
+        return np.convolve(extended, self._b, 'valid')
+
+
+class _CumulativeMWA:
+    """
+    MWA_cumulative continued across chunks. The cumulative sum runs on
+    from the previous chunk and its last window_size values are kept to
+    close the windows, so the arithmetic is that of the whole record.
+    """
+
+    def __init__(self, window_size):
+        self._N = window_size
+        self._n = 0
+        self._csum = 0.0
+        self._tail = np.zeros(0)
+
+    def process(self, x):
+        if len(x) == 0:
+            return np.zeros(0)
+
+        csum = np.cumsum(np.concatenate(([self._csum], x)))[1:]
+        self._csum = csum[-1]
+        extended = np.concatenate((self._tail, csum))
+        self._tail = extended[-self._N:]
+
+        # global sample index k and position of k in extended
+        k = self._n+np.arange(len(csum))
+        position = len(extended)-len(csum)+np.arange(len(csum))
+        self._n += len(x)
+
+        mwa = csum.copy()
+        full = k >= self._N
+        mwa[full] = csum[full]-extended[position[full]-self._N]
+        warm_up = k < self._N-1
+        mwa[warm_up] = mwa[warm_up]/(k[warm_up]+1)
+        mwa[~warm_up] = mwa[~warm_up]/self._N
+
+        return mwa
+
+
+class DetectorStream:
+    """
+    Chunk bookkeeping shared by the streaming detectors. Subclasses turn
+    the ECG into their detection signal with _detection_signal() and
+    run their threshold logic on its local maxima in _on_peak(), or on
+    every sample by overriding _threshold().
+    """
+
+    def __init__(self, sampling_frequency):
+        """
+        The constructor takes the sampling rate in Hz of the ECG data.
+        """
+
+        ## Sampling rate
+        self.fs = sampling_frequency
+
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all state so that the next chunk starts a new record.
+        """
+
+        ## Number of ECG samples received so far
+        self.n_samples = 0
+
+        ## Number of detection signal samples produced so far
+        self.n_detection = 0
+
+        ## Last two detection samples, needed to find maxima across chunks
+        self._tail = np.zeros(0)
+
+    def process(self, chunk):
+        """
+        Feeds the next chunk of the ECG and returns the list of beats
+        confirmed by it.
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        beats = []
+        if len(chunk) == 0:
+            return beats
+
+        detection = self._detection_signal(chunk)
+        self.n_samples += len(chunk)
+
+        if len(detection) > 0:
+            self._threshold(detection, beats)
+        self.n_detection += len(detection)
+
+        return beats
+
+    def _detection_signal(self, chunk):
+        raise NotImplementedError
+
+    def _threshold(self, detection, beats):
+        """
+        Runs the threshold logic on the next detection samples, the
+        first of which is sample n_detection.
+        """
+        extended = np.concatenate((self._tail, detection))
+        offset = self.n_detection-len(self._tail)
+        self._tail = extended[-2:]
+
+        peaks = local_maxima(extended)
+        for peak, amplitude in zip((peaks+offset).tolist(),
+                                   extended[peaks].tolist()):
+            self._on_peak(peak, amplitude, beats)
+
+    def _on_peak(self, peak, amplitude, beats):
+        raise NotImplementedError
+
+
+class PanTompkinsStream(DetectorStream):
+    """
+    Streaming version of Detectors.pan_tompkins_detector, including the
+    searchback of panPeakDetect. Only the 'cumulative' moving window
+    average is supported.
+    """
+
+    def __init__(self, sampling_frequency, MWA_name='cumulative'):
+        if MWA_name != 'cumulative':
+            raise RuntimeError('streaming only supports the cumulative moving average!')
+
+        maxQRSduration = 0.150 #sec
+
+        self._sos = design_filter("pan_tompkins_sos", sampling_frequency)
+        self._N = int(maxQRSduration*sampling_frequency)
+        self._blanking = int(maxQRSduration*sampling_frequency*2)
+        self._min_distance = int(0.25*sampling_frequency)
+
+        DetectorStream.__init__(self, sampling_frequency)
+
+    def reset(self):
+        DetectorStream.reset(self)
+
+        # filter and derivative state
+        self._zi = np.zeros((len(self._sos), 2))
+        self._last_filtered = None
+
+        # moving window average of the squared derivative
+        self._mwa = _CumulativeMWA(self._N)
+
+        # threshold state of panPeakDetect
+        self.SPKI = 0.0
+        self.NPKI = 0.0
+        self.threshold_I1 = 0.0
+        self.threshold_I2 = 0.0
+        self.RR_missed = 0
+        self._signal_peaks = deque([0], maxlen=9)
+        self._n_signal_peaks = 1
+        # noise peaks since the last signal peak, for the searchback
+        self._since_signal = []
+
+    def _detection_signal(self, chunk):
+        filtered, self._zi = signal.sosfilt(self._sos, chunk, zi=self._zi)
+
+        if self._last_filtered is not None:
+            filtered = np.concatenate(([self._last_filtered], filtered))
+        self._last_filtered = filtered[-1]
+
+        diff = np.diff(filtered)
+        squared = diff*diff
+
+        mwa = self._mwa.process(squared)
+        mwa[:max(0, self._blanking-self.n_detection)] = 0
+
+        return mwa
+
+    def _on_peak(self, peak, amplitude, beats):
+        fs = self.fs
+        signal_peaks = self._signal_peaks
+
+        if amplitude>self.threshold_I1 and (peak-signal_peaks[-1])>0.3*fs:
+
+            previous = signal_peaks[-1]
+            signal_peaks.append(peak)
+            self._n_signal_peaks += 1
+            self.SPKI = 0.125*amplitude + 0.875*self.SPKI
+
+            if self.RR_missed!=0:
+                if peak-previous>self.RR_missed:
+                    missed = None
+                    for missed_peak, missed_amplitude in self._since_signal:
+                        if missed_peak-previous>self._min_distance and peak-missed_peak>self._min_distance and missed_amplitude>self.threshold_I2:
+                            if missed is None or missed_amplitude>missed[1]:
+                                missed = (missed_peak, missed_amplitude)
+
+                    if missed is not None:
+                        signal_peaks.pop()
+                        signal_peaks.append(missed[0])
+                        signal_peaks.append(peak)
+                        self._n_signal_peaks += 1
+                        beats.append(missed[0])
+
+            beats.append(peak)
+            self._since_signal = []
+
+        else:
+            self._since_signal.append((peak, amplitude))
+            self.NPKI = 0.125*amplitude + 0.875*self.NPKI
+
+        self.threshold_I1 = self.NPKI + 0.25*(self.SPKI-self.NPKI)
+        self.threshold_I2 = 0.5*self.threshold_I1
+
+        if self._n_signal_peaks>8:
+            RR_ave = int((signal_peaks[-1]-signal_peaks[0])/8)
+            self.RR_missed = int(1.66*RR_ave)
+
+
+class HamiltonStream(DetectorStream):
+    """
+    Streaming version of Detectors.hamilton_detector.
+    """
+
+    def __init__(self, sampling_frequency):
+        self._sos = design_filter("hamilton_sos", sampling_frequency)
+        self._box = design_filter("hamilton_ma", sampling_frequency)
+        self._blanking = len(self._box)*2
+        self._ms360 = int(0.360*sampling_frequency)
+
+        DetectorStream.__init__(self, sampling_frequency)
+
+    def reset(self):
+        DetectorStream.reset(self)
+
+        # filter, derivative and moving average state
+        self._zi = np.zeros((len(self._sos), 2))
+        self._last_filtered = None
+        self._ma = _FIRFilter(self._box)
+
+        # threshold state of hamiltonPeakDetect
+        self._n_pks = deque(maxlen=8)
+        self.n_pks_ave = 0.0
+        self._s_pks = np.empty(64)
+        self._s_pks_count = 0
+        self.s_pks_ave = 0.0
+        # last two QRS, starting from the placeholder 0 of the batch code
+        self._QRS = deque([0], maxlen=2)
+        self._n_QRS = 0
+        self._RR = deque(maxlen=8)
+        self.RR_ave = 0.0
+        self.th = 0.0
+        self._last_idx = None
+
+        # The searchback indexes the list of all maxima with sample
+        # indices, so the maxima from list position _history_start (the
+        # last accepted peak) onwards are kept.
+        self._n_peaks = 0
+        self._history = []
+        self._history_first = 0
+        self._history_start = 0
+
+    def _detection_signal(self, chunk):
+        filtered, self._zi = signal.sosfilt(self._sos, chunk, zi=self._zi)
+
+        if self._last_filtered is not None:
+            filtered = np.concatenate(([self._last_filtered], filtered))
+        self._last_filtered = filtered[-1]
+
+        diff = abs(np.diff(filtered))
+
+        ma = self._ma.process(diff)
+        ma[:max(0, self._blanking-self.n_detection)] = 0
+
+        return ma
+
+    def _on_peak(self, peak, amplitude, beats):
+        k = self._n_peaks
+        self._n_peaks += 1
+        if k >= self._history_start:
+            if not self._history:
+                self._history_first = k
+            self._history.append((peak, amplitude))
+
+        QRS = self._QRS
+
+        if amplitude > self.th and (peak-QRS[-1])>0.3*self.fs:
+            QRS.append(peak)
+            self._n_QRS += 1
+            if self._s_pks_count == len(self._s_pks):
+                self._s_pks = np.concatenate((self._s_pks, np.empty(len(self._s_pks))))
+            self._s_pks[self._s_pks_count] = amplitude
+            self._s_pks_count += 1
+            self.s_pks_ave = self._s_pks[:self._s_pks_count].mean()
+
+            if self.RR_ave != 0.0:
+                if QRS[-1]-QRS[-2] > 1.5*self.RR_ave:
+                    first = self._history_first
+                    start = self._last_idx+1
+                    stop = min(peak, k+1)
+                    for missed_peak, missed_amplitude in self._history[start-first:stop-first]:
+                        if missed_peak-self._history[self._last_idx-first][0]>self._ms360 and missed_amplitude>0.5*self.th:
+                            QRS[-2] = missed_peak
+                            self._n_QRS += 1
+                            beats.append(missed_peak)
+                            break
+
+            beats.append(peak)
+
+            if self._n_QRS>1:
+                self._RR.append(QRS[-1]-QRS[-2])
+                self.RR_ave = int(sum(self._RR)/len(self._RR))
+
+            self._last_idx = peak
+            self._trim_history(peak)
+
+        else:
+            self._n_pks.append(amplitude)
+            self.n_pks_ave = short_mean(self._n_pks)
+
+        self.th = self.n_pks_ave + 0.45*(self.s_pks_ave-self.n_pks_ave)
+
+    def _trim_history(self, start):
+        """
+        Drops the maxima before list position start.
+        """
+        self._history_start = start
+        drop = min(start-self._history_first, len(self._history))
+        if drop > 0:
+            del self._history[:drop]
+            self._history_first += drop
+
+
+class ChristovStream(DetectorStream):
+    """
+    Streaming version of Detectors.christov_detector. The learning phase
+    maximum, the F term and the loop state of christovPeakDetect are
+    carried over; with jit the resumable kernel of ecgjit is used if
+    numba is installed.
+    """
+
+    def __init__(self, sampling_frequency, jit=True):
+        fs = sampling_frequency
+        MA1_b, MA2_b, MA3_b = design_filter("christov_ma", fs)
+        self._b = (MA1_b, MA2_b, MA3_b)
+        self._total_taps = len(MA1_b)+len(MA2_b)+len(MA3_b)
+
+        self._ms50 = int(0.05*fs)
+        self._ms200 = int(0.2*fs)
+        self._ms1200 = int(1.2*fs)
+        self._ms350 = int(0.35*fs)
+        self._M_slope = threshold_slope(self._ms200, self._ms1200)
+        self._n_learn = int(np.ceil(5*fs))
+        self._jit = jit and ecgjit is not None
+
+        DetectorStream.__init__(self, sampling_frequency)
+
+    def reset(self):
+        DetectorStream.reset(self)
+
+        # moving averages and derivative
+        self._ma1, self._ma2, self._ma3 = (_FIRFilter(b) for b in self._b)
+        self._ma2_tail = np.zeros(0)
+
+        # running maximum of the learning phase and the F term, from the
+        # trailing 50 ms maxima max50 and the last detection samples
+        self._learn_max = None
+        self._detection_tail = np.zeros(0)
+        self._max50 = np.zeros(0)
+        self._max50_start = max(self._ms50-1, 0)
+        self._F = 0.0
+
+        # threshold loop state
+        if self._jit:
+            self._fstate, self._istate = ecgjit.christov_state()
+        self.M = 0.0
+        self.newM5 = 0.0
+        self._MM = deque(maxlen=5)
+        self.MM_ave = 0.0
+        self.R = 0.0
+        self._RR = deque(maxlen=5)
+        self.Rm = 0
+        self.R_start = 0
+        self._n_QRS = 0
+        self._last_qrs = 0
+        self._seg_max = 0.0
+        self._previous = 0.0
+
+    def _detection_signal(self, chunk):
+        MA2 = self._ma2.process(self._ma1.process(chunk))
+
+        extended = np.concatenate((self._ma2_tail, MA2))
+        self._ma2_tail = extended[-2:]
+        Y = abs(extended[2:]-extended[:-2])
+
+        MA3 = self._ma3.process(Y)
+        MA3[:max(0, self._total_taps-self.n_detection)] = 0
+
+        return MA3
+
+    def _threshold(self, detection, beats):
+        start = self.n_detection
+        n = len(detection)
+
+        # M during the first 5 s is 0.6 times the running maximum
+        n_learn = min(n, max(0, self._n_learn-start))
+        learn = detection[:n_learn]
+        if self._learn_max is not None:
+            learn = np.concatenate(([self._learn_max], learn))
+        learn = np.maximum.accumulate(learn)
+        if n_learn > 0:
+            self._learn_max = learn[-1]
+        M_learn = 0.6*learn[len(learn)-n_learn:]
+
+        F = self._F_term(detection)
+
+        if self._jit:
+            n_QRS = self._istate[ecgjit.CI_N_QRS]
+            QRS = ecgjit.christov_resume(
+                detection, start, M_learn, F, self._M_slope,
+                self._ms200, self._ms1200, self._fstate, self._istate).tolist()
+        else:
+            n_QRS = self._n_QRS
+            QRS = self._loop(detection.tolist(), start, M_learn.tolist(),
+                             F.tolist())
+
+        # the first detection of the record is dropped like in the batch code
+        if n_QRS == 0:
+            QRS = QRS[1:]
+        beats += QRS
+
+    def _F_term(self, detection):
+        """
+        F of christovPeakDetect for the next detection samples: the sum
+        of the differences between the maxima of the latest and the
+        earliest 50 ms of the preceding 350 ms.
+        """
+        start = self.n_detection
+        n = len(detection)
+        ms50, ms350 = self._ms50, self._ms350
+
+        # max50[k] is the maximum of detection[k-ms50+1:k+1]
+        extended = np.concatenate((self._detection_tail, detection))
+        self._detection_tail = extended[max(0, len(extended)-(ms50-1)):]
+        if len(extended) >= ms50 > 0:
+            max50 = ndimage.maximum_filter1d(extended, ms50, origin=(ms50-1)//2)
+            self._max50 = np.concatenate((self._max50, max50[ms50-1:]))
+
+        # F[i] adds the maxima at i-1 and i-1-ms350+ms50
+        F = np.zeros(n)
+        first = max(start, ms350+1)
+        if first < start+n:
+            i = np.arange(first, start+n)
+            terms = (self._max50[i-1-self._max50_start]-
+                     self._max50[i-1-ms350+ms50-self._max50_start])/150.0
+            F[first-start:] = np.cumsum(np.concatenate(([self._F], terms)))[1:]
+            self._F = F[-1]
+
+        # keep the maxima that the next samples refer back to
+        drop = min(start+n-(ms350-ms50+1)-self._max50_start, len(self._max50))
+        if drop > 0:
+            self._max50 = self._max50[drop:]
+            self._max50_start += drop
+
+        return F
+
+    def _loop(self, detection, start, M_learn, F):
+        """
+        Pure Python threshold loop, as christov_resume in ecgjit.
+        """
+        ms200, ms1200 = self._ms200, self._ms1200
+        M_slope = self._M_slope
+        MM, RR = self._MM, self._RR
+        M, newM5, MM_ave, R = self.M, self.newM5, self.MM_ave, self.R
+        Rm, R_start = self.Rm, self.R_start
+        n_QRS, last_qrs = self._n_QRS, self._last_qrs
+        seg_max, previous = self._seg_max, self._previous
+        n_learn = len(M_learn)
+
+        QRS = []
+        for j, value in enumerate(detection):
+            i = start+j
+
+            # M
+            if j < n_learn:
+                M = M_learn[j]
+                MM.append(M)
+                MM_ave = sum(MM)/len(MM)
+
+            elif n_QRS > 0 and i < last_qrs+ms200:
+                if previous > seg_max:
+                    seg_max = previous
+                newM5 = 0.6*seg_max
+                if newM5>1.5*MM[-1]:
+                    newM5 = 1.1*MM[-1]
+
+            elif n_QRS > 0 and i == last_qrs+ms200:
+                if newM5==0:
+                    newM5 = MM[-1]
+                MM.append(newM5)
+                MM_ave = sum(MM)/len(MM)
+                M = MM_ave
+
+            elif n_QRS > 0 and i > last_qrs+ms200 and i < last_qrs+ms1200:
+                M = MM_ave*M_slope[i-(last_qrs+ms200)]
+
+            elif n_QRS > 0 and i > last_qrs+ms1200:
+                M = 0.6*MM_ave
+
+            if j < n_learn and n_QRS > 0 and i > last_qrs:
+                if previous > seg_max:
+                    seg_max = previous
+
+            # R
+            if n_QRS > 0 and i < last_qrs+R_start:
+                R = 0.0
+
+            elif n_QRS > 0 and i > last_qrs+R_start and i < last_qrs+Rm:
+                R = (M-MM_ave)/1.4
+
+            MFR = M+F[j]+R
+
+            if (n_QRS == 0 or i > last_qrs+ms200) and value>MFR:
+                QRS.append(i)
+                n_QRS += 1
+                if n_QRS>2:
+                    RR.append(i-last_qrs)
+                    Rm = int(sum(RR)/len(RR))
+                    R_start = int((2.0/3.0*Rm))
+                last_qrs = i
+                seg_max = value
+
+            previous = value
+
+        self.M, self.newM5, self.MM_ave, self.R = M, newM5, MM_ave, R
+        self.Rm, self.R_start = Rm, R_start
+        self._n_QRS, self._last_qrs = n_QRS, last_qrs
+        self._seg_max, self._previous = seg_max, previous
+
+        return QRS
+
+
+class EngzeeStream(DetectorStream):
+    """
+    Streaming version of Detectors.engzee_detector, without the
+    benchmarking fake delay. The learning phase maximum, the loop state
+    of engzeePeakDetect and the unfiltered ECG since 10 ms before the
+    last QRS are carried over; with jit the resumable kernel of ecgjit
+    is used if numba is installed.
+    """
+
+    def __init__(self, sampling_frequency, jit=True):
+        fs = sampling_frequency
+        self._sos = design_filter("engzee_sos", fs)
+        self._blanking = int(0.2*fs)
+
+        self._ms200 = int(0.2*fs)
+        self._ms1200 = int(1.2*fs)
+        self._ms160 = int(0.16*fs)
+        self._ms10 = int(0.01*fs)
+        self._neg_threshold = int(0.01*fs)
+        self._M_slope = threshold_slope(self._ms200, self._ms1200)
+        self._n_learn = int(np.ceil(5*fs))
+        self._jit = jit and ecgjit is not None
+
+        DetectorStream.__init__(self, sampling_frequency)
+
+    def reset(self):
+        DetectorStream.reset(self)
+
+        # filter, derivative and low pass state
+        self._zi = np.zeros((len(self._sos), 2))
+        self._filtered_tail = np.zeros(0)
+        self._low_pass = _FIRFilter([1,4,6,4,1])
+
+        # unfiltered ECG from _ecg_start on, as far back as the R-peak
+        # search can reach
+        self._ecg = np.zeros(0)
+        self._ecg_start = 0
+
+        # running maximum of the learning phase
+        self._learn_max = None
+
+        # threshold loop state
+        if self._jit:
+            self._fstate, self._istate = ecgjit.engzee_state()
+        self.M = 0.0
+        self._MM = deque(maxlen=5)
+        self.MM_ave = 0.0
+        self.newM5 = 0.0
+        self._n_QRS = 0
+        self._last_qrs = 0
+        self._seg_max = 0.0
+        self._previous = 0.0
+        self._counter = 0
+        self._thi = False
+        self._thf = False
+        self._n_r_peaks = 0
+
+    def _detection_signal(self, chunk):
+        filtered, self._zi = signal.sosfilt(self._sos, chunk, zi=self._zi)
+
+        # diff[k] = filtered[k]-filtered[k-4], 0 for the first 4 samples
+        extended = np.concatenate((self._filtered_tail, filtered))
+        self._filtered_tail = extended[-4:]
+        diff = np.zeros(len(filtered))
+        skip = max(0, 4-self.n_samples)
+        if skip < len(filtered):
+            position = len(extended)-len(filtered)+np.arange(skip, len(filtered))
+            diff[skip:] = extended[position]-extended[position-4]
+
+        low_pass = self._low_pass.process(diff)
+        low_pass[:max(0, self._blanking-self.n_detection)] = 0
+
+        keep = self._ms160+self._ms10
+        self._ecg = np.concatenate((self._ecg[max(0, len(self._ecg)-keep):], chunk))
+        self._ecg_start = self.n_samples+len(chunk)-len(self._ecg)
+
+        return low_pass
+
+    def _threshold(self, low_pass, beats):
+        start = self.n_detection
+        n = len(low_pass)
+
+        # M during the first 5 s is 0.6 times the running maximum
+        n_learn = min(n, max(0, self._n_learn-start))
+        learn = low_pass[:n_learn]
+        if self._learn_max is not None:
+            learn = np.concatenate(([self._learn_max], learn))
+        learn = np.maximum.accumulate(learn)
+        if n_learn > 0:
+            self._learn_max = learn[-1]
+        M_learn = 0.6*learn[len(learn)-n_learn:]
+
+        if self._jit:
+            r_peaks = ecgjit.engzee_resume(
+                low_pass, start, self._ecg, self._ecg_start, M_learn,
+                self._M_slope, self._ms200, self._ms1200, self._ms160,
+                self._ms10, self._neg_threshold,
+                self._fstate, self._istate).tolist()
+        else:
+            r_peaks = self._loop(low_pass.tolist(), start, M_learn.tolist())
+
+        # the first detection of the record is dropped like in the batch code
+        if self._n_r_peaks == 0:
+            beats += r_peaks[1:]
+        else:
+            beats += r_peaks
+        self._n_r_peaks += len(r_peaks)
+
+    def _loop(self, low_pass, start, M_learn):
+        """
+        Pure Python threshold loop, as engzee_resume in ecgjit.
+        """
+        ms200, ms1200, ms160, ms10 = (self._ms200, self._ms1200,
+                                      self._ms160, self._ms10)
+        M_slope = self._M_slope
+        MM = self._MM
+        M, MM_ave, newM5 = self.M, self.MM_ave, self.newM5
+        n_QRS, last_qrs = self._n_QRS, self._last_qrs
+        seg_max, previous = self._seg_max, self._previous
+        counter, thi, thf = self._counter, self._thi, self._thf
+        n_learn = len(M_learn)
+
+        r_peaks = []
+        for j, value in enumerate(low_pass):
+            i = start+j
+
+            # M
+            if j < n_learn:
+                M = M_learn[j]
+                MM.append(M)
+                MM_ave = sum(MM)/len(MM)
+                if n_QRS > 0 and i > last_qrs:
+                    if previous > seg_max:
+                        seg_max = previous
+
+            elif n_QRS > 0 and i < last_qrs+ms200:
+                if previous > seg_max:
+                    seg_max = previous
+                newM5 = 0.6*seg_max
+                if newM5>1.5*MM[-1]:
+                    newM5 = 1.1*MM[-1]
+
+            elif newM5 and n_QRS > 0 and i == last_qrs+ms200:
+                MM.append(newM5)
+                MM_ave = sum(MM)/len(MM)
+                M = MM_ave
+
+            elif n_QRS > 0 and i > last_qrs+ms200 and i < last_qrs+ms1200:
+                M = MM_ave*M_slope[i-(last_qrs+ms200)]
+
+            elif n_QRS > 0 and i > last_qrs+ms1200:
+                M = 0.6*MM_ave
+
+            if (n_QRS == 0 or i > last_qrs+ms200) and value>M:
+                n_QRS += 1
+                last_qrs = i
+                seg_max = value
+                thi = True
+
+            if thi and i<last_qrs+ms160:
+                if value<-M and previous>-M:
+                    thf = True
+
+                if thf and value<-M:
+                    counter += 1
+
+                elif value>-M and thf:
+                    counter = 0
+                    thi = False
+                    thf = False
+
+            elif thi and i>last_qrs+ms160:
+                counter = 0
+                thi = False
+                thf = False
+
+            if counter>self._neg_threshold:
+                section = self._ecg[last_qrs-ms10-self._ecg_start:i-self._ecg_start]
+                r_peaks.append(int(np.argmax(section))+last_qrs-ms10)
+                counter = 0
+                thi = False
+                thf = False
+
+            previous = value
+
+        self.M, self.MM_ave, self.newM5 = M, MM_ave, newM5
+        self._n_QRS, self._last_qrs = n_QRS, last_qrs
+        self._seg_max, self._previous = seg_max, previous
+        self._counter, self._thi, self._thf = counter, thi, thf
+
+        return r_peaks
+
+
+class TwoAverageStream(DetectorStream):
+    """
+    Streaming version of Detectors.two_average_detector with the
+    'cumulative' moving window averages. A block of interest gives its
+    beat once its end has been seen.
+    """
+
+    def __init__(self, sampling_frequency):
+        fs = sampling_frequency
+        self._sos = design_filter("two_average_sos", fs)
+        self._window1 = int(0.12*fs)
+        self._window2 = int(0.6*fs)
+        self._min_length = int(0.08*fs)
+        self._refractory = int(0.3*fs)
+
+        DetectorStream.__init__(self, sampling_frequency)
+
+    def reset(self):
+        DetectorStream.reset(self)
+
+        # filter and moving averages
+        self._zi = np.zeros((len(self._sos), 2))
+        self._mwa_qrs = _CumulativeMWA(self._window1)
+        self._mwa_beat = _CumulativeMWA(self._window2)
+        self._filtered = np.zeros(0)
+
+        # last sample of the block mask, the open block and its maximum
+        self._last_block = None
+        self._block_start = None
+        self._block_max = None
+        self._block_argmax = 0
+        self._last_beat = None
+
+    def _detection_signal(self, chunk):
+        self._filtered, self._zi = signal.sosfilt(self._sos, chunk, zi=self._zi)
+
+        rectified = abs(self._filtered)
+        mwa_qrs = self._mwa_qrs.process(rectified)
+        mwa_beat = self._mwa_beat.process(rectified)
+
+        return mwa_qrs > mwa_beat
+
+    def _threshold(self, blocks, beats):
+        start = self.n_detection
+        filtered = self._filtered
+
+        # a block starts at a rising edge and ends before a falling one
+        if self._last_block is None:
+            edges = np.diff(blocks.astype(np.int8))
+            offset = start+1
+        else:
+            edges = np.diff(np.concatenate(([self._last_block], blocks)).astype(np.int8))
+            offset = start
+        self._last_block = blocks[-1]
+
+        for edge in np.flatnonzero(edges).tolist():
+            if edges[edge] == 1:
+                self._block_start = edge+offset
+                self._block_max = None
+
+            elif self._block_start is not None:
+                end = edge+offset-1
+                self._scan(filtered, self._block_start-start, end-start+1)
+                if end-self._block_start > self._min_length:
+                    self._add_beat(self._block_argmax, beats)
+                self._block_start = None
+
+        if self._block_start is not None:
+            self._scan(filtered, self._block_start-start, len(filtered))
+
+    def _scan(self, filtered, first, stop):
+        """
+        Keeps the first maximum of the open block, which continues in
+        filtered[first:stop] of the current chunk.
+        """
+        first = max(first, 0)
+        if first >= stop:
+            return
+        k = first+int(np.argmax(filtered[first:stop]))
+        if self._block_max is None or filtered[k] > self._block_max:
+            self._block_max = filtered[k]
+            self._block_argmax = self.n_detection+k
+
+    def _add_beat(self, beat, beats):
+        if self._last_beat is None or beat-self._last_beat>self._refractory:
+            beats.append(beat)
+            self._last_beat = beat
+
+
+class WQRSStream(DetectorStream):
+    """
+    Streaming version of Detectors.wqrs_detector. The first beats come
+    once the first length transform window is complete, since the
+    samples before it repeat its value.
+    """
+
+    def __init__(self, sampling_frequency):
+        fs = sampling_frequency
+        self._sos = design_filter("wqrs_sos", fs)
+        self._w = int(np.ceil(fs*0.13))
+        self._refractory = fs*0.35
+
+        DetectorStream.__init__(self, sampling_frequency)
+
+    def reset(self):
+        DetectorStream.reset(self)
+
+        # filter state and the cumulative curve length csum of
+        # length_transform, from sample _csum_start on
+        self._zi = np.zeros((len(self._sos), 2))
+        self._last_filtered = None
+        self._csum = np.zeros(1)
+        self._csum_start = 0
+
+        # threshold state of wqrsPeakDetect
+        self._mwa = _CumulativeMWA(10*self.fs)
+        self._last_beat = None
+
+    def _detection_signal(self, chunk):
+        filtered, self._zi = signal.sosfilt(self._sos, chunk, zi=self._zi)
+
+        if self._last_filtered is not None:
+            filtered = np.concatenate(([self._last_filtered], filtered))
+        self._last_filtered = filtered[-1]
+
+        segments = np.sqrt(np.power(1/self.fs, 2) + np.power(np.diff(filtered), 2))
+        csum = np.cumsum(np.concatenate((self._csum[-1:], segments)))
+        csum = np.concatenate((self._csum, csum[1:]))
+
+        # l[i] = csum[i-1]-csum[i-w] once i >= w, the first w samples
+        # wait for l[w]
+        w = self._w
+        n = self.n_samples+len(chunk)
+        first = max(self.n_detection, w)
+        i = np.arange(first, n)
+        l = csum[i-1-self._csum_start]-csum[i-w-self._csum_start]
+        if self.n_detection < w and len(l) > 0:
+            l = np.concatenate((np.full(w-self.n_detection, l[0]), l))
+        elif self.n_detection < w:
+            l = np.zeros(0)
+
+        drop = max(0, n-w-self._csum_start)
+        self._csum = csum[drop:]
+        self._csum_start += drop
+
+        return l
+
+    def _threshold(self, l, beats):
+        u = self._mwa.process(l)
+        candidates = np.flatnonzero(l > u)+self.n_detection
+
+        k = 0
+        if self._last_beat is not None:
+            k = np.searchsorted(candidates, self._last_beat+self._refractory, side='right')
+        while k < len(candidates):
+            self._last_beat = int(candidates[k])
+            beats.append(self._last_beat)
+            k = np.searchsorted(candidates, candidates[k]+self._refractory, side='right')
+
+
+## Streaming detector of each detector description of
+## Detectors.get_detector_list()
+DETECTOR_STREAMS = {
+    "Elgendi et al (Two average)": TwoAverageStream,
+    "Engzee": EngzeeStream,
+    "Christov": ChristovStream,
+    "Hamilton": HamiltonStream,
+    "Pan Tompkins": PanTompkinsStream,
+    "WQRS": WQRSStream,
+}
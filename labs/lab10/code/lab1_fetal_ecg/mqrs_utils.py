@@ -1,65 +1,361 @@
-import numpy as np
-from scipy.linalg import svd
-from scipy.interpolate import interp1d
-
-
-def cancel_mqrs(fs, x, mqrs, n_eigenvectors_to_keep=3):
-    """Cancel maternal QRS peaks as described in section 2.6 of
-    M Varanini et al 2014 Physiol. Meas. 35 1607.
-
-    Args:
-        fs: sampling frequency (in Hz)
-        x: multi-channel ECG signals of size nSamples x nChannels.
-        mqrs: indices to previously detected mQRS locations.        
-        n_eigenvectors_to_keep: number of eigenvectors to keep for QRS template.
-        
-    Returns:
-        residual signal of `x` with cancelled mQRS peaks.
-        mQRS signals based on templates
-    """
-
-    # number of samples in window around mQRS
-    qrs_window = (-np.fix(0.2 * fs), np.fix(0.5 * fs))
-    # prepare indices for matrix containing all mQRS complexes
-    from scipy.signal.windows import tukey
-    tmp = tukey(M=101, alpha=0.5, sym=True)
-    f = interp1d([qrs_window[0], 0, qrs_window[-1]], [0, (len(tmp)-1)/2, (len(tmp)-1)])
-    idxs = f(np.arange(qrs_window[0], qrs_window[-1]))
-    weighting_win = interp1d(np.arange(len(tmp)), tmp)(idxs) * 0.8 + 0.2
-    weighting_win = weighting_win.reshape(-1, 1).repeat(len(mqrs), axis=1)
-    lookup_matrix = (np.arange(*qrs_window).reshape(-1, 1).repeat(
-        len(mqrs), axis=1) + mqrs.reshape(1, -1).repeat(
-        int(np.diff(qrs_window)), axis=0))
-    lookup_matrix = lookup_matrix.astype(int)
-
-    # perform mQRS cancelling for each channel/lead individually
-    x_mqrs = np.full(x.shape, np.nan)
-
-    for ic in range(x.shape[1]):
-        # create matrix with all mQRS complexes for this channel/lead
-        #   matrix of size nSamplesInWindow x nMaternalQRSComplexes
-        A = x[lookup_matrix.astype(int), ic].squeeze() * weighting_win
-
-        # perform SVD on all mQRS complexes
-        u, s, vh = svd(A, full_matrices=False)
-        s_reduced = np.zeros(s.shape)
-        s_reduced[:n_eigenvectors_to_keep] = s[:n_eigenvectors_to_keep]
-        ar = u @ np.diag(s_reduced) @ vh
-
-        # approximate each individual mQRS using SVD
-        unweighted_mqrs = ar / weighting_win
-        for iqrs in range(A.shape[1]):
-            x_mqrs[lookup_matrix[:, iqrs], ic] = unweighted_mqrs[:, iqrs]
-
-        # create smooth connections between successive mQRS
-        to_interpolate = np.isnan(x_mqrs[:, ic])
-        idxs = np.arange(len(to_interpolate))
-        f = interp1d(idxs[~to_interpolate], x_mqrs[~to_interpolate, ic],
-                     kind='linear', fill_value=0, bounds_error=False)
-        x_mqrs[to_interpolate, ic] = f(idxs[to_interpolate])
-
-    # remove mQRS to get fQRS in residual signal
-    x_residual = x - x_mqrs
-
-    return x_residual, x
-
+from collections import deque
+from functools import lru_cache
+
+import numpy as np
+from scipy.linalg import eigh, svd
+from scipy.interpolate import interp1d
+from scipy.signal.windows import tukey
+
+
+# seconds before and after each mQRS covered by its template
+QRS_WINDOW = (0.2, 0.5)
+
+# factor applied to the singular values of the streaming template
+# subspace for every new mQRS, the weight of a beat halves after about
+# 35 newer ones
+FORGETTING_FACTOR = 0.98
+
+# seconds after which the streaming canceller returns a sample even if
+# no later mQRS has been seen
+MAX_LATENCY = 2.0
+
+
+def cancel_mqrs(fs, x, mqrs, n_eigenvectors_to_keep=3, truncated=True,
+                out=None):
+    """Cancel maternal QRS peaks as described in section 2.6 of
+    M Varanini et al 2014 Physiol. Meas. 35 1607.
+
+    Args:
+        fs: sampling frequency (in Hz)
+        x: multi-channel ECG signals of size nSamples x nChannels.
+        mqrs: indices to previously detected mQRS locations.        
+        n_eigenvectors_to_keep: number of eigenvectors to keep for QRS template.
+        truncated: only compute the kept eigenvectors, see
+            low_rank_approximation(). Otherwise a full SVD is computed.
+        out: optional array of the shape of `x` the residual is written
+            to. It may be `x` itself to cancel the mQRS in place.
+        
+    Returns:
+        residual signal of `x` with cancelled mQRS peaks.
+        mQRS signals based on templates
+    """
+    canceller = mqrs_canceller(fs)
+
+    return canceller.cancel(x, mqrs, n_eigenvectors_to_keep, truncated, out)
+
+
+@lru_cache(maxsize=16)
+def mqrs_canceller(fs, qrs_window=QRS_WINDOW):
+    """MQRSCanceller for a sampling frequency and window, shared by all
+    calls with the same arguments.
+    """
+    return MQRSCanceller(fs, qrs_window)
+
+
+class MQRSCanceller:
+    """Cancels maternal QRS peaks like cancel_mqrs(). The window around
+    each mQRS and its weighting profile only depend on the sampling
+    frequency, so they are computed once and reused for every block of
+    signal. The indices of the beat windows of a block are the sum of
+    the window offsets and the mQRS locations, broadcast when needed.
+    """
+
+    def __init__(self, fs, qrs_window=QRS_WINDOW):
+        """
+        Args:
+            fs: sampling frequency (in Hz)
+            qrs_window: seconds before and after each mQRS covered by
+                its template.
+        """
+        self.fs = fs
+
+        # number of samples in window around mQRS
+        window = (-np.fix(qrs_window[0] * fs), np.fix(qrs_window[1] * fs))
+
+        # sample offsets of the window from its mQRS
+        self.offsets = np.arange(*window).astype(int)
+        self.offsets.flags.writeable = False
+
+        # Tukey window stretched to put its centre on the mQRS
+        tmp = tukey(M=101, alpha=0.5, sym=True)
+        f = interp1d([window[0], 0, window[-1]], [0, (len(tmp)-1)/2, (len(tmp)-1)])
+        idxs = f(np.arange(window[0], window[-1]))
+        self.weighting_win = interp1d(np.arange(len(tmp)), tmp)(idxs) * 0.8 + 0.2
+        self.weighting_win.flags.writeable = False
+
+    def lookup(self, mqrs):
+        """Indices of the samples of all mQRS windows, as a matrix of
+        size nSamplesInWindow x nMaternalQRSComplexes.
+        """
+        return self.offsets[:, None] + np.asarray(mqrs, dtype=int)[None, :]
+
+    def cancel(self, x, mqrs, n_eigenvectors_to_keep=3, truncated=True,
+               out=None):
+        """Cancels the mQRS of `x`, see cancel_mqrs() for the arguments.
+        """
+        lookup_matrix = self.lookup(mqrs)
+        weighting_win = self.weighting_win[:, None]
+
+        # samples outside of all mQRS windows are interpolated linearly
+        # between the nearest samples inside them, which are the same for
+        # all channels
+        covered = np.zeros(len(x), dtype=bool)
+        covered[lookup_matrix] = True
+        gaps = interpolation_gaps(covered)
+
+        # later mQRS overwrite earlier ones where their windows overlap
+        scatter_idxs = lookup_matrix.T.ravel()
+
+        if out is None:
+            out = np.empty(x.shape)
+        x_mqrs = np.empty(len(x))
+
+        # perform mQRS cancelling for each channel/lead individually
+        for ic in range(x.shape[1]):
+            # create matrix with all mQRS complexes for this channel/lead
+            #   matrix of size nSamplesInWindow x nMaternalQRSComplexes
+            A = x[lookup_matrix, ic] * weighting_win
+
+            # approximate all mQRS complexes by the leading eigenvectors
+            if truncated:
+                ar = low_rank_approximation(A, n_eigenvectors_to_keep)
+            else:
+                u, s, vh = svd(A, full_matrices=False)
+                k = n_eigenvectors_to_keep
+                ar = (u[:, :k] * s[:k]) @ vh[:k]
+
+            # approximate each individual mQRS using SVD
+            unweighted_mqrs = ar / weighting_win
+            x_mqrs[scatter_idxs] = unweighted_mqrs.T.ravel()
+
+            # create smooth connections between successive mQRS
+            interpolate_gaps(x_mqrs, gaps)
+
+            # remove mQRS to get fQRS in residual signal
+            np.subtract(x[:, ic], x_mqrs, out=out[:, ic])
+
+        return out, x
+
+
+class MQRSCancellerStream:
+    """Online version of cancel_mqrs() for continuous recordings.
+
+    The signal arrives in chunks together with the mQRS detected so far.
+    Each mQRS is cancelled as soon as its whole window has arrived. The
+    per-channel template subspace is not computed from all beats of the
+    record but updated for every beat by an incremental SVD of the
+    kept eigenvectors and the new, weighted beat. The old beats are
+    down-weighted by forgetting_factor. Every beat is then projected
+    onto the updated subspace.
+
+    A sample is returned once the window of a later mQRS has started,
+    because until then that window may still overwrite or interpolate
+    it, or at the latest max_latency seconds after it arrived. Samples
+    that are returned in a gap without a later mQRS keep a template of
+    zero, like the samples after the last mQRS in cancel_mqrs(). Memory
+    use is bounded by the window, the latency and the chunk size.
+    """
+
+    def __init__(self, fs, n_channels, n_eigenvectors_to_keep=3,
+                 forgetting_factor=FORGETTING_FACTOR,
+                 max_latency=MAX_LATENCY, qrs_window=QRS_WINDOW):
+        """
+        Args:
+            fs: sampling frequency (in Hz)
+            n_channels: number of channels of the signal.
+            n_eigenvectors_to_keep: number of eigenvectors to keep for QRS template.
+            forgetting_factor: weight of the previous beats relative to
+                a new beat, 1 to weight all beats equally.
+            max_latency: maximum number of seconds a sample is held
+                back waiting for the next mQRS.
+            qrs_window: seconds before and after each mQRS covered by
+                its template.
+        """
+        self.fs = fs
+        self.n_channels = n_channels
+        self.n_eigenvectors_to_keep = n_eigenvectors_to_keep
+        self.forgetting_factor = forgetting_factor
+        self.max_latency = int(max_latency * fs)
+        self.canceller = mqrs_canceller(fs, qrs_window)
+
+        self.reset()
+
+    def reset(self):
+        """Clears all state so that the next chunk starts a new recording.
+        """
+        n_window = len(self.canceller.offsets)
+
+        # number of samples received and returned so far
+        self.n_samples = 0
+        self.n_output = 0
+
+        # signal and template from sample _buffer_start on
+        self._buffer_start = 0
+        self._buffer = np.zeros((0, self.n_channels))
+        self._template = np.zeros((0, self.n_channels))
+
+        # mQRS whose window has not arrived completely
+        self._pending = deque()
+
+        # leading left singular vectors and singular values per channel
+        self._u = np.zeros((self.n_channels, n_window, 0))
+        self._s = np.zeros((self.n_channels, 0))
+
+        # start of the window of the last cancelled mQRS, end of the
+        # windows so far and the template on the last sample before it
+        self._window_start = 0
+        self._covered_end = None
+        self._left_value = None
+
+    def process(self, chunk, mqrs=()):
+        """Feeds the next chunk of the signal.
+
+        Args:
+            chunk: signal of size nSamples x nChannels.
+            mqrs: indices, counted from the start of the recording, of
+                the mQRS detected since the last call, in increasing order.
+
+        Returns:
+            residual of the samples n_output onwards that became final,
+            of size nFinalSamples x nChannels.
+        """
+        chunk = np.asarray(chunk, dtype=float).reshape(-1, self.n_channels)
+        self._buffer = np.concatenate((self._buffer, chunk))
+        self._template = np.concatenate((self._template, np.zeros(chunk.shape)))
+        self.n_samples += len(chunk)
+
+        self._pending.extend(int(r) for r in mqrs)
+        offsets = self.canceller.offsets
+        while self._pending and self._pending[0] + offsets[-1] < self.n_samples:
+            self._cancel_beat(self._pending.popleft())
+
+        return self._emit(max(self._window_start, self.n_samples - self.max_latency))
+
+    def flush(self):
+        """Returns the residual of all samples not returned yet, as at
+        the end of the recording. mQRS whose window does not fit into
+        the recording are not cancelled.
+        """
+        self._pending.clear()
+
+        return self._emit(self.n_samples)
+
+    def _cancel_beat(self, r):
+        offsets = self.canceller.offsets
+        weighting_win = self.canceller.weighting_win
+        start = r + offsets[0]
+        stop = r + offsets[-1] + 1
+        if start < self._buffer_start:
+            # the window starts before the recording or has already been
+            # returned and dropped
+            return
+
+        # update the subspace with the weighted beat, nChannels x nSamplesInWindow
+        a = self._buffer[start-self._buffer_start:stop-self._buffer_start].T * weighting_win
+        m = np.concatenate((self._u * (self.forgetting_factor * self._s)[:, None, :],
+                            a[:, :, None]), axis=2)
+        u, s, _ = np.linalg.svd(m, full_matrices=False)
+        self._u = u[:, :, :self.n_eigenvectors_to_keep]
+        self._s = s[:, :self.n_eigenvectors_to_keep]
+
+        # approximate the mQRS by its projection onto the subspace
+        coefficients = np.matmul(self._u.transpose(0, 2, 1), a[:, :, None])
+        template = (np.matmul(self._u, coefficients)[:, :, 0] / weighting_win).T
+
+        # create a smooth connection from the previous mQRS
+        if self._covered_end is not None and start > self._covered_end:
+            left = self._covered_end - 1
+            idxs = np.arange(max(self._covered_end, self.n_output), start)
+            slope = (template[0] - self._left_value) / (start - left)
+            self._template[idxs-self._buffer_start] = (
+                slope * (idxs - left)[:, None] + self._left_value)
+
+        # later mQRS overwrite earlier ones, but not what was returned
+        lo = max(start, self.n_output)
+        self._template[lo-self._buffer_start:stop-self._buffer_start] = template[lo-start:]
+
+        self._window_start = start
+        if self._covered_end is None or stop >= self._covered_end:
+            self._covered_end = stop
+            self._left_value = template[-1]
+
+    def _emit(self, stop):
+        stop = min(stop, self.n_samples)
+        if stop <= self.n_output:
+            return np.zeros((0, self.n_channels))
+
+        lo = self.n_output - self._buffer_start
+        hi = stop - self._buffer_start
+        residual = self._buffer[lo:hi] - self._template[lo:hi]
+        self.n_output = stop
+
+        # keep one window of returned signal for mQRS detected late
+        keep = max(self.n_output - len(self.canceller.offsets), self._buffer_start)
+        self._buffer = self._buffer[keep-self._buffer_start:]
+        self._template = self._template[keep-self._buffer_start:]
+        self._buffer_start = keep
+
+        return residual
+
+
+def low_rank_approximation(A, rank):
+    """Best approximation of rank `rank` of the matrix A, the same as
+    keeping its largest `rank` singular values in an SVD.
+
+    Only the leading singular vectors are computed, as the leading
+    eigenvectors of the Gram matrix of the shorter side of A, and A is
+    projected onto them. For a window of a few hundred samples and
+    thousands of beats this is about ten times faster than a full SVD.
+
+    Args:
+        A: matrix of size nSamplesInWindow x nMaternalQRSComplexes.
+        rank: number of singular values to keep.
+
+    Returns:
+        rank-`rank` approximation of `A`.
+    """
+    n_rows, n_cols = A.shape
+    if rank >= min(n_rows, n_cols):
+        return A.copy()
+    if rank <= 0:
+        return np.zeros_like(A)
+
+    if n_rows <= n_cols:
+        _, u = eigh(A @ A.T, subset_by_index=[n_rows-rank, n_rows-1])
+        return u @ (u.T @ A)
+
+    _, v = eigh(A.T @ A, subset_by_index=[n_cols-rank, n_cols-1])
+    return (A @ v) @ v.T
+
+
+def interpolation_gaps(covered):
+    """Linear interpolation of the samples where `covered` is False from
+    the nearest covered samples on either side.
+
+    Args:
+        covered: boolean array, True for the samples that are known.
+
+    Returns:
+        indices of the gap samples inside the covered range, the indices
+        of their left and right covered neighbours, and the indices of the
+        gap samples before the first or after the last covered sample.
+    """
+    idxs = np.arange(len(covered))
+    left = np.maximum.accumulate(np.where(covered, idxs, -1))
+    right = np.minimum.accumulate(np.where(covered, idxs, len(covered))[::-1])[::-1]
+
+    inside = ~covered & (left >= 0) & (right < len(covered))
+    outside = np.flatnonzero(~covered & ~inside)
+    inside = np.flatnonzero(inside)
+
+    return inside, left[inside], right[inside], outside
+
+
+def interpolate_gaps(y, gaps):
+    """Fills the gaps found by interpolation_gaps() in `y` in place, in the
+    same way as a linear interp1d with fill_value=0.
+    """
+    inside, left, right, outside = gaps
+    slope = (y[right] - y[left]) / (right - left)
+    y[inside] = slope * (inside - left) + y[left]
+    y[outside] = 0
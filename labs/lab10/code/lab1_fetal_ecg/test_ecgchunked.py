@@ -0,0 +1,77 @@
+"""
+Parity tests of chunked detection.
+
+detect_chunked and the streaming detectors it feeds are compared with
+the detectors of ecgdetectors.Detectors run on the whole record, for
+every detector, on single and multi-lead records and with chunks that
+end anywhere in a beat, down to a few samples.
+
+Run with
+python -m pytest test_ecgchunked.py
+"""
+
+import numpy as np
+import pytest
+
+from ecgbenchmark import synthetic_ecg
+from ecgchunked import detect_chunked
+from ecgdetectors import Detectors
+from ecgstreaming import DETECTOR_STREAMS
+
+
+DETECTORS = [description for description, _ in Detectors().get_detector_list()]
+
+
+def full_record(detector, ecg, fs):
+    return dict(Detectors(fs).get_detector_list())[detector](ecg).tolist()
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_single_lead_matches_full_record(detector):
+    fs = 500
+    for seed, heart_rate in enumerate((70, 130)):
+        ecg, _ = synthetic_ecg(fs, 240, heart_rate=heart_rate, noise=0.2, seed=seed)
+        expected = full_record(detector, ecg, fs)
+
+        for chunk_duration in (7.3, 60):
+            r_peaks = detect_chunked(ecg, detector, fs, chunk_duration)
+            assert r_peaks.tolist() == expected, (seed, chunk_duration)
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_multi_lead_matches_full_record(detector, tmp_path):
+    fs = 360
+    leads = [synthetic_ecg(fs, 120, heart_rate=heart_rate, noise=noise, seed=seed)[0]
+             for seed, heart_rate, noise in ((0, 60, 0.05), (1, 95, 0.2), (2, 150, 0.1))]
+    ecg = np.memmap(tmp_path / "ecg.dat", dtype=np.float32, mode="w+",
+                    shape=(len(leads[0]), len(leads)))
+    ecg[:] = np.column_stack(leads)
+
+    r_peaks = detect_chunked(ecg, detector, fs, chunk_duration=11.1)
+
+    for lead in range(len(leads)):
+        expected = full_record(detector, np.asarray(ecg[:, lead], dtype=float), fs)
+        assert r_peaks[lead].tolist() == expected, lead
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_stream_with_tiny_chunks(detector):
+    fs = 250
+    ecg, _ = synthetic_ecg(fs, 20, heart_rate=120, noise=0.1, seed=4)
+    expected = full_record(detector, ecg, fs)
+
+    rng = np.random.default_rng(0)
+    # Christov and Engzee also run their pure Python loops
+    options = [{}, {"jit": False}] if detector in ("Christov", "Engzee") else [{}]
+    for kwargs in options:
+        stream = DETECTOR_STREAMS[detector](fs, **kwargs)
+
+        beats = []
+        start = 0
+        while start < len(ecg):
+            stop = start+int(rng.integers(1, 6))
+            beats += stream.process(ecg[start:stop])
+            start = stop
+
+        assert beats == expected, kwargs
+
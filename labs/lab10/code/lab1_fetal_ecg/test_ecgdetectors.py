@@ -0,0 +1,219 @@
+"""
+Parity tests of the threshold stage of the Hamilton detector, of the
+batched R-peak search, and a check of the stage vocabulary of the
+instrumentation.
+
+hamiltonPeakDetect, its numba kernel and HamiltonStream are compared
+with the sample by sample loop of the original hamilton_detector, on
+the detection signals of the bundled records and on random detection
+signals made to trigger the searchback.
+
+Run with
+python -m pytest test_ecgdetectors.py
+"""
+
+import numpy as np
+import pytest
+
+from ecgbenchmark import bundled_records, synthetic_ecg
+import ecgdetectors
+from ecgdetectors import STAGES, Detectors, ecgjit, hamiltonPeakDetect, r_peak_search
+from ecgstreaming import HamiltonStream
+
+
+def reference_hamilton(ma, fs):
+    """
+    Threshold loop of the original Detectors.hamilton_detector, from the
+    moving average on. Returns the beats and the number of searchbacks
+    that found a missed beat.
+    """
+    n_pks = []
+    n_pks_ave = 0.0
+    s_pks = []
+    s_pks_ave = 0.0
+    QRS = [0]
+    RR = []
+    RR_ave = 0.0
+
+    th = 0.0
+
+    idx = []
+    peaks = []
+    searchbacks = 0
+
+    for i in range(len(ma)):
+
+        if i>0 and i<len(ma)-1:
+            if ma[i-1]<ma[i] and ma[i+1]<ma[i]:
+                peak = i
+                peaks.append(i)
+
+                if ma[peak] > th and (peak-QRS[-1])>0.3*fs:
+                    QRS.append(peak)
+                    idx.append(i)
+                    s_pks.append(ma[peak])
+                    if len(n_pks)>8:
+                        s_pks.pop(0)
+                    s_pks_ave = np.mean(s_pks)
+
+                    if RR_ave != 0.0:
+                        if QRS[-1]-QRS[-2] > 1.5*RR_ave:
+                            missed_peaks = peaks[idx[-2]+1:idx[-1]]
+                            for missed_peak in missed_peaks:
+                                if missed_peak-peaks[idx[-2]]>int(0.360*fs) and ma[missed_peak]>0.5*th:
+                                    QRS.append(missed_peak)
+                                    QRS.sort()
+                                    searchbacks += 1
+                                    break
+
+                    if len(QRS)>2:
+                        RR.append(QRS[-1]-QRS[-2])
+                        if len(RR)>8:
+                            RR.pop(0)
+                        RR_ave = int(np.mean(RR))
+
+                else:
+                    n_pks.append(ma[peak])
+                    if len(n_pks)>8:
+                        n_pks.pop(0)
+                    n_pks_ave = np.mean(n_pks)
+
+                th = n_pks_ave + 0.45*(s_pks_ave-n_pks_ave)
+
+    QRS.pop(0)
+
+    return QRS, searchbacks
+
+
+def random_detection(fs, duration, seed):
+    """
+    Moving average like detection signal: triangular pulses at a
+    varying heart rate, some of them weak, on low noise.
+
+    The searchback of the original slices the list of local maxima with
+    sample indices, so it can only find a missed beat while there are
+    more maxima than samples before the previous beat. Here that is set
+    up at the start: two beats, then the noise maxima catch up during a
+    pause, and a weak beat in the pause is found by the searchback.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration*fs)
+    ma = np.abs(rng.normal(0, 0.002, n))
+
+    width = max(int(0.04*fs), 2)
+    pulse = 1-np.abs(np.linspace(-1, 1, 2*width+1))
+
+    first = int(0.3*fs)+1
+    second = first+int(rng.uniform(0.31, 0.45)*fs)
+    missed = 3*second+int(rng.uniform(0.45, 0.8)*fs)
+    ma[missed-width:missed+width+1] += rng.uniform(0.25, 0.42)*pulse
+
+    beats = [first, second]
+    beat = missed+rng.uniform(0.4, 0.8)*fs
+    while beat < n-width-1:
+        beats.append(int(beat))
+        beat += fs*rng.uniform(0.5, 1.1)
+        if rng.random() < 0.05:
+            beat += fs*rng.uniform(0.5, 1.5)
+
+    for beat in beats:
+        amplitude = rng.uniform(0.8, 1.2)
+        if rng.random() < 0.15:
+            amplitude *= rng.uniform(0.2, 0.6)
+        ma[beat-width:beat+width+1] += amplitude*pulse
+
+    return ma
+
+
+def detection_signals():
+    signals = []
+    for name, ecg, fs, _ in bundled_records():
+        signals.append((name, Detectors(fs).hamilton_preprocessing(ecg), fs))
+
+    return signals
+
+
+@pytest.mark.parametrize("name,ma,fs", detection_signals())
+def test_hamilton_bundled_records(name, ma, fs):
+    expected, _ = reference_hamilton(ma, fs)
+
+    assert hamiltonPeakDetect(ma, fs, jit=False).tolist() == expected
+    if ecgjit is not None:
+        assert hamiltonPeakDetect(ma, fs, jit=True).tolist() == expected
+
+
+def test_hamilton_searchback_fuzz():
+    searchbacks = 0
+    for seed in range(40):
+        fs = (250, 360, 500, 1000)[seed % 4]
+        ma = random_detection(fs, 60, seed)
+        expected, n = reference_hamilton(ma, fs)
+        searchbacks += n
+
+        assert hamiltonPeakDetect(ma, fs, jit=False).tolist() == expected, seed
+        if ecgjit is not None:
+            assert hamiltonPeakDetect(ma, fs, jit=True).tolist() == expected, seed
+
+    # the fuzz is only useful if it goes through the searchback
+    assert searchbacks > 0
+
+
+def test_hamilton_stream_matches_batch():
+    rng = np.random.default_rng(0)
+    for name, ecg, fs, _ in bundled_records():
+        detectors = Detectors(fs)
+        expected = detectors.hamilton_detector(ecg).tolist()
+
+        stream = HamiltonStream(fs)
+        beats = []
+        start = 0
+        while start < len(ecg):
+            stop = start+int(rng.integers(1, fs))
+            beats += stream.process(ecg[start:stop])
+            start = stop
+
+        assert sorted(beats) == expected, name
+
+
+@pytest.mark.skipif(ecgjit is None, reason="numba is not installed")
+def test_pairwise_sum_matches_np_mean():
+    rng = np.random.default_rng(0)
+    for n in list(rng.integers(1, 3000, 200))+[8, 128, 129, 8192, 20000]:
+        a = rng.random(int(n))*10.0**rng.integers(-3, 4)
+
+        assert ecgjit._pairwise_sum(a, 0, len(a))/len(a) == np.mean(a)
+
+
+def test_stage_profile_uses_fixed_stages():
+    fs = 250
+    ecg, _ = synthetic_ecg(fs, 20)
+    detectors = Detectors(fs)
+    with detectors.instrument(trace_memory=False) as profile:
+        for _, detector in detectors.get_detector_list():
+            detector(ecg)
+    report = profile.report()
+
+    # every stage is recorded by some detector
+    assert {record["stage"] for record in report["records"]} == set(STAGES)
+    # every detector filters and thresholds, so both add up over all six
+    totals = {total["stage"]: total for total in report["totals"]}
+    assert totals["filter"]["runs"] >= 6
+    assert totals["thresholding"]["runs"] == 6
+    assert sum(total["runs"] for total in report["totals"]) == len(report["records"])
+
+
+def test_r_peak_search_in_batches(monkeypatch):
+    rng = np.random.default_rng(0)
+    ecg = np.round(rng.normal(size=5000), 1)
+    r_peaks = np.sort(rng.integers(-20, len(ecg)+20, 700))
+    radius = 37
+
+    # one window at a time, with the first of equal samples
+    expected = []
+    for peak in r_peaks:
+        window = np.clip(np.arange(peak-radius, peak+radius+1), 0, len(ecg)-1)
+        expected.append(window[np.argmax(ecg[window])])
+
+    for batch in (1, 2*radius+1, 1000, 1 << 18):
+        monkeypatch.setattr(ecgdetectors, "R_PEAK_SEARCH_BATCH", batch)
+        assert r_peak_search(ecg, r_peaks, radius).tolist() == expected, batch
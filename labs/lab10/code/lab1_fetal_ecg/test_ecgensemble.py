@@ -0,0 +1,40 @@
+"""
+Tests of the detector ensemble.
+
+Without the shared bandpass every detector of the ensemble gives the
+beats of its own detector. By default Hamilton reuses the Pan-Tompkins
+bandpass, which is then computed once for both.
+
+Run with
+python -m pytest test_ecgensemble.py
+"""
+
+from ecgbenchmark import synthetic_ecg
+from ecgdetectors import Detectors
+from ecgensemble import DetectorEnsemble
+
+
+def test_unshared_stages_match_detectors():
+    fs = 360
+    ecg, _ = synthetic_ecg(fs, 60, heart_rate=80, noise=0.1, seed=2)
+    detectors = dict(Detectors(fs).get_detector_list())
+
+    r_peaks = DetectorEnsemble(fs, shared_bandpass=False).detect_all(ecg)
+
+    assert set(r_peaks) == set(detectors)
+    for description, detector in detectors.items():
+        assert r_peaks[description].tolist() == detector(ecg).tolist(), description
+
+
+def test_shared_bandpass_runs_once():
+    fs = 250
+    ecg, beats = synthetic_ecg(fs, 60, heart_rate=70, seed=5)
+    ensemble = DetectorEnsemble(fs, detectors=["Pan Tompkins", "Hamilton"], min_votes=2)
+
+    with ensemble.detectors.instrument(trace_memory=False) as profile:
+        r_peaks = ensemble.detect(ecg)
+    filters = [(record["detector"], record["label"]) for record in profile.report()["records"]
+               if record["stage"] == "filter"]
+
+    assert filters == [("Pan Tompkins", "bandpass")]
+    assert abs(len(r_peaks)-len(beats)) <= 1
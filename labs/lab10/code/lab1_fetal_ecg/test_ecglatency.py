@@ -0,0 +1,65 @@
+"""
+Tests of the detection latency profiler.
+
+replay() feeds every detector through its stream of ecgstreaming.py.
+The beats it reports are compared with the detector run on the whole
+record, and the sample at which each became final with a reference that
+reruns the detector on the record received so far after every step.
+
+Run with
+python -m pytest test_ecglatency.py
+"""
+
+import numpy as np
+import pytest
+
+from ecgbenchmark import synthetic_ecg
+from ecgdetectors import Detectors
+from ecglatency import latency_report, replay
+
+
+DETECTORS = [description for description, _ in Detectors().get_detector_list()]
+
+
+def reference_decisions(detector, ecg, step):
+    """
+    Sample at which each beat became final: the number of samples
+    received since which every rerun on the record so far finds it.
+    """
+    final_since = {}
+    for stop in range(step, len(ecg)+step, step):
+        stop = min(stop, len(ecg))
+        try:
+            r_peaks = detector(ecg[:stop])
+        except (ValueError, IndexError):
+            # too short for the filters of the detector
+            continue
+
+        final_since = {peak: final_since.get(peak, stop) for peak in r_peaks.tolist()}
+
+    return final_since
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_stream_latencies_match_batch(detector):
+    fs = 250
+    ecg, _ = synthetic_ecg(fs, 12, heart_rate=90, noise=0.1, seed=3)
+    batch = dict(Detectors(fs).get_detector_list())[detector]
+
+    beats = replay(ecg, detector, fs, step=0.1)
+
+    assert beats["index"].tolist() == batch(ecg).tolist()
+    expected = reference_decisions(batch, ecg, int(0.1*fs))
+    assert beats["decision"].tolist() == [expected[i] for i in beats["index"].tolist()]
+
+
+def test_latency_report_covers_all_detectors():
+    fs = 360
+    ecg, _ = synthetic_ecg(fs, 30, seed=1)
+
+    report = latency_report(ecg, fs)
+
+    assert set(report["detectors"]) == set(DETECTORS)
+    for summary in report["detectors"].values():
+        assert summary["n_beats"] > 0
+        assert 0 <= summary["within_budget"] <= 1